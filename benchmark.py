@@ -0,0 +1,304 @@
+import argparse
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+from caoslexer import lexcaos
+from caosparser import parse
+from caosprofile import Profile
+from extendedcaos import extendedcaos_to_caos
+
+# Synthetic Extended CAOS inputs. Each generator takes its sizes as arguments
+# and returns the source text, so the same shape can be benchmarked at
+# different scales. Repeated parts go in their own event scripts, since a
+# script only has 100 variables to go around
+
+
+def in_script(i, body):
+    return "scrp 3 1 21051 {}\n{}endm\n".format(i + 1, body)
+
+
+def generate_scripts(n):
+    # n event scripts, each with a handful of plain commands
+    parts = []
+    for i in range(n):
+        parts.append(
+            "scrp 3 1 21051 {}\n"
+            "    setv $count {}\n"
+            "    addv $count 1\n"
+            "    dbg: outv $count\n"
+            "    mvsf 10 {}\n"
+            "endm\n".format(i + 1, i, i)
+        )
+    return "".join(parts)
+
+
+def generate_macros(m, k):
+    # m macros taking an argument, each of them invoked k times
+    parts = []
+    for i in range(m):
+        parts.append(
+            "macro Macro{} value\n"
+            "    setv $result{} $value\n"
+            "    dbg: outv $result{}\n"
+            "endmacro\n".format(i, i, i)
+        )
+    for j in range(k):
+        parts.append(
+            in_script(j, "".join("Macro{} {}\n".format(i, j) for i in range(m)))
+        )
+    return "".join(parts)
+
+
+def generate_dot_chains(n, depth):
+    # n chains of dot commands, each one depending on the agent from the last
+    parts = []
+    for i in range(n):
+        chain = "seta $agent0 ownr\n"
+        for d in range(depth):
+            chain += "seta $agent{} $agent{}.carr\n".format(d + 1, d)
+        chain += "$agent{0}.mvsf $agent0.posx $agent{0}.posy\n".format(depth)
+        parts.append(in_script(i, chain))
+    return "".join(parts)
+
+
+def generate_conditions(n, terms):
+    # n doifs, each with a condition of terms comparisons joined by and/or
+    parts = []
+    for i in range(n):
+        condition = ""
+        for t in range(terms):
+            if t:
+                condition += " and " if t % 2 else " or "
+            condition += "posx > {}".format(t + i)
+        body = "doif {}\n    dbg: outv {}\nelif posy = {}\n    dbg: outv 0\nendi\n"
+        parts.append(in_script(i, body.format(condition, i, i)))
+    return "".join(parts)
+
+
+def generate_constants(n):
+    # n constants, each used a couple of times
+    parts = []
+    for i in range(n):
+        parts.append("constant :classifier{} 3 1 {}\n".format(i, 1000 + i))
+        parts.append("constant :value{} {}\n".format(i, i))
+    for i in range(n):
+        parts.append("enum :classifier{}\n".format(i))
+        parts.append("    dbg: outv :value{}\n".format(i))
+        parts.append("next\n")
+    return "".join(parts)
+
+
+def generate_mixed(n):
+    # a bit of everything, roughly what a real agent file looks like
+    return "".join(
+        [
+            generate_constants(n),
+            generate_macros(n // 10 + 1, 10),
+            generate_conditions(n, 4),
+            generate_dot_chains(n // 10 + 1, 10),
+            generate_scripts(n),
+        ]
+    )
+
+
+# name -> (generator, arguments at scale 1). Arguments get multiplied by the
+# scale, apart from the second one for the shapes where that's a depth or width
+CASES = {
+    "scripts": (generate_scripts, (500,)),
+    "macros": (generate_macros, (10, 50)),
+    "dot_chains": (generate_dot_chains, (50, 20)),
+    "conditions": (generate_conditions, (200, 6)),
+    "constants": (generate_constants, (300,)),
+    "mixed": (generate_mixed, (100,)),
+}
+SCALED_ARGUMENTS = {
+    "scripts": (0,),
+    "macros": (1,),
+    "dot_chains": (0,),
+    "conditions": (0,),
+    "constants": (0,),
+    "mixed": (0,),
+}
+
+
+def generate_case(name, scale=1):
+    generator, arguments = CASES[name]
+    arguments = [
+        max(1, int(a * scale)) if i in SCALED_ARGUMENTS[name] else a
+        for i, a in enumerate(arguments)
+    ]
+    return generator(*arguments)
+
+
+def best_of(repeat, function):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_case(source, repeat=3):
+    # times the lexer and parser on their own, then a whole compile pass by
+    # pass. Everything is the best of `repeat` runs
+    tokens = lexcaos(source)
+    result = {
+        "size": len(source),
+        "tokens": len(tokens),
+        "lex": best_of(repeat, lambda: lexcaos(source)),
+        "parse": best_of(repeat, lambda: parse(tokens)),
+    }
+
+    passes = None
+    total = None
+    for _ in range(repeat):
+        profile = Profile()
+        start = time.perf_counter()
+        extendedcaos_to_caos(source, profile=profile)
+        elapsed = time.perf_counter() - start
+        if total is None or elapsed < total:
+            total = elapsed
+            passes = profile.timings
+            counters = profile.totals()
+    result["passes"] = passes
+    result["total"] = total
+    result["counters"] = counters
+    return result
+
+
+def scaling_exponent(name, scale, repeat=3):
+    # How compile time grows with input size: 1 is linear, 2 is quadratic
+    small = benchmark_case(generate_case(name, scale), repeat)
+    large = benchmark_case(generate_case(name, scale * 4), repeat)
+    return math.log(large["total"] / small["total"]) / math.log(
+        large["size"] / small["size"]
+    )
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    # prints old vs new per case and returns the regressions past threshold
+    regressions = []
+    for name, result in new["results"].items():
+        if name not in old["results"]:
+            continue
+        old_result = old["results"][name]
+        timings = [("lex", old_result["lex"], result["lex"])]
+        timings.append(("parse", old_result["parse"], result["parse"]))
+        for p, seconds in result["passes"].items():
+            if p in old_result["passes"]:
+                timings.append((p, old_result["passes"][p], seconds))
+        timings.append(("total", old_result["total"], result["total"]))
+        for (what, before, after) in timings:
+            ratio = after / before if before else 1
+            flag = ""
+            if ratio > 1 + threshold and after - before > 0.001:
+                flag = "  REGRESSION"
+                regressions.append((name, what, ratio))
+            print(
+                "{:<12} {:<36} {:>9.2f} {:>9.2f} {:>6.2f}x{}".format(
+                    name, what, before * 1000, after * 1000, ratio, flag
+                )
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Extended CAOS compiler on synthetic inputs"
+    )
+    parser.add_argument("cases", nargs="*", help="cases to run, default all")
+    parser.add_argument("--scale", type=float, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument(
+        "--compare", help="JSON results from an earlier run to compare against"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="slowdown that counts as a regression when comparing, default 0.2",
+    )
+    parser.add_argument(
+        "--check-scaling",
+        action="store_true",
+        help="fail if any case grows worse than --max-exponent with input size",
+    )
+    parser.add_argument("--max-exponent", type=float, default=1.5)
+    args = parser.parse_args()
+
+    names = args.cases or list(CASES)
+    for name in names:
+        if name not in CASES:
+            parser.error(
+                "unknown case %r, expected one of %s" % (name, ", ".join(CASES))
+            )
+
+    results = {}
+    for name in names:
+        results[name] = benchmark_case(generate_case(name, args.scale), args.repeat)
+        sys.stderr.write(
+            "{:<12} {:>8} chars {:>9.2f} ms\n".format(
+                name, results[name]["size"], results[name]["total"] * 1000
+            )
+        )
+
+    failed = False
+    if args.check_scaling:
+        for name in names:
+            exponent = scaling_exponent(name, args.scale, args.repeat)
+            results[name]["scaling_exponent"] = exponent
+            too_slow = exponent > args.max_exponent
+            failed = failed or too_slow
+            sys.stderr.write(
+                "{:<12} scales as n^{:.2f}{}\n".format(
+                    name, exponent, "  TOO SLOW" if too_slow else ""
+                )
+            )
+
+    output = {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, output, args.threshold):
+            failed = True
+
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
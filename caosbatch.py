@@ -0,0 +1,136 @@
+import concurrent.futures
+import os
+
+import caoscache
+import caoscommandinfo
+from caoscommandinfo import DEFAULT_VARIANT
+from extendedcaos import extendedcaos_to_caos
+
+# Without an output directory, foo.cos compiles to foo.compiled.cos next to it
+OUTPUT_SUFFIX = ".compiled.cos"
+
+
+class CompileResult:
+    __slots__ = ["source", "destination", "error"]
+
+    def __init__(self, source, destination, error=None):
+        self.source = source
+        self.destination = destination
+        self.error = error
+
+    def __repr__(self):
+        return "CompileResult(%r, %r, %r)" % (self.source, self.destination, self.error)
+
+
+def find_sources(paths):
+    # Returns (path, relative path) for each file to compile. Directories are
+    # searched for .cos files, in sorted order so runs are reproducible, and
+    # the relative path is relative to the directory given
+    sources = []
+    for path in paths:
+        if not os.path.isdir(path):
+            sources.append((path, os.path.basename(path)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if not filename.lower().endswith(".cos"):
+                    continue
+                if filename.endswith(OUTPUT_SUFFIX):
+                    continue
+                source = os.path.join(dirpath, filename)
+                sources.append((source, os.path.relpath(source, path)))
+    return sources
+
+
+def destination_for(source, relative, output_dir=None):
+    if output_dir is None:
+        return os.path.splitext(source)[0] + OUTPUT_SUFFIX
+    return os.path.join(output_dir, relative)
+
+
+def write_atomically(path, text):
+    # Anything reading the output (like the game, injecting it) never sees a
+    # half-written file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(tmp_path, "w") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _init_worker(variant):
+    # each worker loads the command info it needs once, up front, rather than
+    # on whichever file happens to be first
+    caoscommandinfo.get_variant(variant)
+
+
+def include_dirs_for(source, include_dirs=()):
+    # libraries are looked for next to the source first
+    return (os.path.dirname(source) or ".",) + tuple(include_dirs)
+
+
+def compile_file(
+    source, destination, variant=DEFAULT_VARIANT, cache_dir=None, include_dirs=()
+):
+    try:
+        with open(source) as f:
+            text = f.read()
+        include_dirs = include_dirs_for(source, include_dirs)
+        if cache_dir is None:
+            result = extendedcaos_to_caos(text, variant, include_dirs=include_dirs)
+        else:
+            result = caoscache.compile_cached(text, variant, cache_dir, include_dirs)
+        write_atomically(destination, result)
+    except Exception as e:
+        return CompileResult(source, destination, "%s: %s" % (source, e))
+    return CompileResult(source, destination)
+
+
+def compile_files(
+    paths,
+    output_dir=None,
+    jobs=None,
+    variant=DEFAULT_VARIANT,
+    cache_dir=None,
+    include_dirs=(),
+):
+    # Compiles every file in paths, in parallel across jobs worker processes
+    # (default: one per CPU). Results come back in the same order as the
+    # sources regardless of which finish first, so diagnostics always come
+    # out in the same order too. With a cache_dir, unchanged files are
+    # served from the compile cache there. Libraries only get parsed once per
+    # worker, however many files include them
+    sources = find_sources(paths)
+    destinations = [destination_for(s, r, output_dir) for (s, r) in sources]
+    seen = {}
+    for (source, relative), destination in zip(sources, destinations):
+        if destination in seen:
+            raise Exception(
+                "%s and %s would both be compiled to %s"
+                % (seen[destination], source, destination)
+            )
+        seen[destination] = source
+
+    if jobs == 1 or len(sources) <= 1:
+        _init_worker(variant)
+        return [
+            compile_file(s, d, variant, cache_dir, include_dirs)
+            for ((s, r), d) in zip(sources, destinations)
+        ]
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(variant,)
+    ) as executor:
+        futures = [
+            executor.submit(compile_file, s, d, variant, cache_dir, include_dirs)
+            for ((s, r), d) in zip(sources, destinations)
+        ]
+        return [f.result() for f in futures]
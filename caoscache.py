@@ -0,0 +1,219 @@
+import collections
+import hashlib
+import os
+import threading
+
+import caoscommandinfo
+from caoscommandinfo import DEFAULT_VARIANT
+from extendedcaos import extendedcaos_to_caos, included_libraries
+
+# Compiled output, keyed by a hash of everything that goes into it: the source,
+# the variant, the compiler itself, the command info and any libraries the
+# source includes. A hit skips lexing and parsing entirely.
+#
+# There are two layers. An in-process memo of the last few sources handles
+# things like editors recompiling the same text over and over, and an
+# optional directory of files handles rebuilds of mostly unchanged trees.
+# The directory is kept under a size limit by throwing away whichever entries
+# were used least recently, going by their mtimes (which hits update).
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache")),
+    "extendedcaos",
+)
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_MEMO_SIZE = 128
+
+COMPILER_MODULES = (
+    "caoscommandinfo.py",
+    "caoslexer.py",
+    "caosparser.py",
+    "extendedcaos.py",
+)
+_compiler_version = None
+
+
+def compiler_version():
+    # a hash of the compiler's own source, so editing it invalidates the cache
+    global _compiler_version
+    if _compiler_version is None:
+        h = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in COMPILER_MODULES:
+            with open(os.path.join(directory, name), "rb") as f:
+                h.update(f.read())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+
+class CompileCache:
+    __slots__ = [
+        "directory",
+        "max_bytes",
+        "memo",
+        "memo_size",
+        "memo_hits",
+        "disk_hits",
+        "misses",
+        "_size",
+        "_lock",
+    ]
+
+    def __init__(
+        self, directory=None, max_bytes=DEFAULT_MAX_BYTES, memo_size=DEFAULT_MEMO_SIZE
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memo = collections.OrderedDict()
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # bytes in the directory, worked out the first time something's stored
+        self._size = None
+        # compiles happen outside of this, so threads can share a cache
+        self._lock = threading.Lock()
+
+    def key(self, source, variant=DEFAULT_VARIANT, libraries=()):
+        h = hashlib.sha256()
+        for part in (
+            compiler_version(),
+            caoscommandinfo.get_variant(variant).hash,
+            variant,
+            *(_.digest for _ in libraries),
+        ):
+            h.update(part.encode("ascii") + b"\0")
+        h.update(source.encode("utf-8"))
+        return h.hexdigest()
+
+    def compile(self, source, variant=DEFAULT_VARIANT, include_dirs=(".",)):
+        libraries = included_libraries(source, variant, include_dirs)
+        memo_key = (source, variant, tuple(_.digest for _ in libraries))
+        with self._lock:
+            output = self.memo.get(memo_key)
+            if output is not None:
+                self.memo.move_to_end(memo_key)
+                self.memo_hits += 1
+                return output
+
+        key = None
+        if self.directory is not None:
+            key = self.key(source, variant, libraries)
+            output = self._read(key)
+        if output is not None:
+            with self._lock:
+                self.disk_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            output = extendedcaos_to_caos(source, variant, include_dirs=include_dirs)
+            if key is not None:
+                self._write(key, output)
+
+        with self._lock:
+            self.memo[memo_key] = output
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return output
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".cos")
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8", newline="") as f:
+                output = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return output
+
+    def _write(self, key, output):
+        path = self._path(key)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        data = output.encode("utf-8")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # e.g. a read-only cache directory, just go without
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for (_, _, size) in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        # (mtime, path, size) for each entry in the directory
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(".cos"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, path, stat.st_size))
+        return entries
+
+    def evict(self):
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        # Removes the least recently used entries until the directory fits in
+        # max_bytes. Other processes might be using the same directory, so
+        # this goes by what's actually there, not what this process wrote
+        entries = sorted(self._entries())
+        size = sum(_[2] for _ in entries)
+        for (mtime, path, entry_size) in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        with self._lock:
+            self.memo.clear()
+            for (mtime, path, size) in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size = 0
+
+
+_caches = {}
+
+
+def get_cache(directory=None):
+    # one cache per directory per process, so the memo gets shared between
+    # everything compiling into the same place
+    cache = _caches.get(directory)
+    if cache is None:
+        cache = _caches[directory] = CompileCache(directory)
+    return cache
+
+
+def compile_cached(
+    source, variant=DEFAULT_VARIANT, directory=None, include_dirs=(".",)
+):
+    return get_cache(directory).compile(source, variant, include_dirs)
@@ -1,36 +1,175 @@
-import json
-
-with open("commandinfo.json", "rb") as f:
-    COMMAND_INFO = json.loads(f.read())
-
-COMMAND_INFO_C3 = list(COMMAND_INFO["variants"]["c3"].values())
-# TODO: fix openc2e so it has the correct command info for FACE
-# FACE is apparently a command that differs depending on the expected return type
-# - it can be either a string or an integer. Openc2e handles this by defining
-# two different commands
-i = 0
-while i < len(COMMAND_INFO_C3):
-    if COMMAND_INFO_C3[i]["name"] in ("FACE STRING", "FACE INT"):
-        del COMMAND_INFO_C3[i]
+import marshal
+import os
+import sys
+
+COMMAND_INFO_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "commandinfo.json"
+)
+
+# Parsing commandinfo.json on every run is most of the startup time for short
+# scripts, so the parts of it the parser actually uses are kept in a marshal
+# file per variant under __pycache__. A cache is used as long as the JSON's
+# mtime and size match; if they don't, the JSON is hashed, and the cache is only
+# rebuilt if the contents really changed. json and hashlib are only imported
+# when they're needed, since importing them takes longer than loading a cache.
+COMMAND_INFO_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "__pycache__"
+)
+_CACHE_VERSION = 1
+
+VARIANTS = ("c1", "c2", "c3", "cv", "sm")
+DEFAULT_VARIANT = "c3"
+
+
+def _compact_command_info(ci):
+    compact = {
+        "name": ci["name"],
+        "match": ci["match"],
+        "type": ci["type"],
+        "arguments": [{"name": a["name"], "type": a["type"]} for a in ci["arguments"]],
+    }
+    if "namespace" in ci:
+        compact["namespace"] = ci["namespace"]
+    return compact
+
+
+def _read_cache(path):
+    try:
+        with open(path, "rb") as f:
+            cache = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not (isinstance(cache, dict) and cache.get("version") == _CACHE_VERSION):
+        return None
+    return cache
+
+
+def _write_cache(path, cache):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            marshal.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # e.g. a read-only install, just go without the cache
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _load_cache(variant, json_path, cache_dir):
+    cache_path = os.path.join(
+        cache_dir,
+        "commandinfo.{}.{}.marshal".format(variant, sys.implementation.cache_tag),
+    )
+    stat = os.stat(json_path)
+    cache = _read_cache(cache_path)
+    if cache and (cache["mtime"], cache["size"]) == (stat.st_mtime_ns, stat.st_size):
+        return cache
+
+    import hashlib
+    import json
+
+    with open(json_path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if cache and cache["hash"] == digest:
+        commands = cache["commands"]
     else:
-        i += 1
-
-COMMAND_INFO_C3.append(
-    {
-        "namespace": "",
-        "arguments": [],
-        "type": "anything",
-        "match": "FACE",
-        "name": "FACE",
+        commands = [
+            _compact_command_info(ci)
+            for ci in json.loads(data)["variants"][variant].values()
+        ]
+    cache = {
+        "version": _CACHE_VERSION,
+        "mtime": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "hash": digest,
+        "commands": commands,
     }
-)
+    _write_cache(cache_path, cache)
+    return cache
+
+
+def load_command_info(
+    variant, json_path=COMMAND_INFO_PATH, cache_dir=COMMAND_INFO_CACHE_DIR
+):
+    return _load_cache(variant, json_path, cache_dir)["commands"]
+
+
+class CommandVariant:
+    # The command info for one engine variant, indexed for the parser
+    __slots__ = ["name", "commands", "commands_dict", "namespaces", "hash"]
+
+    def __init__(self, name, commands, hash=None):
+        self.name = name
+        # sha256 of the JSON it came from
+        self.hash = hash
+        # TODO: fix openc2e so it has the correct command info for FACE
+        # FACE is apparently a command that differs depending on the expected
+        # return type - it can be either a string or an integer. Openc2e handles
+        # this by defining two different commands
+        face_variants = ("FACE STRING", "FACE INT")
+        self.commands = [_ for _ in commands if _["name"] not in face_variants]
+        if len(self.commands) != len(commands):
+            self.commands.append(
+                {
+                    "namespace": "",
+                    "arguments": [],
+                    "type": "anything",
+                    "match": "FACE",
+                    "name": "FACE",
+                }
+            )
+
+        self.commands_dict = {}
+        for ci in self.commands:
+            is_toplevel = ci["type"] == "command"
+            key = (ci.get("namespace", "").lower(), ci["match"].lower(), is_toplevel)
+            self.commands_dict[key] = ci
+
+        self.namespaces = {
+            _.get("namespace")
+            for _ in self.commands_dict.values()
+            if _.get("namespace")
+        }
+
+
+_LOADED_VARIANTS = {}
+
+
+def get_variant(name=DEFAULT_VARIANT):
+    # Variants are loaded and indexed the first time they're asked for, so a
+    # process only pays for the ones it uses
+    variant = _LOADED_VARIANTS.get(name)
+    if variant is None:
+        if name not in VARIANTS:
+            raise Exception(
+                "Unknown variant %r, expected one of %s" % (name, ", ".join(VARIANTS))
+            )
+        cache = _load_cache(name, COMMAND_INFO_PATH, COMMAND_INFO_CACHE_DIR)
+        variant = _LOADED_VARIANTS[name] = CommandVariant(
+            name, cache["commands"], cache["hash"]
+        )
+    return variant
+
 
-COMMAND_INFO_C3_DICT = {}
-for ci in COMMAND_INFO_C3:
-    is_toplevel = ci["type"] == "command"
-    key = (ci.get("namespace", "").lower(), ci["match"].lower(), is_toplevel)
-    COMMAND_INFO_C3_DICT[key] = ci
+def __getattr__(name):
+    # the full command info is only loaded if something asks for it
+    if name == "COMMAND_INFO":
+        import json
 
-COMMAND_INFO_C3_NAMESPACES = {
-    _.get("namespace") for _ in COMMAND_INFO_C3_DICT.values() if _.get("namespace")
-}
+        with open(COMMAND_INFO_PATH, "rb") as f:
+            value = json.loads(f.read())
+        globals()[name] = value
+        return value
+    # older names for the C3 command info
+    if name == "COMMAND_INFO_C3":
+        return get_variant("c3").commands
+    if name == "COMMAND_INFO_C3_DICT":
+        return get_variant("c3").commands_dict
+    if name == "COMMAND_INFO_C3_NAMESPACES":
+        return get_variant("c3").namespaces
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,258 @@
+from caoscommandinfo import DEFAULT_VARIANT
+from caoslexer import *
+from extendedcaos import extendedcaos_to_caos, included_libraries
+
+# Recompiles only the parts of a file that changed since the last compile.
+#
+# A file is split into chunks: whatever comes before the first script, then one
+# chunk per scrp/rscr. Each chunk gets compiled on its own, along with the
+# definitions it uses from the rest of the file (constants, agent variables and
+# macros, and whatever those macros use) and the spill variables, which apply
+# to every script. Those go on their own lines in front of the chunk, where
+# they get whited out, and so don't show up in its output.
+#
+# That only gives the same output as compiling the whole file when no script
+# runs across chunks. The install script goes on after each endm, and scripts
+# spilling to GAME variables delete them at the end of the file, so files with
+# code after an endm or with GAME spill variables get compiled in one go.
+#
+# A chunk's output is kept under its text and the text of the definitions it
+# pulled in, so it gets recompiled when either of those change. Libraries
+# could define anything, so every chunk pulls in the includes before it, and
+# outputs are also kept under the libraries' digests.
+
+
+class Definition:
+    __slots__ = ["kind", "name", "text", "references"]
+
+    def __init__(self, kind, name, text, references=()):
+        self.kind = kind
+        self.name = name
+        self.text = text
+        # names used in a macro body, which it needs defined too
+        self.references = frozenset(references)
+
+    def __repr__(self):
+        return "Definition(%r, %r)" % (self.kind, self.name)
+
+
+class Chunk:
+    __slots__ = ["text", "definitions", "references", "after_endm"]
+
+    def __init__(self, text, definitions, references, after_endm=False):
+        self.text = text
+        self.definitions = definitions
+        self.references = references
+        # whether there's code after its endm, which belongs to another script
+        self.after_endm = after_endm
+
+    def __repr__(self):
+        return "Chunk(%r)" % self.text
+
+
+def reference_name(t):
+    # how a word refers to a definition: constants and agent variables by
+    # their exact name, macros case-insensitively
+    if t[1][0] in ":$":
+        return t[1]
+    return t[1].lower()
+
+
+def _definition_at(tokens, p):
+    # Returns the definition starting at p and the index after it, which is
+    # after the newline ending the definition
+    kind = tokens[p][1]
+    name_p = p + 1
+    while name_p < len(tokens) and tokens[name_p][0] == TOK_WHITESPACE:
+        name_p += 1
+    if name_p >= len(tokens) or tokens[name_p][0] != (
+        TOK_STRING if kind == "include" else TOK_WORD
+    ):
+        return (None, p + 1)
+    if kind in ("include", "spill_variable"):
+        name = tokens[name_p][1]
+    else:
+        name = reference_name(tokens[name_p])
+
+    end = p
+    if kind == "macro":
+        while end < len(tokens) and not (
+            tokens[end][0] == TOK_WORD and tokens[end][1] == "endmacro"
+        ):
+            end += 1
+    while end < len(tokens) and tokens[end][0] != TOK_NEWLINE:
+        end += 1
+
+    # comments on the first line get moved in front of the definition, where
+    # they'd stay in the output
+    first_line_end = p
+    while first_line_end < end and tokens[first_line_end][0] != TOK_NEWLINE:
+        first_line_end += 1
+    text = tokens_to_string(
+        [t for t in tokens[p:first_line_end] if t[0] != TOK_COMMENT]
+    )
+    text += tokens_to_string(tokens[first_line_end:end]) + "\n"
+
+    references = set()
+    if kind == "macro":
+        references = {
+            reference_name(t)
+            for t in tokens[name_p + 1 : end]
+            if t[0] == TOK_WORD and t[1] != "endmacro"
+        }
+    return (Definition(kind, name, text, references), end + 1)
+
+
+def split_chunks(tokens):
+    # Chunks start at the beginning of the line with the scrp or rscr on it.
+    # Every token belongs to exactly one chunk, so the chunks' text adds back
+    # up to the whole file
+    starts = [0]
+    line_start = 0
+    for i, t in enumerate(tokens):
+        if t[0] == TOK_NEWLINE:
+            line_start = i + 1
+        elif t[0] == TOK_WORD and t[1] in ("scrp", "rscr") and i > 0:
+            if all(_[0] == TOK_WHITESPACE for _ in tokens[line_start:i]):
+                starts.append(line_start)
+            else:
+                starts.append(i)
+    starts.append(len(tokens))
+
+    chunks = []
+    for (start, end) in zip(starts, starts[1:]):
+        chunk_tokens = tokens[start:end]
+        definitions = []
+        references = set()
+        ended = False
+        after_endm = False
+        p = 0
+        while p < len(chunk_tokens):
+            t = chunk_tokens[p]
+            if t[0] == TOK_WORD and t[1] in (
+                "constant",
+                "agent_variable",
+                "macro",
+                "include",
+                "spill_variable",
+            ):
+                (definition, p) = _definition_at(chunk_tokens, p)
+                if definition:
+                    definitions.append(definition)
+                continue
+            if t[0] == TOK_WORD:
+                references.add(reference_name(t))
+                after_endm = after_endm or ended
+                ended = ended or t[1].lower() == "endm"
+            p += 1
+        chunks.append(
+            Chunk(
+                tokens_to_string(chunk_tokens),
+                definitions,
+                frozenset(references),
+                after_endm,
+            )
+        )
+    return chunks
+
+
+class IncrementalCompiler:
+    # Call compile() with each new version of a file. Outputs are kept for
+    # the chunks in the last version only
+    __slots__ = ["variant", "include_dirs", "outputs", "compiled", "reused"]
+
+    def __init__(self, variant=DEFAULT_VARIANT, include_dirs=(".",)):
+        self.variant = variant
+        self.include_dirs = include_dirs
+        self.outputs = {}
+        # how many chunks the last compile had to compile, and how many it
+        # could reuse
+        self.compiled = 0
+        self.reused = 0
+
+    def compile(self, source):
+        tokens = lexcaos(source)[:-1]
+        chunks = split_chunks(tokens)
+
+        # Agent variables can be used anywhere in the file, constants and macros
+        # only after they're defined. Macros and agent variables that get
+        # defined twice apply to the whole file, whichever comes last, so
+        # there's no telling which chunks they affect. Neither is there for
+        # includes after the first script, which could define agent variables
+        agent_variables = {}
+        order = {}
+        seen = set()
+        whole_file = any(_.after_endm for _ in chunks)
+        for i, chunk in enumerate(chunks):
+            for d in chunk.definitions:
+                order[d] = len(order)
+                if d.kind == "agent_variable":
+                    agent_variables[d.name] = d
+                if (
+                    (d.kind == "include" and i > 0)
+                    or (
+                        d.kind in ("agent_variable", "macro")
+                        and (d.kind, d.name) in seen
+                    )
+                    or (d.kind == "spill_variable" and d.name.lower() == "game")
+                ):
+                    whole_file = True
+                seen.add((d.kind, d.name))
+        if whole_file:
+            self.outputs = {}
+            self.compiled = 1
+            self.reused = 0
+            return extendedcaos_to_caos(
+                source, self.variant, include_dirs=self.include_dirs
+            )
+        includes = [d for d in chunks[0].definitions if d.kind == "include"]
+        spill_variables = [
+            d
+            for chunk in chunks
+            for d in chunk.definitions
+            if d.kind == "spill_variable"
+        ]
+        digests = tuple(
+            _.digest
+            for _ in included_libraries(source, self.variant, self.include_dirs)
+        )
+
+        self.compiled = 0
+        self.reused = 0
+        outputs = {}
+        result = []
+        defined = {}
+        for chunk in chunks:
+            needed = set(
+                _ for _ in includes + spill_variables if _ not in chunk.definitions
+            )
+            pending = list(chunk.references)
+            while pending:
+                name = pending.pop()
+                d = defined.get(name) or agent_variables.get(name)
+                if d is None or d in needed or d in chunk.definitions:
+                    continue
+                needed.add(d)
+                pending += d.references
+
+            prefix = "".join(d.text for d in sorted(needed, key=order.get))
+            key = (prefix, chunk.text, digests)
+            output = self.outputs.get(key)
+            if output is None:
+                output = outputs.get(key)
+            if output is None:
+                output = extendedcaos_to_caos(
+                    prefix + chunk.text, self.variant, include_dirs=self.include_dirs
+                )
+                self.compiled += 1
+            else:
+                self.reused += 1
+            outputs[key] = output
+            result.append(output)
+
+            for d in chunk.definitions:
+                if d.kind in ("constant", "macro"):
+                    defined[d.name] = d
+
+        self.outputs = outputs
+        return "".join(result)
@@ -1,5 +1,8 @@
-import string
 import functools
+import itertools
+import re
+import string
+from array import array
 
 
 def peek(s, index):
@@ -8,11 +11,17 @@ def peek(s, index):
     return None
 
 
+# indexed by TokenType.code
+TOKEN_TYPES = []
+
+
 class TokenType:
-    __slots__ = ["name"]
+    __slots__ = ["name", "code"]
 
     def __init__(self, name):
         self.name = name
+        self.code = len(TOKEN_TYPES)
+        TOKEN_TYPES.append(self)
 
     def __repr__(self):
         return self.name
@@ -32,7 +41,172 @@ TOK_DOT = TokenType("TOK_DOT")
 TOK_EOI = TokenType("TOK_EOI")
 
 
+class TokenBuffer:
+    # A token sequence stored as an array of TokenType codes and a parallel list
+    # of token text, rather than a list of tuples. Supports the parts of the list
+    # interface the compiler passes use; (TokenType, text) tuples are only built
+    # when a single token is read.
+    #
+    # The storage is a gap buffer: types[gap_start:gap_end] and
+    # values[gap_start:gap_end] are unused slots. Splicing moves the gap to the
+    # splice position first, so a pass that edits the buffer front to back only
+    # ever shifts the tokens between one edit and the next. Gap slots hold empty
+    # text, so "".join(values) is always the buffer's text.
+    __slots__ = ["types", "values", "gap_start", "gap_end"]
+
+    def __init__(self, tokens=()):
+        self.types = array("B")
+        self.values = []
+        self.gap_start = self.gap_end = 0
+        self.extend(tokens)
+
+    def __len__(self):
+        return len(self.values) - (self.gap_end - self.gap_start)
+
+    def __iter__(self):
+        return itertools.chain(
+            zip(
+                map(TOKEN_TYPES.__getitem__, self.types[: self.gap_start]),
+                self.values[: self.gap_start],
+            ),
+            zip(
+                map(TOKEN_TYPES.__getitem__, self.types[self.gap_end :]),
+                self.values[self.gap_end :],
+            ),
+        )
+
+    def _storage_index(self, i):
+        if i < 0:
+            i += len(self)
+            if i < 0:
+                raise IndexError("token index out of range")
+        if i >= self.gap_start:
+            i += self.gap_end - self.gap_start
+        return i
+
+    def _storage_slices(self, start, stop):
+        # storage slices covering [start, stop), skipping over the gap
+        gap = self.gap_end - self.gap_start
+        if stop <= self.gap_start:
+            return [slice(start, stop)]
+        if start >= self.gap_start:
+            return [slice(start + gap, stop + gap)]
+        return [slice(start, self.gap_start), slice(self.gap_end, stop + gap)]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1
+            # copies the type codes and text references, but makes no tuples
+            new = TokenBuffer()
+            for s in self._storage_slices(start, max(start, stop)):
+                new.types.extend(self.types[s])
+                new.values.extend(self.values[s])
+            new.gap_start = new.gap_end = len(new.values)
+            return new
+        i = self._storage_index(i)
+        return (TOKEN_TYPES[self.types[i]], self.values[i])
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            assert step == 1
+            self.splice(start, value, max(0, stop - start))
+        else:
+            i = self._storage_index(i)
+            self.types[i] = value[0].code
+            self.values[i] = value[1]
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            self[i] = ()
+        else:
+            self._storage_index(i)  # raises IndexError if out of range
+            self.splice(i % len(self), (), 1)
+
+    def __add__(self, other):
+        new = self[:]
+        new.extend(other)
+        return new
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return "TokenBuffer(%r)" % list(self)
+
+    def append(self, token):
+        self.splice(len(self), (token,))
+
+    def extend(self, tokens):
+        self.splice(len(self), tokens)
+
+    def insert(self, i, token):
+        if i < 0:
+            i = max(0, i + len(self))
+        self.splice(min(i, len(self)), (token,))
+
+    def _move_gap(self, i):
+        # Tokens that move into the gap's old position are copied across it; the
+        # slots they leave behind become part of the gap and get emptied.
+        gap = self.gap_end - self.gap_start
+        if i < self.gap_start:
+            n = self.gap_start - i
+            self.types[self.gap_end - n : self.gap_end] = self.types[i : self.gap_start]
+            self.values[self.gap_end - n : self.gap_end] = self.values[
+                i : self.gap_start
+            ]
+            self.values[i : i + min(n, gap)] = [""] * min(n, gap)
+            self.gap_start -= n
+            self.gap_end -= n
+        elif i > self.gap_start:
+            n = i - self.gap_start
+            self.types[self.gap_start : i] = self.types[self.gap_end : self.gap_end + n]
+            self.values[self.gap_start : i] = self.values[
+                self.gap_end : self.gap_end + n
+            ]
+            self.values[self.gap_end + n - min(n, gap) : self.gap_end + n] = [
+                ""
+            ] * min(n, gap)
+            self.gap_start += n
+            self.gap_end += n
+
+    def splice(self, i, tokens, delete=0):
+        # Replace `delete` tokens at position i with `tokens`, in one operation
+        if isinstance(tokens, TokenBuffer):
+            types = tokens.types[: tokens.gap_start] + tokens.types[tokens.gap_end :]
+            values = tokens.values[: tokens.gap_start] + tokens.values[tokens.gap_end :]
+        else:
+            tokens = list(tokens)
+            types = array("B", [t[0].code for t in tokens])
+            values = [t[1] for t in tokens]
+
+        self._move_gap(i)
+        self.values[self.gap_end : self.gap_end + delete] = [""] * delete
+        self.gap_end += delete
+
+        if self.gap_end - self.gap_start < len(values):
+            # grow the gap in proportion to the buffer, so that repeated
+            # insertions only reallocate a logarithmic number of times
+            grow = len(values) + len(self.values) // 4 + 16
+            self.types[self.gap_end : self.gap_end] = array("B", bytes(grow))
+            self.values[self.gap_end : self.gap_end] = [""] * grow
+            self.gap_end += grow
+
+        self.types[self.gap_start : self.gap_start + len(values)] = types
+        self.values[self.gap_start : self.gap_start + len(values)] = values
+        self.gap_start += len(values)
+
+    def whiteout(self, start, stop):
+        # replace tokens with empty whitespace, keeping every position the same
+        for s in self._storage_slices(start, stop):
+            self.types[s] = array("B", [TOK_WHITESPACE.code]) * (s.stop - s.start)
+            self.values[s] = [""] * (s.stop - s.start)
+
+
 def tokens_to_string(tokens):
+    if isinstance(tokens, TokenBuffer):
+        return "".join(tokens.values)
     out = ""
     for t in tokens:
         out += str(t[1])
@@ -50,10 +224,149 @@ def listify(fn):
     return listify_return(fn)
 
 
-@listify
+# Alternatives are ordered roughly by how common they are in real scripts.
+# Every alternative consumes at least one character, and _FIRST_CHARACTER_TYPES
+# below classifies a lexeme by its first character.
+_TOKEN_PATTERN = r"""
+    [ \t]++
+    | [A-Za-z_][A-Za-z0-9:_+]*+
+    | \n
+    | \$[A-Za-z0-9_][A-Za-z0-9*:_]*+
+    | :[A-Za-z0-9_]++
+    | -?[0-9]++(?:\.[0-9]*+)?
+    | \*[^\r\n]*+
+    | "(?:[^"\\]++|\\[\s\S])*"
+    | \.(?:[0-9]++|(?=[^0-9]))
+    | <> | >= | <= | [=<>]
+    | \r\n
+    | %[0-9]++
+    | \[[^\]]*+\]
+    | '(?:\\[\s\S]|[^\\])'
+"""
+try:
+    _TOKEN_REGEX = re.compile(_TOKEN_PATTERN, re.VERBOSE)
+except re.error:
+    # possessive quantifiers need Python 3.11, but they're only an optimization
+    _TOKEN_REGEX = re.compile(
+        _TOKEN_PATTERN.replace("++", "+").replace("*+", "*"), re.VERBOSE
+    )
+
+# The start of a token that _TOKEN_REGEX can't match until there's more input,
+# like a string missing its closing quote or a '-' missing its digits
+_PARTIAL_TOKEN_REGEX = re.compile(
+    r"""
+    "(?:[^"\\]|\\[\s\S])*\\?
+    | \[[^\]]*
+    | '(?:\\[\s\S]?|[^\\])?
+    | [\r\-%.$:]
+    """,
+    re.VERBOSE,
+)
+
+_FIRST_CHARACTER_TYPES = {
+    "\n": TOK_NEWLINE,
+    "\r": TOK_NEWLINE,
+    " ": TOK_WHITESPACE,
+    "\t": TOK_WHITESPACE,
+    "*": TOK_COMMENT,
+    '"': TOK_STRING,
+    "[": TOK_BYTESTRING,
+    "'": TOK_CHARACTER,
+    "%": TOK_BINARY_LITERAL,
+}
+for _ in string.ascii_letters + "_$:<>=":
+    _FIRST_CHARACTER_TYPES[_] = TOK_WORD
+# numbers and dots need to look at more than the first character
+for _ in string.digits + "-.":
+    _FIRST_CHARACTER_TYPES[_] = None
+
+
+class _TokenCache(dict):
+    # Maps lexeme text to its token tuple. Scripts repeat the same words and
+    # whitespace constantly, so most lookups never leave C.
+    def __missing__(self, text):
+        toktype = _FIRST_CHARACTER_TYPES[text[0]]
+        if toktype is None:
+            if text == ".":
+                toktype = TOK_DOT
+            elif "." in text:
+                toktype = TOK_FLOAT
+            else:
+                toktype = TOK_INTEGER
+        token = self[text] = (toktype, text)
+        return token
+
+
 def lexcaos(s):
-    p = 0
+    lexemes = _TOKEN_REGEX.findall(s)
+    # findall skips over characters it can't match, so make sure it didn't
+    if len("".join(lexemes)) != len(s):
+        p = 0
+        for l in lexemes:
+            if not s.startswith(l, p):
+                break
+            p += len(l)
+        raise_lex_error(s, p)
+    tokens = list(map(_TokenCache().__getitem__, lexemes))
+    tokens.append((TOK_EOI, ""))
+    return tokens
+
+
+def lexcaos_stream(source, chunk_size=64 * 1024):
+    # Lazily lexes a file-like object (anything with .read) or an iterable of
+    # string chunks. Only the current chunk and any partial token at its end are
+    # kept in memory, and errors are raised as soon as they're read.
+    if hasattr(source, "read"):
+        chunks = iter(functools.partial(source.read, chunk_size), "")
+    else:
+        chunks = iter(source)
+    cache = _TokenCache()
+    buf = ""
+    eof = False
+
+    while True:
+        p = 0
+        match = _TOKEN_REGEX.scanner(buf).match
+        while True:
+            m = match()
+            # a lexeme that runs to the end of the buffer might continue in the
+            # next chunk, so re-lex it once we have more input
+            if (
+                m is None
+                and p < len(buf)
+                and not eof
+                and not _PARTIAL_TOKEN_REGEX.fullmatch(buf, p)
+            ):
+                raise_lex_error(buf, p)
+            if m is None or (m.end() == len(buf) and not eof):
+                break
+            yield cache[m.group()]
+            p = m.end()
+
+        if eof:
+            if p != len(buf):
+                raise_lex_error(buf, p)
+            yield (TOK_EOI, "")
+            return
+
+        buf = buf[p:]
+        for chunk in chunks:
+            if chunk:
+                buf += chunk
+                break
+        else:
+            eof = True
+
+
+def raise_lex_error(s, p):
+    # Run the character-by-character lexer from the failing position, so that
+    # errors are reported exactly as they always have been
+    for _ in lexcaos_charwise(s, p):
+        pass
+    raise Exception("Unexpected character '%s' (%02x)" % (s[p], ord(s[p])))
+
 
+def lexcaos_charwise(s, p=0):
     while True:
         basep = p
         if p >= len(s):
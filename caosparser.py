@@ -1,9 +1,192 @@
-import re
+import sys
 
 from caoscommandinfo import *
 from caoslexer import *
 
 
+class Node:
+    # Base class for parse tree nodes. Each node type is its own class with a
+    # fixed set of fields, so passes can dispatch with isinstance() and nodes
+    # stay small. Fields that don't apply to a node (e.g. start_token on a
+    # command that isn't at the toplevel) are None. Use node_to_dict() to get
+    # the old dict form of a node.
+    __slots__ = []
+    fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = cls.fields + tuple(cls.__dict__.get("__slots__", ()))
+
+    def __init__(self, *args, **kwargs):
+        if len(args) > len(self.fields):
+            raise Exception("Too many fields for %s" % type(self).__name__)
+        for name, value in zip(self.fields, args):
+            setattr(self, name, value)
+        for name in self.fields[len(args) :]:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise Exception(
+                "Unknown fields for %s: %s" % (type(self).__name__, ", ".join(kwargs))
+            )
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, _) == getattr(other, _) for _ in self.fields
+        )
+
+    def __repr__(self):
+        return "%s(%s)" % (
+            type(self).__name__,
+            ", ".join(
+                "%s=%r" % (_, getattr(self, _))
+                for _ in self.fields
+                if getattr(self, _) is not None
+            ),
+        )
+
+
+class Condition(Node):
+    __slots__ = ["args"]
+
+
+class ConditionKeyword(Node):
+    __slots__ = ["value"]
+
+
+class Label(Node):
+    __slots__ = ["value"]
+
+
+class Constant(Node):
+    __slots__ = ["name"]
+
+
+class Variable(Node):
+    __slots__ = ["value"]
+
+
+class Literal(Node):
+    __slots__ = ["value"]
+
+
+class LiteralInteger(Literal):
+    __slots__ = []
+
+
+class LiteralFloat(Literal):
+    __slots__ = []
+
+
+class LiteralString(Literal):
+    __slots__ = []
+
+
+class LiteralBytestring(Literal):
+    __slots__ = []
+
+
+class DotVariable(Node):
+    __slots__ = ["name", "targ", "start_token_in_parent", "end_token_in_parent"]
+
+
+class CommandBase(Node):
+    # toplevel commands have start_token and end_token, commands used as
+    # arguments have start_token_in_parent and end_token_in_parent, relative to
+    # the toplevel command they're in
+    __slots__ = [
+        "name",
+        "args",
+        "commandtype",
+        "commandret",
+        "start_token",
+        "end_token",
+        "start_token_in_parent",
+        "end_token_in_parent",
+    ]
+
+
+class Command(CommandBase):
+    __slots__ = []
+
+
+class DotCommand(CommandBase):
+    __slots__ = ["targ"]
+
+
+class ConstantDefinition(Node):
+    __slots__ = ["name", "values", "start_token", "end_token"]
+
+
+class AgentVariableDefinition(Node):
+    __slots__ = ["name", "value", "start_token", "end_token"]
+
+
+class SpillVariableDefinition(Node):
+    # value is the variable, e.g. "mv98" or 'game "spill"'
+    __slots__ = ["value", "start_token", "end_token"]
+
+
+class MacroDefinitionStart(Node):
+    __slots__ = ["name", "argnames", "start_token", "end_token", "body_start_token"]
+
+
+class MacroDefinitionEnd(Node):
+    __slots__ = ["start_token", "end_token"]
+
+
+class Include(Node):
+    # library is whatever the parser's include function returned for path
+    __slots__ = ["path", "library", "start_token", "end_token"]
+
+
+_LITERAL_NODE_TYPES = {
+    TOK_INTEGER: LiteralInteger,
+    TOK_CHARACTER: LiteralInteger,
+    TOK_BINARY_LITERAL: LiteralInteger,
+    TOK_FLOAT: LiteralFloat,
+    TOK_STRING: LiteralString,
+    TOK_BYTESTRING: LiteralBytestring,
+}
+
+
+def literal_node(token):
+    return _LITERAL_NODE_TYPES[token[0]](token[1])
+
+
+def node_to_dict(node):
+    # the dict form nodes used to have, with "type" set to the class name
+    if isinstance(node, list):
+        return [node_to_dict(_) for _ in node]
+    if not isinstance(node, Node):
+        return node
+    d = {"type": type(node).__name__}
+    for name in node.fields:
+        value = getattr(node, name)
+        if value is not None:
+            d[name] = node_to_dict(value)
+    return d
+
+
+class _CommandNameCache(dict):
+    # Maps a word as written to its lowercase form and the name it's looked up
+    # by in the command info, where vaXX, ovXX and mvXX each share one entry,
+    # e.g. "VA12" -> ("va12", "vaxx"), and so do C1's varX and obvX. Scripts use
+    # the same handful of command names over and over, so this is almost always
+    # a single dict hit.
+    def __missing__(self, word):
+        name = sys.intern(word.lower())
+        normalized = name
+        if len(name) == 4 and name[:2] in ("va", "ov", "mv") and name[2:].isdecimal():
+            normalized = sys.intern(name[:2] + "xx")
+        elif len(name) == 4 and name[:3] in ("var", "obv") and name[3].isdecimal():
+            normalized = sys.intern(name[:3] + "x")
+        result = self[word] = (name, normalized)
+        return result
+
+
+_COMMAND_NAMES = _CommandNameCache()
+
+
 class ParserState:
     __slots__ = [
         "p",
@@ -13,16 +196,24 @@ class ParserState:
         "constant_definitions",
         "macro_definitions",
         "toplevel_startp",
+        "include",
     ]
 
-    def __init__(self, tokens):
+    def __init__(self, tokens, variant=DEFAULT_VARIANT, include=None):
+        if isinstance(tokens, TokenBuffer):
+            # the parser reads every token several times, so give it tuples
+            tokens = list(tokens)
         self.tokens = tokens
-        self.commands = COMMAND_INFO_C3_DICT
-        self.command_namespaces = COMMAND_INFO_C3_NAMESPACES
+        variant = get_variant(variant)
+        self.commands = variant.commands_dict
+        self.command_namespaces = variant.namespaces
         self.constant_definitions = {}
         self.macro_definitions = {}
         self.p = 0
         self.toplevel_startp = 0
+        # include(path) returns a library, with the constants and macros it
+        # defines in library.constants and library.macros
+        self.include = include
 
     def peekmatch(self, newp, toktypes):
         if not isinstance(toktypes, (tuple, list, set)):
@@ -32,14 +223,11 @@ class ParserState:
 
 
 def caoscondition(args):
-    return {
-        "type": "Condition",
-        "args": args,
-    }
+    return Condition(args)
 
 
 def caosconditionkeyword(value):
-    return {"type": "ConditionKeyword", "value": value}
+    return ConditionKeyword(value)
 
 
 def maybe_eat_whitespace(state):
@@ -115,23 +303,15 @@ def parse_condition(state):
                 right,
                 caosconditionkeyword(combiner),
             ]
-            + remainder["args"],
+            + remainder.args,
         )
     else:
         return caoscondition([left, caosconditionkeyword(comparison), right])
 
 
 def get_command_info(state, namespace, command_name, is_toplevel):
-    namespace = namespace.lower()
-    command_name = command_name.lower()
-
-    commandnormalized = command_name
-    if re.match(r"^va\d\d$", command_name):
-        commandnormalized = "vaxx"
-    if re.match(r"^ov\d\d$", command_name):
-        commandnormalized = "ovxx"
-    if re.match(r"^mv\d\d$", command_name):
-        commandnormalized = "mvxx"
+    namespace = _COMMAND_NAMES[namespace][0] if namespace else ""
+    (command_name, commandnormalized) = _COMMAND_NAMES[command_name]
 
     ci = state.commands.get((namespace, commandnormalized, is_toplevel))
     if ci:
@@ -141,7 +321,7 @@ def get_command_info(state, namespace, command_name, is_toplevel):
         return {
             "arguments": [
                 {"name": a, "type": "anything"}
-                for a in state.macro_definitions[commandnormalized]["argnames"]
+                for a in state.macro_definitions[commandnormalized].argnames
             ],
             "type": "command",
         }
@@ -170,30 +350,33 @@ def parse_command(state, is_toplevel):
         command = state.tokens[state.p][1]
         if command[0] == "$":
             state.p += 1
-            return {
-                "type": "DotVariable",
-                "name": command,
-                "targ": targ,
-                "start_token_in_parent": startp - state.toplevel_startp,
-                "end_token_in_parent": state.p - 1 - state.toplevel_startp,
-            }
-        command = command.lower()
-    elif state.tokens[state.p][1].lower() in state.command_namespaces:
-        namespace = state.tokens[state.p][1].lower()
-        state.p += 1
-        eat_whitespace(state)
-        command = state.tokens[state.p][1].lower()
+            return DotVariable(
+                name=command,
+                targ=targ,
+                start_token_in_parent=startp - state.toplevel_startp,
+                end_token_in_parent=state.p - 1 - state.toplevel_startp,
+            )
+        (command, commandnormalized) = _COMMAND_NAMES[command]
     else:
+        (command, commandnormalized) = _COMMAND_NAMES[state.tokens[state.p][1]]
         namespace = ""
-        command = state.tokens[state.p][1].lower()
-
-    commandnormalized = command
-    if re.match(r"(?i)^va\d\d$", command):
-        commandnormalized = "vaxx"
-    if re.match(r"(?i)^ov\d\d$", command):
-        commandnormalized = "ovxx"
-    if re.match(r"(?i)^mv\d\d$", command):
-        commandnormalized = "mvxx"
+        if command in state.command_namespaces:
+            # in C1 and C2, setv is both a namespace, for setv clas, and a
+            # command, so only go with the namespace if the next word's in it
+            p = state.p + 1
+            while state.tokens[p][0] == TOK_WHITESPACE:
+                p += 1
+            subcommand = None
+            if state.tokens[p][0] == TOK_WORD:
+                subcommand = _COMMAND_NAMES[state.tokens[p][1]]
+            if (
+                subcommand is not None
+                and (command, subcommand[1], is_toplevel) in state.commands
+            ) or ("", commandnormalized, is_toplevel) not in state.commands:
+                namespace = command
+                state.p += 1
+                eat_whitespace(state)
+                (command, commandnormalized) = _COMMAND_NAMES[state.tokens[state.p][1]]
 
     commandinfo = get_command_info(state, namespace, commandnormalized, is_toplevel)
     state.p += 1
@@ -208,45 +391,39 @@ def parse_command(state, is_toplevel):
         elif _["type"] == "label":
             if state.tokens[state.p][0] != TOK_WORD:
                 raise Exception("Expected label, got %s '%s'\n" % (t[0], t[1]))
-            args.append({"type": "Label", "value": state.tokens[state.p][1]})
+            args.append(Label(state.tokens[state.p][1]))
             state.p += 1
         else:
             args.append(parse_value(state))
-        if args[-1]["type"] == "Constant":
-            num_args_parsed += len(state.constant_definitions[args[-1]["name"]])
+        if isinstance(args[-1], Constant):
+            num_args_parsed += len(state.constant_definitions[args[-1].name])
         else:
             num_args_parsed += 1
 
     end_token = state.p - 1
 
-    node = {
-        "commandtype": ("statement" if is_toplevel else "expression"),
-        "commandret": commandinfo["type"],
-        "args": args,
-    }
-    if dotcommand:
-        node.update(
-            {"type": "DotCommand", "targ": targ, "name": command,}
-        )
-    else:
-        node.update(
-            {
-                "type": "Command",
-                "name": (namespace + " " if namespace else "") + command,
-            }
-        )
+    # built with positional fields, this runs for every command in the script
     if is_toplevel:
-        node.update(
-            {"start_token": startp, "end_token": end_token,}
-        )
+        positions = (startp, end_token, None, None)
     else:
-        node.update(
-            {
-                "start_token_in_parent": startp - state.toplevel_startp,
-                "end_token_in_parent": end_token - state.toplevel_startp,
-            }
+        positions = (
+            None,
+            None,
+            startp - state.toplevel_startp,
+            end_token - state.toplevel_startp,
         )
-    return node
+    commandtype = "statement" if is_toplevel else "expression"
+    if dotcommand:
+        return DotCommand(
+            command, args, commandtype, commandinfo["type"], *positions, targ
+        )
+    return Command(
+        (namespace + " " if namespace else "") + command,
+        args,
+        commandtype,
+        commandinfo["type"],
+        *positions,
+    )
 
 
 def parse_constant_definition(state):
@@ -295,13 +472,9 @@ def parse_constant_definition(state):
     endp = state.p - 1
 
     state.constant_definitions[name] = values
-    return {
-        "type": "ConstantDefinition",
-        "name": name,
-        "values": values,
-        "start_token": startp,
-        "end_token": endp,
-    }
+    return ConstantDefinition(
+        name=name, values=values, start_token=startp, end_token=endp,
+    )
 
 
 def parse_agent_variable(state):
@@ -326,7 +499,7 @@ def parse_agent_variable(state):
     eat_whitespace(state)
     if not (
         state.tokens[state.p][0] == TOK_WORD
-        and re.match(r"(?i)^ov\d\d$", state.tokens[state.p][1])
+        and _COMMAND_NAMES[state.tokens[state.p][1]][1] == "ovxx"
     ):
         raise Exception(
             "Expected ovXX after agent variable name, got %r" % (state.tokens[state.p],)
@@ -335,13 +508,41 @@ def parse_agent_variable(state):
     endp = state.p
     state.p += 1
 
-    return {
-        "type": "AgentVariableDefinition",
-        "name": variable_name,
-        "value": definition,
-        "start_token": startp,
-        "end_token": endp,
-    }
+    return AgentVariableDefinition(
+        name=variable_name, value=definition, start_token=startp, end_token=endp,
+    )
+
+
+def parse_spill_variable(state):
+    assert (
+        state.tokens[state.p][0] == TOK_WORD
+        and state.tokens[state.p][1] == "spill_variable"
+    )
+    startp = state.p
+    state.p += 1
+
+    eat_whitespace(state)
+    word = state.tokens[state.p][1] if state.tokens[state.p][0] == TOK_WORD else None
+    if word is not None and _COMMAND_NAMES[word][1] == "mvxx":
+        value = word.lower()
+    elif word is not None and word.lower() == "game":
+        state.p += 1
+        eat_whitespace(state)
+        if state.tokens[state.p][0] != TOK_STRING:
+            raise Exception(
+                "Expected a string after 'spill_variable game', got %r"
+                % (state.tokens[state.p],)
+            )
+        value = "game " + state.tokens[state.p][1]
+    else:
+        raise Exception(
+            "Expected mvXX or game after 'spill_variable', got %r"
+            % (state.tokens[state.p],)
+        )
+    endp = state.p
+    state.p += 1
+
+    return SpillVariableDefinition(value=value, start_token=startp, end_token=endp)
 
 
 def parse_macro_definition(state):
@@ -377,18 +578,43 @@ def parse_macro_definition(state):
     state.p += 1
     bodystartp = state.p
 
-    node = {
-        "type": "MacroDefinitionStart",
-        "name": macro_name,
-        "argnames": argnames,
-        "start_token": startp,
-        "end_token": endp,
-        "body_start_token": bodystartp,
-    }
+    node = MacroDefinitionStart(
+        name=macro_name,
+        argnames=argnames,
+        start_token=startp,
+        end_token=endp,
+        body_start_token=bodystartp,
+    )
     state.macro_definitions[macro_name] = node
     return node
 
 
+def parse_include(state):
+    assert (
+        state.tokens[state.p][0] == TOK_WORD and state.tokens[state.p][1] == "include"
+    )
+    startp = state.p
+    state.p += 1
+
+    eat_whitespace(state)
+    if state.tokens[state.p][0] != TOK_STRING:
+        raise Exception(
+            "Expected library path after 'include', got %r" % (state.tokens[state.p],)
+        )
+    path = state.tokens[state.p][1][1:-1]
+    endp = state.p
+    state.p += 1
+
+    if state.include is None:
+        raise Exception("Can't include %r here" % path)
+    library = state.include(path)
+    # the library's definitions can be used from here on, like they'd been
+    # written here
+    state.constant_definitions.update(library.constants)
+    state.macro_definitions.update(library.macros)
+    return Include(path=path, library=library, start_token=startp, end_token=endp)
+
+
 def parse_toplevel(state):
     state.toplevel_startp = state.p
     if state.tokens[state.p][0] == TOK_WORD and state.tokens[state.p][1] == "macro":
@@ -396,11 +622,7 @@ def parse_toplevel(state):
     elif (
         state.tokens[state.p][0] == TOK_WORD and state.tokens[state.p][1] == "endmacro"
     ):
-        node = {
-            "type": "MacroDefinitionEnd",
-            "start_token": state.p,
-            "end_token": state.p,
-        }
+        node = MacroDefinitionEnd(start_token=state.p, end_token=state.p)
         state.p += 1
         return node
     if state.tokens[state.p][0] == TOK_WORD and state.tokens[state.p][1] == "constant":
@@ -410,6 +632,13 @@ def parse_toplevel(state):
         and state.tokens[state.p][1] == "agent_variable"
     ):
         return parse_agent_variable(state)
+    if (
+        state.tokens[state.p][0] == TOK_WORD
+        and state.tokens[state.p][1] == "spill_variable"
+    ):
+        return parse_spill_variable(state)
+    if state.tokens[state.p][0] == TOK_WORD and state.tokens[state.p][1] == "include":
+        return parse_include(state)
     return parse_command(state, True)
 
 
@@ -421,10 +650,7 @@ def parse_value(state):
     if state.tokens[state.p][0] == TOK_WORD:
         if state.tokens[state.p][1][0] == ":":
             state.p += 1
-            return {
-                "type": "Constant",
-                "name": state.tokens[state.p - 1][1],
-            }
+            return Constant(state.tokens[state.p - 1][1])
         elif (
             state.tokens[state.p][1][0] == "$"
             and state.tokens[state.p + 1][0] != TOK_DOT
@@ -434,34 +660,33 @@ def parse_value(state):
             state.peekmatch(
                 state.p, (TOK_WHITESPACE, TOK_COMMENT, TOK_EOI, TOK_NEWLINE)
             )
-            return {"type": "Variable", "value": value}
+            return Variable(value)
         return parse_command(state, False)
-    elif state.tokens[state.p][0] in (TOK_INTEGER, TOK_CHARACTER, TOK_BINARY_LITERAL):
-        value = state.tokens[state.p][1]
-        state.p += 1
-        state.peekmatch(state.p, (TOK_WHITESPACE, TOK_COMMENT, TOK_EOI, TOK_NEWLINE))
-        return {"type": "LiteralInteger", "value": value}
-    elif state.tokens[state.p][0] == TOK_FLOAT:
-        value = state.tokens[state.p][1]
-        state.p += 1
-        state.peekmatch(state.p, (TOK_WHITESPACE, TOK_COMMENT, TOK_EOI, TOK_NEWLINE))
-        return {"type": "LiteralFloat", "value": value}
-    elif state.tokens[state.p][0] == TOK_STRING:
-        value = state.tokens[state.p][1]
-        state.p += 1
-        state.peekmatch(state.p, (TOK_WHITESPACE, TOK_COMMENT, TOK_EOI, TOK_NEWLINE))
-        return {"type": "LiteralString", "value": value}
-    elif state.tokens[state.p][0] == TOK_BYTESTRING:
-        value = state.tokens[state.p][1]
+    elif state.tokens[state.p][0] in _LITERAL_NODE_TYPES:
+        node = literal_node(state.tokens[state.p])
         state.p += 1
         state.peekmatch(state.p, (TOK_WHITESPACE, TOK_COMMENT, TOK_EOI, TOK_NEWLINE))
-        return {"type": "LiteralBytestring", "value": value}
+        return node
     else:
         raise Exception("Unimplemented token type %s" % state.tokens[state.p][0])
 
 
-def parse(tokens):
-    state = ParserState(tokens)
+def parse_expression(tokens, variant=DEFAULT_VARIANT):
+    # Parses a single value, e.g. to put in place of an argument of an existing
+    # command. Positions in the result are relative to the start of tokens.
+    state = ParserState(tokens, variant)
+    node = parse_value(state)
+    maybe_eat_whitespace_or_newline_or_comment(state)
+    if state.tokens[state.p][0] != TOK_EOI:
+        raise Exception(
+            "Expected a single value, got %s %s"
+            % (state.tokens[state.p][0], state.tokens[state.p][1])
+        )
+    return node
+
+
+def parse(tokens, variant=DEFAULT_VARIANT, include=None):
+    state = ParserState(tokens, variant, include)
     fst = []
     while True:
         maybe_eat_whitespace_or_newline_or_comment(state)
@@ -0,0 +1,114 @@
+import contextlib
+import contextvars
+import time
+
+TOKENS_INSERTED = "tokens inserted"
+NODES_REPARSED = "nodes reparsed"
+SNIPPETS_GENERATED = "snippets generated"
+VARIABLES_ALLOCATED = "variables allocated"
+VARIABLES_SPILLED = "variables spilled"
+LIBRARIES_COMPILED = "libraries compiled"
+COUNTERS = (
+    TOKENS_INSERTED,
+    NODES_REPARSED,
+    SNIPPETS_GENERATED,
+    VARIABLES_ALLOCATED,
+    VARIABLES_SPILLED,
+    LIBRARIES_COMPILED,
+)
+
+
+class Profile:
+    # Where the time goes in a compile. Timings and counters are kept per pass
+    # (parse and render count as passes here). on_pass_start(name) and
+    # on_pass_end(name, seconds) get called around each one
+    __slots__ = ["timings", "counters", "on_pass_start", "on_pass_end", "current"]
+
+    def __init__(self, on_pass_start=None, on_pass_end=None):
+        self.timings = {}
+        self.counters = {}
+        self.on_pass_start = on_pass_start
+        self.on_pass_end = on_pass_end
+        self.current = None
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        previous = self.current
+        self.current = name
+        if self.on_pass_start:
+            self.on_pass_start(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.current = previous
+            self.timings[name] = self.timings.get(name, 0) + elapsed
+            if self.on_pass_end:
+                self.on_pass_end(name, elapsed)
+
+    def count(self, counter, n=1):
+        counters = self.counters.setdefault(self.current, {})
+        counters[counter] = counters.get(counter, 0) + n
+
+    def totals(self):
+        totals = {}
+        for counters in self.counters.values():
+            for counter, n in counters.items():
+                totals[counter] = totals.get(counter, 0) + n
+        return totals
+
+    def format_table(self):
+        names = list(self.timings)
+        names += [_ for _ in self.counters if _ not in self.timings and _ is not None]
+        headers = ["pass", "ms"] + list(COUNTERS)
+        rows = []
+        for name in names:
+            counters = self.counters.get(name, {})
+            rows.append(
+                [name, "%.2f" % (self.timings.get(name, 0) * 1000)]
+                + [str(counters.get(_, 0)) for _ in COUNTERS]
+            )
+        totals = self.totals()
+        rows.append(
+            ["total", "%.2f" % (sum(self.timings.values()) * 1000)]
+            + [str(totals.get(_, 0)) for _ in COUNTERS]
+        )
+
+        widths = [max(len(_[i]) for _ in [headers] + rows) for i in range(len(headers))]
+        lines = []
+        for row in [headers] + rows:
+            lines.append(
+                "  ".join(
+                    cell.ljust(width) if i == 0 else cell.rjust(width)
+                    for i, (cell, width) in enumerate(zip(row, widths))
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+
+# The profile the running compile reports to, if any. Each thread has its own,
+# so the server can profile compiles running side by side
+_active = contextvars.ContextVar("caosprofile_active", default=None)
+
+
+@contextlib.contextmanager
+def profiling(profile):
+    token = _active.set(profile)
+    try:
+        yield profile
+    finally:
+        _active.reset(token)
+
+
+def timer(name):
+    profile = _active.get()
+    if profile is None:
+        return contextlib.nullcontext()
+    return profile.timer(name)
+
+
+def count(counter, n=1):
+    profile = _active.get()
+    if profile is not None:
+        profile.count(counter, n)
@@ -0,0 +1,222 @@
+import collections
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+
+import caoscommandinfo
+from caosbatch import include_dirs_for
+from caoscache import CompileCache
+from caoscommandinfo import DEFAULT_VARIANT, VARIANTS
+from caosincremental import IncrementalCompiler
+
+# A resident compiler, so editors and injectors don't pay for starting Python
+# and loading the command info on every save.
+#
+# Messages either way are a 4-byte big-endian length followed by that many
+# bytes of UTF-8 JSON. A connection can send any number of requests, and gets a
+# response to each one, in order:
+#
+#   {"source": "...", "variant": "c3", "path": "...", "id": ...}
+#   {"output": "..." or null, "diagnostics": [{"severity": "error",
+#    "message": "..."}], "id": ...}
+#
+# Only source is required. Requests with a path are compiled incrementally
+# against the last source seen for that path, so an editor sending the same
+# document over and over only pays for the scripts that changed, and included
+# libraries are looked for next to it. Others go through a CompileCache. id is
+# sent back as it is. Libraries are looked for in the server's include_dirs
+# too, and stay loaded between requests. Only the documents used most recently
+# are kept, so clients can come and go without the server growing.
+
+_HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_DOCUMENTS = 64
+
+
+def read_message(f):
+    # Returns None if the connection was closed between messages
+    header = f.read(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise Exception("Connection closed part way through a message")
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise Exception(
+            "Message is %d bytes, the most allowed is %d" % (length, MAX_MESSAGE_SIZE)
+        )
+    data = f.read(length)
+    if len(data) < length:
+        raise Exception("Connection closed part way through a message")
+    return json.loads(data.decode("utf-8"))
+
+
+def write_message(f, message):
+    data = json.dumps(message).encode("utf-8")
+    f.write(_HEADER.pack(len(data)) + data)
+    f.flush()
+
+
+class CompileService:
+    # Everything the server keeps warm between requests, shared by all the
+    # connections
+    __slots__ = ["cache", "include_dirs", "documents", "max_documents", "lock"]
+
+    def __init__(
+        self,
+        variants=(DEFAULT_VARIANT,),
+        cache_dir=None,
+        include_dirs=(),
+        max_documents=DEFAULT_MAX_DOCUMENTS,
+    ):
+        for variant in variants:
+            caoscommandinfo.get_variant(variant)
+        self.cache = CompileCache(cache_dir)
+        self.include_dirs = tuple(include_dirs)
+        # (path, variant) -> (lock, IncrementalCompiler), least recently used
+        # first
+        self.documents = collections.OrderedDict()
+        self.max_documents = max_documents
+        self.lock = threading.Lock()
+
+    def compile(self, source, variant=DEFAULT_VARIANT, path=None):
+        if path is None:
+            return self.cache.compile(source, variant, (".",) + self.include_dirs)
+        with self.lock:
+            document = self.documents.get((path, variant))
+            if document is None:
+                document = self.documents[(path, variant)] = (
+                    threading.Lock(),
+                    IncrementalCompiler(
+                        variant, include_dirs_for(path, self.include_dirs)
+                    ),
+                )
+                while len(self.documents) > self.max_documents:
+                    self.documents.popitem(last=False)
+            else:
+                self.documents.move_to_end((path, variant))
+        (lock, compiler) = document
+        # different documents compile at the same time, the same one in turn
+        with lock:
+            return compiler.compile(source)
+
+    def handle(self, request):
+        response = {"output": None, "diagnostics": []}
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        try:
+            if not isinstance(request, dict) or not isinstance(
+                request.get("source"), str
+            ):
+                raise Exception("Expected a request with a 'source' string")
+            variant = request.get("variant", DEFAULT_VARIANT)
+            if variant not in VARIANTS:
+                raise Exception(
+                    "Unknown variant %r, expected one of %s"
+                    % (variant, ", ".join(VARIANTS))
+                )
+            response["output"] = self.compile(
+                request["source"], variant, request.get("path")
+            )
+        except Exception as e:
+            response["diagnostics"].append({"severity": "error", "message": str(e)})
+        return response
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = read_message(self.rfile)
+            except Exception as e:
+                # can't tell where the next message starts, so give up on this
+                # connection
+                write_message(
+                    self.wfile,
+                    {
+                        "output": None,
+                        "diagnostics": [{"severity": "error", "message": str(e)}],
+                    },
+                )
+                return
+            if request is None:
+                return
+            write_message(self.wfile, self.server.service.handle(request))
+
+
+class ThreadingUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def parse_address(address):
+    # "host:port" or ":port" for TCP, anything else is a Unix socket path
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def make_server(address, service=None):
+    # address is a Unix socket path, or a (host, port) tuple to use TCP. Each
+    # connection gets its own thread
+    if service is None:
+        service = CompileService()
+    if isinstance(address, tuple):
+        server = ThreadingTCPServer(address, _Handler)
+    else:
+        try:
+            is_socket = stat.S_ISSOCK(os.stat(address).st_mode)
+        except FileNotFoundError:
+            is_socket = False
+        if is_socket:
+            try:
+                connect(address).close()
+            except ConnectionRefusedError:
+                # left behind by a server that didn't shut down cleanly
+                os.remove(address)
+            else:
+                raise Exception("A server is already running on %s" % address)
+        server = ThreadingUnixServer(address, _Handler)
+    server.service = service
+    return server
+
+
+def serve(address, service=None):
+    server = make_server(address, service)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple):
+            try:
+                os.remove(address)
+            except OSError:
+                pass
+
+
+def connect(address):
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def compile_remote(address, source, variant=DEFAULT_VARIANT, path=None):
+    # A client for one request. Returns the response as a dict
+    request = {"source": source, "variant": variant}
+    if path is not None:
+        request["path"] = path
+    with connect(address) as sock:
+        with sock.makefile("rwb") as f:
+            write_message(f, request)
+            return read_message(f)
@@ -0,0 +1,112 @@
+import os
+import time
+
+import caoscommandinfo
+from caosbatch import (
+    CompileResult,
+    destination_for,
+    find_sources,
+    include_dirs_for,
+    write_atomically,
+)
+from caoscommandinfo import DEFAULT_VARIANT
+from caosincremental import IncrementalCompiler
+from extendedcaos import included_libraries
+
+# Keeps recompiling files as they change. Everything stays loaded between
+# builds: the command info tables, and an IncrementalCompiler per file, so a
+# rebuild after an edit only compiles the scripts that edit touched.
+#
+# Files are polled rather than watched with inotify or similar, so this works
+# the same everywhere without any extra dependencies. Directories are searched
+# again on every poll, so new files get picked up too. Files get recompiled
+# when a library they include changes as well.
+
+
+class Watcher:
+    __slots__ = [
+        "paths",
+        "output_dir",
+        "variant",
+        "include_dirs",
+        "stamps",
+        "compilers",
+        "libraries",
+    ]
+
+    def __init__(
+        self, paths, output_dir=None, variant=DEFAULT_VARIANT, include_dirs=()
+    ):
+        self.paths = paths
+        self.output_dir = output_dir
+        self.variant = variant
+        self.include_dirs = include_dirs
+        # source -> (mtime, size) when it was last compiled
+        self.stamps = {}
+        self.compilers = {}
+        # source -> the libraries it included when it was last compiled
+        self.libraries = {}
+        caoscommandinfo.get_variant(variant)
+
+    def poll(self):
+        # Compiles every source that's new or has changed since the last poll,
+        # in the same order as find_sources
+        results = []
+        seen = set()
+        for (source, relative) in find_sources(self.paths):
+            try:
+                stat = os.stat(source)
+            except OSError:
+                continue
+            seen.add(source)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if self.stamps.get(source) == stamp and not any(
+                _.changed() for _ in self.libraries.get(source, ())
+            ):
+                continue
+            self.stamps[source] = stamp
+            results.append(
+                self.compile(source, destination_for(source, relative, self.output_dir))
+            )
+
+        for source in list(self.stamps):
+            if source not in seen:
+                del self.stamps[source]
+                self.compilers.pop(source, None)
+                self.libraries.pop(source, None)
+        return results
+
+    def compile(self, source, destination):
+        include_dirs = include_dirs_for(source, self.include_dirs)
+        compiler = self.compilers.get(source)
+        if compiler is None:
+            compiler = self.compilers[source] = IncrementalCompiler(
+                self.variant, include_dirs
+            )
+        try:
+            with open(source) as f:
+                text = f.read()
+            self.libraries[source] = included_libraries(
+                text, self.variant, include_dirs
+            )
+            write_atomically(destination, compiler.compile(text))
+        except Exception as e:
+            return CompileResult(source, destination, "%s: %s" % (source, e))
+        return CompileResult(source, destination)
+
+
+def watch(
+    paths,
+    output_dir=None,
+    variant=DEFAULT_VARIANT,
+    interval=0.5,
+    report=None,
+    include_dirs=(),
+):
+    # Polls forever, calling report(result) for each file compiled
+    watcher = Watcher(paths, output_dir, variant, include_dirs)
+    while True:
+        for result in watcher.poll():
+            if report:
+                report(result)
+        time.sleep(interval)
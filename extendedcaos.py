@@ -1,12 +1,31 @@
 # encoding: utf-8
 
+import bisect
+import functools
+import hashlib
+import heapq
 import itertools
+import marshal
+import os
 import re
 import string
 import sys
+import time
 
 from caoslexer import *
 from caosparser import *
+from caosprofile import (
+    LIBRARIES_COMPILED,
+    NODES_REPARSED,
+    SNIPPETS_GENERATED,
+    TOKENS_INSERTED,
+    VARIABLES_ALLOCATED,
+    VARIABLES_SPILLED,
+    Profile,
+    count,
+    profiling,
+    timer,
+)
 
 
 def move_comments_to_own_line(tokens):
@@ -36,58 +55,483 @@ def move_comments_to_own_line(tokens):
                 del tokens[i - 1]
             # figure out where to put it
             i = last_newline + 1
-            tokens.insert(i, (TOK_WHITESPACE, get_indentation_at(tokens, i)))
-            tokens.insert(i + 1, t)
-            tokens.insert(i + 2, (TOK_NEWLINE, "\n"))
+            tokens[i:i] = [
+                (TOK_WHITESPACE, get_indentation_at(tokens, i)),
+                t,
+                (TOK_NEWLINE, "\n"),
+            ]
+            count(TOKENS_INSERTED, 3)
             i += 2
         else:
             i += 1
 
 
-class script:
-    def __init__(self, start, end):
+# Named variables get allocated VAxx like registers. Each variable is split
+# into webs: separate live ranges, which start where it's set outside of any
+# block, and each web only needs a VAxx from its first use to its last, so
+# webs that don't overlap can share one. Scripts are block structured, so that
+# range is the span of tokens between them, stretched over any loop the
+# variable is still live around.
+#
+# VAxx start out as 0, and scripts can rely on that, so a variable that might
+# be read before it's set gets a VAxx that nothing before it used. The same
+# goes for everything in scripts using gsub, where control can jump around.
+#
+# The install script is everything outside of scrp and rscr, so code after an
+# endm carries on from before the scrp, with the same variables.
+#
+# When there are more webs live at once than VAxx, the ones used least get
+# spilled instead, into the variables the file sets aside for it with
+# spill_variable. There's no telling which MVxx or GAME variables anything
+# else uses, so nothing else gets spilled into. Event scripts spill to the
+# MVxx: they're the owner's, and OWNR doesn't change when TARG does. Scripts
+# that CALL others on the owner could have them overwritten, so don't.
+# Injected scripts have no owner, so they spill to the GAME variables, and
+# delete them again with DELG wherever they stop. Only webs that are set
+# before they're read get spilled, so none of this needs setting to 0 first.
+NUM_VARIABLES = 100
+_ASSIGNMENTS = ("setv", "seta", "sets")
+_LOOP_STARTS = ("enum", "esee", "etch", "epas", "econ", "reps", "loop")
+_LOOP_ENDS = ("next", "repe", "untl", "ever")
+_BLOCK_WORDS = ("doif", "elif", "else", "endi") + _LOOP_STARTS + _LOOP_ENDS
+
+
+class Loop:
+    __slots__ = ["start", "end"]
+
+    def __init__(self, start, end=None):
         self.start = start
         self.end = end
-        self.vaxx_vars = []
-        self.dollar_vars = []
+
+
+class ScriptVariables:
+    __slots__ = [
+        "start",
+        "end",
+        "event",
+        "calls",
+        "reserved",
+        "object_variables",
+        "occurrences",
+        "dirty",
+        "structured",
+        "exits",
+    ]
+
+    def __init__(self, start, event=False):
+        self.start = start
+        self.end = start
+        # True for scrp, which has an owner, False for injected code
+        self.event = event
+        # True if the script uses call
+        self.calls = False
+        # bitset of the VAxx used directly, which never get allocated
+        self.reserved = 0
+        # bitset of the OVxx used directly, through MVxx, OVxx or AVAR
+        self.object_variables = 0
+        # name -> (token index, line, blocks, loops, assigned) for each use,
+        # where blocks identifies the block it's in and the ones around it,
+        # loops are the loops it's in, outermost first, and assigned is whether
+        # it's being set by setv/seta/sets
+        self.occurrences = {}
+        # variables that might be read before they're set
+        self.dirty = set()
+        # False if the script uses gsub or its blocks don't match up
+        self.structured = True
+        # token indexes of each stop, and of the rscr ending it if there is one
+        self.exits = []
+
+
+class Web:
+    __slots__ = ["name", "occurrences", "dirty", "start", "end", "slot", "spill"]
+
+    def __init__(self, name, occurrences, dirty):
+        self.name = name
+        self.occurrences = occurrences
+        self.dirty = dirty
+        self.start = occurrences[0][0]
+        self.end = occurrences[-1][0]
+        # the VAxx it's in, or None if it got spilled
+        self.slot = None
+        # the variable it got spilled to, e.g. "mv98"
+        self.spill = None
+
+
+def find_script_variables(tokens):
+    # Walks the tokens once, following the blocks in each script and which
+    # variables are definitely set at each point
+    scripts = [ScriptVariables(0)]
+    current = scripts[0]
+    # the script a scrp is in, and the state it was in, to go back to at endm
+    outer = None
+    block_ids = itertools.count()
+
+    def finish(s, end):
+        s.end = end
+        if frames:
+            s.structured = False
+            for frame in frames:
+                if frame[4] is not None:
+                    frame[4].end = end
+
+    blocks = ()
+    loops = ()
+    # ["doif" or "loop", set before, sets at the end of each branch, has else,
+    # Loop]
+    frames = []
+    assigned = set()
+    pending = []
+    line = 0
+    previous = None
+    # 1 after an AVAR, 2 once there's been an integer after it on the line
+    avar = 0
+    for i, t in enumerate(tokens):
+        if t[0] == TOK_NEWLINE:
+            # assignments take effect at the end of the line, so anything
+            # else on it reads what was there before
+            assigned.update(pending)
+            pending.clear()
+            line += 1
+            previous = None
+            if avar == 1:
+                # can't tell which one it is
+                current.object_variables = (1 << NUM_VARIABLES) - 1
+            avar = 0
+            continue
+        if t[0] == TOK_WHITESPACE:
+            continue
+        if t[0] != TOK_WORD:
+            if avar and t[0] == TOK_INTEGER and t[1].isdecimal():
+                # probably the index, but could be part of the agent
+                if int(t[1]) < NUM_VARIABLES:
+                    current.object_variables |= 1 << int(t[1])
+                avar = 2
+            previous = None
+            continue
+
+        s = current
+        word = t[1]
+        if word[0] == "$":
+            is_assignment = previous in _ASSIGNMENTS
+            s.occurrences.setdefault(word, []).append(
+                (i, line, blocks, loops, is_assignment)
+            )
+            if is_assignment:
+                pending.append(word)
+            elif word not in assigned:
+                s.dirty.add(word)
+            previous = None
+            continue
+
+        word = previous = word.lower()
+        if word in ("scrp", "rscr"):
+            if word == "scrp" and outer is None:
+                outer = (s, blocks, loops, frames, assigned)
+            elif outer is not None:
+                # no endm before it
+                finish(s, i - 1)
+            if word == "rscr":
+                if outer is not None:
+                    (s, blocks, loops, frames, assigned) = outer
+                    outer = None
+                s.exits.append(i)
+                finish(s, i - 1)
+            current = ScriptVariables(i, word == "scrp")
+            scripts.append(current)
+            blocks = ()
+            loops = ()
+            frames = []
+            assigned = set()
+            pending.clear()
+        elif word == "endm":
+            if outer is not None:
+                finish(s, i)
+                (current, blocks, loops, frames, assigned) = outer
+                outer = None
+                pending.clear()
+        elif word == "stop":
+            s.exits.append(i)
+        elif len(word) == 4 and word[:2] == "va" and word[2:].isdecimal():
+            s.reserved |= 1 << int(word[2:])
+        elif len(word) == 4 and word[:2] in ("ov", "mv") and word[2:].isdecimal():
+            s.object_variables |= 1 << int(word[2:])
+        elif word == "avar":
+            avar = 1
+        elif word == "call":
+            s.calls = True
+        elif word in ("gsub", "subr"):
+            s.structured = False
+        elif word in _BLOCK_WORDS:
+            assigned.update(pending)
+            pending.clear()
+            if word == "doif":
+                frames.append(["doif", set(assigned), [], False, None])
+                blocks += (next(block_ids),)
+            elif word in _LOOP_STARTS:
+                loop = Loop(i)
+                frames.append(["loop", set(assigned), None, False, loop])
+                blocks += (next(block_ids),)
+                loops += (loop,)
+            elif not frames or frames[-1][0] != (
+                "loop" if word in _LOOP_ENDS else "doif"
+            ):
+                s.structured = False
+            elif word in ("elif", "else"):
+                frame = frames[-1]
+                frame[2].append(assigned)
+                frame[3] = frame[3] or word == "else"
+                assigned = set(frame[1])
+                blocks = blocks[:-1] + (next(block_ids),)
+            elif word == "endi":
+                (_, before, branches, has_else, _) = frames.pop()
+                branches.append(assigned)
+                if not has_else:
+                    branches.append(before)
+                assigned = set.intersection(*branches)
+                blocks = blocks[:-1]
+            else:
+                frame = frames.pop()
+                frame[4].end = i
+                # reps and the enums might not run at all, but loop always
+                # runs once before getting to untl
+                if word != "untl":
+                    assigned = frame[1]
+                blocks = blocks[:-1]
+                loops = loops[:-1]
+    if avar == 1:
+        current.object_variables = (1 << NUM_VARIABLES) - 1
+    finish(current, len(tokens) - 1)
+    if outer is not None:
+        (current, blocks, loops, frames, assigned) = outer
+        finish(current, len(tokens) - 1)
+    return scripts
+
+
+def _split_webs(name, occurrences, dirty):
+    # Starts a new web at each assignment outside of any loop that everything
+    # up to the next web is inside the block of, and that isn't read on the
+    # same line. Everything in a web can then only have come from the
+    # assignment it starts with
+    splits = [len(occurrences)]
+    common = None
+    for k in range(len(occurrences) - 1, 0, -1):
+        (index, line, blocks, loops, is_assignment) = occurrences[k]
+        if (
+            is_assignment
+            and not loops
+            and (k + 1 == len(occurrences) or occurrences[k + 1][1] != line)
+            and (common is None or common[: len(blocks)] == blocks)
+        ):
+            splits.append(k)
+            common = None
+            continue
+        if common is None:
+            common = blocks
+        else:
+            n = 0
+            while n < min(len(common), len(blocks)) and common[n] == blocks[n]:
+                n += 1
+            common = common[:n]
+    splits.append(0)
+    splits.reverse()
+    return [
+        Web(name, occurrences[a:b], dirty and a == 0)
+        for (a, b) in zip(splits, splits[1:])
+    ]
+
+
+def allocate_variables(s, spill_variables=()):
+    # Returns the webs in s, with a VAxx slot each, or if they got spilled, one
+    # of spill_variables, e.g. "mv98" or 'game "spill"'
+    webs = []
+    for name, occurrences in s.occurrences.items():
+        if not s.structured:
+            web = Web(name, occurrences, True)
+            (web.start, web.end) = (s.start, s.end)
+            webs.append(web)
+            continue
+        for web in _split_webs(name, occurrences, name in s.dirty):
+            first = web.occurrences[0]
+            last = web.occurrences[-1]
+            if web.dirty:
+                # live all the way around any loop it's in
+                if first[3]:
+                    web.start = first[3][0].start
+                if last[3]:
+                    web.end = max(web.end, last[3][0].end)
+            else:
+                # it's always set first, so it can only be live around loops
+                # that started after that
+                for loop in last[3]:
+                    if loop.start > first[0]:
+                        web.end = max(web.end, loop.end)
+                        break
+            webs.append(web)
+    webs.sort(key=lambda _: (_.start, _.occurrences[0][0]))
+
+    # linear scan, with the VAxx that are free and the ones that have ever been
+    # used as bitsets
+    can_spill = bool(spill_variables)
+    active = []
+    free = ((1 << NUM_VARIABLES) - 1) & ~s.reserved
+    used = s.reserved
+    spilled = []
+    for n, web in enumerate(webs):
+        while active and active[0][0] < web.start:
+            expired = heapq.heappop(active)[2]
+            if expired.slot is not None:
+                free |= 1 << expired.slot
+        candidates = free & ~used if web.dirty else free
+        if not candidates and can_spill and not web.dirty:
+            # spill whichever of the webs that could be is used least, going
+            # by how many times it appears, and if that's a tie, the one that
+            # stays live longest
+            victim = min(
+                [_[2] for _ in active if _[2].slot is not None and not _[2].dirty]
+                + [web],
+                key=lambda _: (len(_.occurrences), -_.end),
+            )
+            spilled.append(victim)
+            if victim is not web:
+                (web.slot, victim.slot) = (victim.slot, None)
+                heapq.heappush(active, (web.end, n, web))
+            continue
+        if not candidates:
+            raise Exception(
+                "Couldn't allocate variable for '%s', more are live at once than "
+                "there are VAxx and spill_variables for" % web.name
+            )
+        bit = candidates & -candidates
+        free &= ~bit
+        used |= bit
+        web.slot = bit.bit_length() - 1
+        heapq.heappush(active, (web.end, n, web))
+    if not spilled:
+        return webs
+    count(VARIABLES_SPILLED, len(spilled))
+
+    # and the same again for the spilled webs, using the spill variables in the
+    # order they were given
+    spilled.sort(key=lambda _: (_.start, _.occurrences[0][0]))
+    active = []
+    free = list(range(len(spill_variables)))
+    for n, web in enumerate(spilled):
+        while active and active[0][0] < web.start:
+            heapq.heappush(free, heapq.heappop(active)[2])
+        if not free:
+            raise Exception(
+                "Couldn't allocate variable for '%s', more are live at once than "
+                "there are VAxx and spill_variables for" % web.name
+            )
+        k = heapq.heappop(free)
+        web.spill = spill_variables[k]
+        heapq.heappush(active, (web.end, n, k))
+    return webs
 
 
 def namedvariables_to_vaxx(tokens, parsetree):
-    scripts = [script(0, 0)]
+    commands = get_variant(variant_of(parsetree)).commands_dict
+    spill_variables = []
+    node_index = 0
+    while node_index < len(parsetree):
+        node = parsetree[node_index]
+        if not isinstance(node, SpillVariableDefinition):
+            node_index += 1
+            continue
+        if node.value.startswith("game "):
+            if ("", "delg", True) not in commands:
+                raise Exception(
+                    "Can't spill to GAME variables without DELG to delete them"
+                )
+        elif ("", "mvxx", False) not in commands:
+            raise Exception("Can't spill to MVxx, there aren't any")
+        if node.value not in spill_variables:
+            spill_variables.append(node.value)
+        whiteout_node_and_line(tokens, parsetree, node_index)
 
-    # find script extents
-    # TODO: expose this elsewhere too?
-    for i, t in enumerate(tokens):
-        if t[0] == TOK_WORD:
-            if t[1] in ("scrp", "rscr"):
-                scripts[-1].end = i - 1
-                scripts.append(script(i, i))
-            elif re.match(r"(?i)^va\d\d$", t[1]):
-                if t[1].lower() not in scripts[-1].vaxx_vars:
-                    scripts[-1].vaxx_vars.append(t[1].lower())
-            elif t[1][0] == "$":
-                if t[1] not in scripts[-1].dollar_vars:
-                    scripts[-1].dollar_vars.append(t[1])
-    scripts[-1].end = len(tokens) - 1
-
-    # for each script, map named variables to actual variables, then replace the
-    # tokens
+    scripts = find_script_variables(tokens)
+    # token index -> GAME variable, done last since they're more than one token
+    game_variables = {}
+    # token index of each exit -> the GAME variables to delete there
+    deletions = {}
     for s in scripts:
-        var_mapping = {}
-        for d in s.dollar_vars:
-            possibles = [
-                "va{:02}".format(i)
-                for i in range(100)
-                if "va{:02}".format(i)
-                not in itertools.chain(s.vaxx_vars, var_mapping.values())
+        if s.event:
+            allowed = [] if s.calls else [
+                _
+                for _ in spill_variables
+                if _.startswith("mv") and not s.object_variables & (1 << int(_[2:]))
             ]
-            if not possibles:
-                raise Exception("Couldn't allocate variable for '%s'" % d)
-            var_mapping[d] = possibles[0]
-        if s.dollar_vars:
-            for i in range(s.start, s.end + 1):
-                if tokens[i][0] == TOK_WORD and tokens[i][1][0] == "$":
-                    tokens[i] = (TOK_WORD, var_mapping[tokens[i][1]])
+        else:
+            allowed = [_ for _ in spill_variables if _.startswith("game ")]
+        webs = allocate_variables(s, allowed)
+        count(VARIABLES_ALLOCATED, len(s.occurrences))
+        used = []
+        for web in webs:
+            if web.slot is not None:
+                variable = "va{:02}".format(web.slot)
+            elif web.spill.startswith("game "):
+                for occurrence in web.occurrences:
+                    game_variables[occurrence[0]] = web.spill
+                if web.spill not in used:
+                    used.append(web.spill)
+                continue
+            else:
+                variable = web.spill
+            for occurrence in web.occurrences:
+                tokens[occurrence[0]] = (TOK_WORD, variable)
+        if used:
+            for i in s.exits:
+                deletions.setdefault(i, []).extend(used)
+            if not s.exits or tokens[s.exits[-1]][1].lower() != "rscr":
+                # runs to the end of the file
+                deletions.setdefault(None, []).extend(used)
+    if game_variables:
+        spill_to_game_variables(tokens, parsetree, game_variables, deletions)
+
+
+def spill_to_game_variables(tokens, parsetree, game_variables, deletions):
+    # Splices in the GAME variables, one toplevel node at a time, starting from
+    # the end so the ones before don't move. Then deletes them with DELG before
+    # each exit in deletions, given by token index or None for the end of file
+    starts = [_.start_token for _ in parsetree]
+    by_node = {}
+    for i in sorted(game_variables):
+        node_index = bisect.bisect_right(starts, i) - 1
+        by_node.setdefault(node_index, []).append(i)
+    for node_index in sorted(by_node, reverse=True):
+        start = starts[node_index]
+        edits = []
+        for i in by_node[node_index]:
+            whiteout_tokens(tokens, i, i)
+            edits.append((i - start, 1, generate_snippet(game_variables[i])))
+        splice_into_toplevel(tokens, parsetree, node_index, edits)
+
+    def delete(variables):
+        return generate_snippet("".join("delg %s\n" % _[5:] for _ in variables))
+
+    if None in deletions:
+        snippet = delete(deletions.pop(None))
+        if len(tokens) > 1 and tokens[-2][0] != TOK_NEWLINE:
+            snippet = [(TOK_NEWLINE, "\n")] + snippet
+        parsedsnippet = parse(snippet + [(TOK_EOI, "")], variant_of(parsetree))
+        add_token_offset_to_nodes(parsedsnippet, len(tokens) - 1)
+        tokens[len(tokens) - 1 : len(tokens) - 1] = snippet
+        parsetree[len(parsetree) :] = parsedsnippet
+        count(TOKENS_INSERTED, len(snippet))
+    # exits are toplevel commands, and splicing didn't move the nodes around
+    exits = {}
+    for i, variables in deletions.items():
+        node_index = bisect.bisect_left(starts, i)
+        if node_index < len(starts) and starts[node_index] == i:
+            exits[node_index] = variables
+    for node_index in sorted(exits, reverse=True):
+        indent = get_indentation_at(tokens, parsetree[node_index].start_token)
+        insert_before_node(
+            tokens,
+            parsetree,
+            node_index,
+            add_indent(delete(exits[node_index]), indent),
+        )
 
 
 def get_indentation_at(tokens, i):
@@ -146,27 +590,19 @@ def nodes_to_string(nodes):
     parts = []
 
     def visit(n):
-        type = n["type"]
-        if type in ("Command",):
-            parts.append(n["name"])
-            for a in n["args"]:
+        if isinstance(n, Command):
+            parts.append(n.name)
+            for a in n.args:
                 visit(a)
-        elif type in ("Condition",):
-            for a in n["args"]:
+        elif isinstance(n, Condition):
+            for a in n.args:
                 visit(a)
-        elif type in ("DotCommand",):
-            parts.append(n["targ"] + "." + n["name"])
-            for a in n["args"]:
+        elif isinstance(n, DotCommand):
+            parts.append(n.targ + "." + n.name)
+            for a in n.args:
                 visit(a)
-        elif type in (
-            "Variable",
-            "LiteralString",
-            "LiteralInteger",
-            "LiteralFloat",
-            "LiteralBytestring",
-            "ConditionKeyword",
-        ):
-            parts.append(n["value"])
+        elif isinstance(n, (Variable, Literal, ConditionKeyword)):
+            parts.append(n.value)
         else:
             raise Exception("Unimplemented node type %r" % n)
 
@@ -182,8 +618,8 @@ def node_to_string(node):
 def generate_save_result_to_variable(variable_name, node):
     value = node_to_string(node)
 
-    if node["type"] == "Variable" or (
-        node["type"] == "Command" and node["commandret"] == "variable"
+    if isinstance(node, Variable) or (
+        isinstance(node, Command) and node.commandret == "variable"
     ):
         # e.g. "va00", or "FROM" in Docking Station, which can be an agent or a string
         # TODO: can we look at what the parent is expecting?
@@ -199,16 +635,16 @@ def generate_save_result_to_variable(variable_name, node):
             ).format(value=value, var=variable_name)
         )
 
-    if node["type"] == "LiteralString":
+    if isinstance(node, LiteralString):
         setx_command = "sets"
-    elif node["type"] == "LiteralInteger":
+    elif isinstance(node, LiteralInteger):
         setx_command = "setv"
-    elif node["type"] in ("Command", "DotCommand"):
-        if node["commandret"] in ("integer", "float"):
+    elif isinstance(node, CommandBase):
+        if node.commandret in ("integer", "float"):
             setx_command = "setv"
-        elif node["commandret"] in ("string",):
+        elif node.commandret in ("string",):
             setx_command = "sets"
-        elif node["commandret"] in ("agent",):
+        elif node.commandret in ("agent",):
             setx_command = "seta"
         else:
             raise Exception("Don't know how to save result type of {}".format(node))
@@ -223,16 +659,16 @@ def generate_save_result_to_variable(variable_name, node):
 
 
 def get_endi_index_for(parsetree, p):
-    assert parsetree[p]["type"] == "Command"
-    assert parsetree[p]["name"] in ("doif", "elif")
+    assert isinstance(parsetree[p], Command)
+    assert parsetree[p].name in ("doif", "elif")
 
     nesting = 0
 
     while True:
         p += 1
-        if parsetree[p]["type"] == "Command" and parsetree[p]["name"] == "doif":
+        if isinstance(parsetree[p], Command) and parsetree[p].name == "doif":
             nesting += 1
-        elif parsetree[p]["type"] == "Command" and parsetree[p]["name"] == "endi":
+        elif isinstance(parsetree[p], Command) and parsetree[p].name == "endi":
             if nesting == 0:
                 return p
             else:
@@ -245,38 +681,127 @@ def generate_snippet(*args):
     for a in args:
         if isinstance(a, str):
             snippet += a
-        elif isinstance(a, list) and isinstance(a[0], tuple):
+        elif isinstance(a, TokenBuffer) or (
+            isinstance(a, list) and isinstance(a[0], tuple)
+        ):
             # must be tokens
             snippet += tokens_to_string(a)
         else:
             raise Exception("Don't know how to generate snippet for %r" % a)
+    count(SNIPPETS_GENERATED)
+    return list(_lex_snippet(snippet))
+
+
+@functools.lru_cache(maxsize=4096)
+def _lex_snippet(snippet):
+    # passes generate the same few snippets over and over
     # TODO: either get rid of TOK_EOI or skip it, or something
-    return lexcaos(snippet)[:-1]
+    return tuple(lexcaos(snippet)[:-1])
+
+
+# Statements that can't change TARG or anything about an agent, so dot command
+# values worked out before them are still good after. The ones that assign
+# to a variable make any dot commands on it stale, see assigned_variable, and
+# assigning to anything else, which could be part of an agent, makes them all
+# stale, see assigns_agent_variable
+_PURE_STATEMENTS = (
+    "setv",
+    "seta",
+    "sets",
+    "adds",
+    "addv",
+    "subv",
+    "mulv",
+    "divv",
+    "modv",
+    "negv",
+    "absv",
+    "andv",
+    "orrv",
+    "dbg: outv",
+    "dbg: outs",
+)
+# Statements that jump, end the script or set TARG themselves, so nothing
+# after them can count on TARG being what it was before
+_GROUP_ENDS = ("targ", "gsub", "subr", "retn", "call", "stop", "scrp", "rscr", "endm")
+
+
+def variable_key(name):
+    # named variables are case sensitive, everything else isn't
+    return name if name.startswith("$") else name.lower()
+
+
+def assigned_variable(node):
+    # the variable a pure statement like setv assigns to, or None if it doesn't
+    # or isn't one
+    if not (
+        isinstance(node, Command) and node.name in _PURE_STATEMENTS and node.args
+    ):
+        return None
+    return variable_node_key(node.args[0])
+
+
+def assigns_agent_variable(node):
+    # whether a pure statement like setv assigns to something other than a
+    # script variable, like ov00, attr, velx or $agent.ov00, which could be part
+    # of an agent, and so change what dot commands on any agent give
+    if not (
+        isinstance(node, Command)
+        and node.name in _PURE_STATEMENTS
+        and not node.name.startswith("dbg:")
+        and node.args
+    ):
+        return False
+    return variable_node_key(node.args[0]) is None
 
 
 def explicit_targs(tokens, parsetree):
+    # Argless dot commands, like ownr.posy, only get worked out once, as long
+    # as nothing in between could change them and every way to where they're
+    # used again goes through where they were worked out. Loops and anything
+    # else that isn't a doif, or a statement that just sets a variable, start
+    # over. (targ, name) -> the variable holding its value
+    available = {}
+    # for each doif around this node, what was available at the start of it
+    # and at the end of each branch so far, and whether it has an else
+    frames = []
+
+    # returns the snippets to insert before the toplevel node, and the node to
+    # put in place of this one
     def visit(node, in_dotcommand):
-        if node["type"] == "DotCommand" or (
-            node["type"] in ("Command", "Condition") and in_dotcommand
+        if isinstance(node, DotCommand) and not node.args:
+            key = (variable_key(node.targ), node.name)
+            if key in available:
+                startp = node.start_token_in_parent + toplevel.start_token
+                whiteout_child_node_from_tokens(toplevel, node, tokens)
+                tokens[startp] = (TOK_WORD, available[key])
+                return [], Variable(available[key])
+
+        if isinstance(node, DotCommand) or (
+            isinstance(node, (Command, Condition)) and in_dotcommand
         ):
-            insertions = []
-            for a in node["args"]:
-                insertions += visit(a, True)
+            insertions = visit_args(node, True)
 
-            startp = node["start_token_in_parent"] + toplevel["start_token"]
+            startp = node.start_token_in_parent + toplevel.start_token
             value_variable = "$__{}_{}__t{}".format(
-                node.get("targ", "").lstrip("$"), node["name"], startp
+                node.targ.lstrip("$") if isinstance(node, DotCommand) else "",
+                node.name,
+                startp,
             )
 
-            indent = get_indentation_at(tokens, toplevel["start_token"])
-            if node["type"] == "DotCommand":
-                newnode = dict(node)
-                newnode.update({"type": "Command"})
+            indent = get_indentation_at(tokens, toplevel.start_token)
+            if isinstance(node, DotCommand):
+                newnode = Command(
+                    name=node.name,
+                    args=node.args,
+                    commandtype=node.commandtype,
+                    commandret=node.commandret,
+                )
                 insertions.append(
                     add_indent(
                         generate_snippet(
                             "seta $__saved_targ targ\n",
-                            "targ {}\n".format(node["targ"]),
+                            "targ {}\n".format(node.targ),
                             generate_save_result_to_variable(value_variable, newnode),
                             "targ $__saved_targ\n",
                         ),
@@ -291,36 +816,200 @@ def explicit_targs(tokens, parsetree):
                 )
             whiteout_child_node_from_tokens(toplevel, node, tokens)
             tokens[startp] = (TOK_WORD, value_variable)
-            node.clear()
-            node.update(
-                {"type": "Variable", "value": value_variable,}
-            )
-            return insertions
+            if isinstance(node, DotCommand) and not node.args:
+                available[(variable_key(node.targ), node.name)] = value_variable
+            return insertions, Variable(value_variable)
 
-        elif node.get("type", "") in ("Command", "Condition"):
-            insertions = []
-            for a in node["args"]:
-                insertions += visit(a, in_dotcommand)
-            return insertions
+        elif isinstance(node, (Command, Condition)):
+            return visit_args(node, in_dotcommand), node
         else:
-            return []
+            return [], node
+
+    def visit_args(node, in_dotcommand):
+        insertions = []
+        for i, a in enumerate(node.args):
+            arg_insertions, node.args[i] = visit(a, in_dotcommand)
+            insertions += arg_insertions
+        return insertions
+
+    # A statement whose dot commands are all on the same agent, and that
+    # doesn't read TARG otherwise, can just run with TARG set to that agent,
+    # with its dot commands worked out in place. A run of them on the same
+    # agent shares the one targ. Returns (key, targ) for the agent, or None
+    def group_targ(node):
+        if isinstance(node, DotCommand):
+            if (
+                node.name in _TARG_SETTING + _BLOCK_WORDS + _GROUP_ENDS
+                or node.name.startswith("new:")
+            ):
+                return None
+            targs = {variable_key(node.targ): node.targ}
+        elif isinstance(node, Command) and node.name in _PURE_STATEMENTS:
+            targs = {}
+        else:
+            return None
+        if not all(under_targ(_, targs) for _ in node.args) or len(targs) != 1:
+            return None
+        return next(iter(targs.items()))
+
+    def under_targ(node, targs):
+        if isinstance(node, DotCommand):
+            if node.args or (variable_key(node.targ), node.name) not in available:
+                targs[variable_key(node.targ)] = node.targ
+        elif not reads_targ_through_args(node):
+            return not reads_targ(node)
+        return all(under_targ(_, targs) for _ in node.args)
+
+    def strip_targs(node):
+        # works out the dot commands in a statement in a group in place, apart
+        # from any already in available
+        for i, a in enumerate(node.args):
+            if isinstance(a, DotCommand):
+                if not a.args and (variable_key(a.targ), a.name) in available:
+                    node.args[i] = visit(a, False)[1]
+                    continue
+                startp = a.start_token_in_parent + toplevel.start_token
+                whiteout_tokens(tokens, startp, startp + 1)
+                a = node.args[i] = Command(
+                    name=a.name,
+                    args=a.args,
+                    commandtype=a.commandtype,
+                    commandret=a.commandret,
+                    start_token_in_parent=a.start_token_in_parent + 2,
+                    end_token_in_parent=a.end_token_in_parent,
+                )
+            if isinstance(a, (CommandBase, Condition)):
+                strip_targs(a)
+
+    # the key of the agent TARG is set to for the group the last statement
+    # was in, if it carries on
+    group = None
 
     node_index = 0
     while node_index < len(parsetree):
         toplevel = parsetree[node_index]
-        if toplevel["type"] not in ("Command", "Condition", "DotCommand"):
+        if not isinstance(toplevel, (CommandBase, Condition)):
             node_index += 1
             continue
 
-        insertions = []
-        for a in toplevel["args"]:
-            insertions += visit(a, toplevel["type"] == "DotCommand")
+        name = toplevel.name if isinstance(toplevel, Command) else None
+        # before the dot commands in it get worked out
+        assigns_agent = assigns_agent_variable(toplevel)
+        targ = group_targ(toplevel)
+        if targ is not None:
+            indent = get_indentation_at(tokens, toplevel.start_token)
+            if group is None:
+                node_index = insert_before_node(
+                    tokens,
+                    parsetree,
+                    node_index,
+                    add_indent(
+                        generate_snippet(
+                            "seta $__saved_targ targ\n", "targ {}\n".format(targ[1])
+                        ),
+                        indent,
+                    ),
+                )
+                toplevel = parsetree[node_index]
+            strip_targs(toplevel)
+            if isinstance(toplevel, DotCommand):
+                whiteout_tokens(tokens, toplevel.start_token, toplevel.start_token + 1)
+                toplevel = parsetree[node_index] = Command(
+                    name=toplevel.name,
+                    args=toplevel.args,
+                    commandtype=toplevel.commandtype,
+                    commandret=toplevel.commandret,
+                    start_token=toplevel.start_token + 2,
+                    end_token=toplevel.end_token,
+                )
+                available.clear()
+            elif assigns_agent:
+                available.clear()
+            else:
+                variable = assigned_variable(toplevel)
+                for key in [_ for _ in available if _[0] == variable]:
+                    del available[key]
+
+            # carry on with the same TARG if the next statement can, and this
+            # one didn't change what it's set from
+            group = targ[0]
+            if (
+                not (
+                    group.startswith("$")
+                    or re.match(r"^va\d\d$", group)
+                    or group in _AGENT_CONSTANTS
+                )
+                or any(variable_node_key(_) == group for _ in toplevel.args)
+                or node_index + 1 == len(parsetree)
+                or (group_targ(parsetree[node_index + 1]) or (None,))[0] != group
+            ):
+                group = None
+                node_index = insert_before_node(
+                    tokens,
+                    parsetree,
+                    node_index,
+                    add_indent(
+                        generate_snippet(
+                            tokens[toplevel.start_token : toplevel.end_token + 1],
+                            "\ntarg $__saved_targ\n",
+                        ),
+                        indent,
+                    ),
+                )
+                whiteout_node_and_line(tokens, parsetree, node_index)
+            else:
+                node_index += 1
+            continue
+
+        if name in ("elif", "else") and frames:
+            # what was worked out in the last branch isn't there in this one
+            frame = frames[-1]
+            frame[1].append(dict(available))
+            available.clear()
+            available.update(frame[0])
+            frame[2] = frame[2] or name == "else"
+        elif name == "endi" and frames:
+            (before, branches, has_else) = frames.pop()
+            branches.append(dict(available))
+            if not has_else:
+                branches.append(before)
+            # only what every way here worked out the same way
+            available.clear()
+            available.update(
+                _
+                for _ in branches[0].items()
+                if all(branch.get(_[0]) == _[1] for branch in branches[1:])
+            )
+
+        insertions = visit_args(toplevel, isinstance(toplevel, DotCommand))
 
         for snippet in insertions:
             node_index = insert_before_node(tokens, parsetree, node_index, snippet)
+        # the insertions moved it
+        toplevel = parsetree[node_index]
 
-        if toplevel["type"] == "DotCommand":
-            indent = get_indentation_at(tokens, toplevel["start_token"])
+        variable = assigned_variable(toplevel)
+        if assigns_agent:
+            available.clear()
+        elif variable is not None:
+            for key in [_ for _ in available if _[0] == variable]:
+                del available[key]
+        elif name == "elif" and toplevel.name == "doif" and frames:
+            # it got turned into an else and a doif, to make room for the
+            # insertions
+            frames[-1][2] = True
+            frames.append([dict(available), [], False])
+        elif name in ("doif", "elif", "else", "endi"):
+            if name == "doif":
+                frames.append([dict(available), [], False])
+        elif name not in _PURE_STATEMENTS:
+            # anything else could change TARG or the agents, or be jumped to
+            available.clear()
+            if name in ("scrp", "rscr", "endm"):
+                frames.clear()
+
+        if isinstance(toplevel, DotCommand):
+            indent = get_indentation_at(tokens, toplevel.start_token)
             node_index = insert_before_node(
                 tokens,
                 parsetree,
@@ -328,8 +1017,8 @@ def explicit_targs(tokens, parsetree):
                 add_indent(
                     generate_snippet(
                         "seta $__saved_targ targ\n",
-                        "targ {}\n".format(toplevel["targ"]),
-                        tokens[toplevel["start_token"] + 2 : toplevel["end_token"] + 1],
+                        "targ {}\n".format(toplevel.targ),
+                        tokens[toplevel.start_token + 2 : toplevel.end_token + 1],
                         "\ntarg $__saved_targ\n",
                     ),
                     indent,
@@ -340,49 +1029,10 @@ def explicit_targs(tokens, parsetree):
             node_index += 1
 
 
-def remove_extraneous_targ_saving(tokens, parsetree):
-    node_index = 0
-    while node_index < len(parsetree) - 1:
-        if (
-            parsetree[node_index]["type"] == "Command"
-            and parsetree[node_index]["name"] == "targ"
-            and len(parsetree[node_index]["args"]) == 1
-            and parsetree[node_index]["args"][0]["type"] == "Variable"
-            and parsetree[node_index + 1]["type"] == "Command"
-            and parsetree[node_index + 1]["name"] == "seta"
-            and len(parsetree[node_index + 1]["args"]) == 2
-            and parsetree[node_index + 1]["args"][0]["type"] == "Variable"
-            and parsetree[node_index + 1]["args"][0]["value"]
-            == parsetree[node_index]["args"][0]["value"]
-            and parsetree[node_index + 1]["args"][1]["type"] == "Command"
-            and parsetree[node_index + 1]["args"][1]["name"] == "targ"
-        ):
-            whiteout_node_and_line(tokens, parsetree, node_index + 1)
-        elif (
-            parsetree[node_index]["type"] == "Command"
-            and parsetree[node_index]["name"] == "targ"
-            and len(parsetree[node_index]["args"]) == 1
-            and parsetree[node_index]["args"][0]["type"] == "Command"
-            and re.match(r"^va\d\d$", parsetree[node_index]["args"][0]["name"])
-            and parsetree[node_index + 1]["type"] == "Command"
-            and parsetree[node_index + 1]["name"] == "seta"
-            and len(parsetree[node_index + 1]["args"]) == 2
-            and parsetree[node_index + 1]["args"][0]["type"] == "Command"
-            and parsetree[node_index + 1]["args"][0]["name"]
-            == parsetree[node_index]["args"][0]["name"]
-            and parsetree[node_index + 1]["args"][1]["type"] == "Command"
-            and parsetree[node_index + 1]["args"][1]["name"] == "targ"
-        ):
-            whiteout_node_and_line(tokens, parsetree, node_index + 1)
-        else:
-            node_index += 1
-
-
 def whiteout_child_node_from_tokens(parent_node, child_node, tokens):
-    startp = parent_node["start_token"] + child_node["start_token_in_parent"]
-    endp = parent_node["start_token"] + child_node["end_token_in_parent"]
-    for j in range(startp, endp + 1):
-        tokens[j] = (TOK_WHITESPACE, "")
+    startp = parent_node.start_token + child_node.start_token_in_parent
+    endp = parent_node.start_token + child_node.end_token_in_parent
+    whiteout_tokens(tokens, startp, endp)
 
 
 def whiteout_node_and_line(tokens, nodes, node_index):
@@ -391,8 +1041,14 @@ def whiteout_node_and_line(tokens, nodes, node_index):
 
 
 def whiteout_node_and_line_from_tokens(node, tokens):
-    startp = node["start_token"]
-    endp = node["end_token"]
+    whiteout_tokens(tokens, *node_and_line_extent(node, tokens))
+
+
+def node_and_line_extent(node, tokens):
+    # the tokens to white out to remove node, which is its whole line if it's
+    # on its own line
+    startp = node.start_token
+    endp = node.end_token
 
     newstartp = startp
     while newstartp > 0 and tokens[newstartp - 1][0] == TOK_WHITESPACE:
@@ -411,110 +1067,251 @@ def whiteout_node_and_line_from_tokens(node, tokens):
         startp = newstartp
         endp = newendp
 
-    for j in range(startp, endp + 1):
-        tokens[j] = (TOK_WHITESPACE, "")
-
-
-def remove_double_targ(tokens, parsetree):
-    node_index = 0
-    while node_index < len(parsetree) - 1:
-        if (
-            parsetree[node_index]["type"] == "Command"
-            and parsetree[node_index]["name"] == "targ"
-            and parsetree[node_index + 1]["type"] == "Command"
-            and parsetree[node_index + 1]["name"] == "targ"
-        ):
-            whiteout_node_and_line(tokens, parsetree, node_index)
-        else:
-            node_index += 1
+    return (startp, endp)
 
-    node_index = 0
-    while node_index < len(parsetree) - 2:
-        if (
-            parsetree[node_index]["type"] == "Command"
-            and parsetree[node_index]["name"] == "targ"
-            and parsetree[node_index]["args"][0]["type"] == "Command"
-            and len(parsetree[node_index]["args"][0]["args"]) == 0
-            and parsetree[node_index + 1]["type"] == "Command"
-            and parsetree[node_index + 1]["name"] == "setv"
-            and parsetree[node_index + 2]["type"] == "Command"
-            and parsetree[node_index + 2]["name"] == "targ"
-            and parsetree[node_index + 2]["args"][0]["type"] == "Command"
-            and parsetree[node_index + 2]["args"][0]["name"]
-            == parsetree[node_index]["args"][0]["name"]
-        ):
-            whiteout_node_and_line(tokens, parsetree, node_index + 2)
-        else:
-            node_index += 1
 
+def whiteout_tokens(tokens, startp, endp):
+    if isinstance(tokens, TokenBuffer):
+        tokens.whiteout(startp, endp + 1)
+    else:
+        for j in range(startp, endp + 1):
+            tokens[j] = (TOK_WHITESPACE, "")
+
+
+# TARG gets tracked through each script, forwards, as an id for the agent it
+# holds, along with the ids of the agents in script variables, so a targ or a
+# seta of targ that wouldn't change anything can go. A targ nothing reads
+# before the next one can go too, and so can a seta of targ nothing reads
+# before the variable is set again. The ones explicit_targs put in can also go
+# if nothing reads them before the end of the script. The toplevel code around
+# a scrp is all one script, carrying on after the endm. Doifs carry on
+# with what every branch agrees on, loops and anything that might jump start
+# over, and removing things can make more removable, so it goes round again
+# until nothing changes.
+#
+# Agents that are the same all through a script, as far as TARG is concerned
+_AGENT_CONSTANTS = ("ownr", "from", "null", "_p1_", "_p2_", "pntr")
+# Commands that work out a value without reading TARG, if their args don't
+_TARG_INDEPENDENT = _AGENT_CONSTANTS + ("hots", "norn", "_it_", "avar", "game", "rand")
+# Statements that read and change nothing, TARG included, apart from their args
+_TARG_TRANSPARENT = ("inst", "slow", "wait")
+# Commands that set TARG to some other agent
+_TARG_SETTING = ("rtar", "star", "ttar")
+
+
+def variable_node_key(node):
+    # variable_key for a node that's a script variable, or None
+    if isinstance(node, Variable):
+        return variable_key(node.value)
+    if isinstance(node, Command) and re.match(r"^va\d\d$", node.name):
+        return node.name
+    return None
+
+
+def is_generated(node):
+    # whether node is one of the variables explicit_targs makes up
+    key = variable_node_key(node)
+    return key is not None and key.startswith("$__")
+
+
+def reads_targ_through_args(node):
+    # whether node only reads TARG if one of its args does
+    return isinstance(node, Condition) or (
+        isinstance(node, Command)
+        and (
+            node.name in _TARG_INDEPENDENT
+            or re.match(r"^(va|mv)\d\d$", node.name)
+        )
+    )
 
-def expand_agentvariables(tokens, parsetree):
 
-    # build object variable mapping
-    var_mapping = {}
-    for toplevel in parsetree:
-        if not toplevel["type"] == "AgentVariableDefinition":
+def reads_targ(node):
+    if isinstance(node, (Literal, Variable, ConditionKeyword, Constant)):
+        return False
+    if reads_targ_through_args(node):
+        return any(reads_targ(_) for _ in node.args)
+    return True
+
+
+def variables_read(node, keys):
+    key = variable_node_key(node)
+    if key is not None:
+        keys.append(key)
+    elif isinstance(node, (CommandBase, Condition)):
+        for a in node.args:
+            variables_read(a, keys)
+    return keys
+
+
+def remove_redundant_targs(tokens, parsetree):
+    while _remove_redundant_targs(tokens, parsetree):
+        pass
+
+
+def _remove_redundant_targs(tokens, parsetree):
+    # Returns whether it removed anything
+    ids = itertools.count()
+    # "targ" or a variable key -> the id of the agent it holds
+    values = {}
+    # for each doif around this node, values at the start of it and at the
+    # end of each branch so far, and whether it has an else
+    frames = []
+    # the last targ, if nothing's read TARG since, and what TARG was before it
+    last_targ = None
+    before_last_targ = None
+    # variable key -> the last seta of targ to it, if nothing's read it since
+    saves = {}
+    removed = []
+
+    def value_of(node):
+        key = variable_node_key(node)
+        if key is not None:
+            if key not in values:
+                values[key] = next(ids)
+            return values[key]
+        if isinstance(node, Command) and node.name in _AGENT_CONSTANTS:
+            return node.name
+        if isinstance(node, Command) and node.name == "targ" and not node.args:
+            if "targ" not in values:
+                values["targ"] = next(ids)
+            return values["targ"]
+        return next(ids)
+
+    # what the toplevel code had going when a scrp started, it carries on
+    # after the endm
+    toplevel = None
+
+    def end_of_script():
+        # nothing can read TARG or the VAxx after this. Only the saves and
+        # restores explicit_targs put in go, a targ the user wrote stays
+        if last_targ is not None and is_generated(parsetree[last_targ].args[0]):
+            removed.append(last_targ)
+        removed.extend(saves[_] for _ in saves if _.startswith("$__"))
+
+    for node_index, node in enumerate(parsetree):
+        if not isinstance(node, Command):
             continue
-        var_mapping[toplevel["name"]] = toplevel["value"]
-
-        whiteout_node_and_line_from_tokens(toplevel, tokens)
-
-    # do replacements
-    def visit(node, toplevel_node):
-        if node["type"] == "DotVariable":
-            insertion_point = node["start_token_in_parent"]
-            variable_index = var_mapping[node["name"]][2:4]
-            whiteout_child_node_from_tokens(toplevel_node, node, tokens)
-
-            if node["targ"] == "targ":
-                return [(insertion_point, generate_snippet("ov" + variable_index))]
-            elif node["targ"] == "ownr":
-                return [(insertion_point, generate_snippet("mv" + variable_index))]
-            else:
-                return [
-                    (
-                        insertion_point,
-                        generate_snippet(
-                            "avar {} {}".format(node["targ"], variable_index)
-                        ),
-                    )
-                ]
-        elif node.get("args"):
-            insertions = []
-            for a in node["args"]:
-                insertions += visit(a, toplevel_node)
-            return insertions
+        name = node.name
+        target = assigned_variable(node)
+        if name == "targ" and len(node.args) == 1:
+            value = value_of(node.args[0])
+            redundant = values.get("targ") == value
+            if not redundant and last_targ is not None:
+                # nothing read the last one, so without it TARG would still be
+                # what it was before
+                removed.append(last_targ)
+                last_targ = None
+                redundant = before_last_targ == value
+                if before_last_targ is None:
+                    del values["targ"]
+                else:
+                    values["targ"] = before_last_targ
+        elif name == "seta" and target is not None:
+            source = node.args[1]
+            redundant = (
+                isinstance(source, Command)
+                and source.name == "targ"
+                and values.get(target) == value_of(source)
+            )
         else:
-            return []
+            redundant = False
+        if redundant:
+            # it doesn't even count as reading anything
+            removed.append(node_index)
+            continue
 
-    node_index = 0
-    while node_index < len(parsetree):
-        toplevel = parsetree[node_index]
-        insertions = []
-        for a in toplevel.get("args", []):
-            insertions += visit(a, toplevel)
-
-        if insertions:
-            for insertion_point, toks in reversed(insertions):
-                for t in reversed(toks):
-                    tokens.insert(insertion_point + toplevel["start_token"], t)
-
-            num_tokens_inserted = sum(len(_[1]) for _ in insertions)
-            add_token_offset_to_nodes(parsetree[node_index + 1 :], num_tokens_inserted)
-
-            reparsednodes = parse(
-                tokens[
-                    toplevel["start_token"] : toplevel["end_token"]
-                    + num_tokens_inserted
-                    + 1
-                ]
-                + [(TOK_EOI, "")]
-            )
-            add_token_offset_to_nodes(reparsednodes, toplevel["start_token"])
-            assert len(reparsednodes) == 1
-            parsetree[node_index] = reparsednodes[0]
+        args = node.args[1:] if name in _ASSIGNMENTS and target else node.args
+        if name == "scrp" and toplevel is None:
+            # the script doesn't run as part of the code around it, so whatever
+            # that had going is stashed below instead
+            pass
+        elif any(reads_targ(_) for _ in args) or not (
+            name in _PURE_STATEMENTS or name in _TARG_TRANSPARENT or name == "targ"
+        ):
+            last_targ = None
+        for a in args:
+            for key in variables_read(a, []):
+                saves.pop(key, None)
+
+        if name == "targ" and len(node.args) == 1:
+            last_targ = node_index
+            before_last_targ = values.get("targ")
+            values["targ"] = value
+        elif target is not None:
+            if target in saves and name in _ASSIGNMENTS:
+                # nothing read the one before
+                removed.append(saves.pop(target))
+            if name != "seta":
+                values[target] = next(ids)
+                continue
+            source = node.args[1]
+            if isinstance(source, Command) and source.name == "targ":
+                saves[target] = node_index
+            values[target] = value_of(source)
+        elif name in _PURE_STATEMENTS or name in _TARG_TRANSPARENT:
+            pass
+        elif name in ("doif", "elif", "else", "endi"):
+            last_targ = None
+            saves.clear()
+            if name == "doif":
+                frames.append([dict(values), [], False])
+            elif name in ("elif", "else") and frames:
+                frame = frames[-1]
+                frame[1].append(dict(values))
+                values.clear()
+                values.update(frame[0])
+                frame[2] = frame[2] or name == "else"
+            elif name == "endi" and frames:
+                (before, branches, has_else) = frames.pop()
+                branches.append(dict(values))
+                if not has_else:
+                    branches.append(before)
+                values.clear()
+                values.update(
+                    _
+                    for _ in branches[0].items()
+                    if all(branch.get(_[0]) == _[1] for branch in branches[1:])
+                )
+        elif name == "scrp" and toplevel is None:
+            toplevel = (dict(values), list(frames), last_targ, before_last_targ, saves)
+            last_targ = None
+            saves = {}
+            values.clear()
+            frames.clear()
+        elif name in ("endm", "stop") and toplevel is not None:
+            end_of_script()
+            last_targ = None
+            saves.clear()
+            values.clear()
+            if name == "endm":
+                (values, frames, last_targ, before_last_targ, saves) = toplevel
+                toplevel = None
+        elif name in ("endm", "stop", "scrp", "rscr"):
+            # e.g. the removal script starting, or the install script
+            # stopping part way through
+            last_targ = None
+            saves.clear()
+            values.clear()
+            if name != "stop":
+                frames.clear()
+        elif name in _LOOP_STARTS + _LOOP_ENDS + ("gsub", "subr", "retn", "call"):
+            # anything could have changed, and could get read
+            last_targ = None
+            saves.clear()
+            values.clear()
+        else:
+            if name in _TARG_SETTING or name.startswith("new:"):
+                values["targ"] = next(ids)
+            # and it could set any variables it's given
+            for a in node.args:
+                values.pop(variable_node_key(a), None)
+    end_of_script()
 
-        node_index += 1
+    for node_index in sorted(set(removed), reverse=True):
+        whiteout_node_and_line_from_tokens(parsetree[node_index], tokens)
+    removed = set(removed)
+    parsetree[:] = [_ for (i, _) in enumerate(parsetree) if i not in removed]
+    return bool(removed)
 
 
 def strip_indent(tokens):
@@ -532,8 +1329,7 @@ def strip_indent(tokens):
 
         if tokens[startp][0] == TOK_WHITESPACE:
             tokens[startp] = (TOK_WHITESPACE, whitespace[len(indent) :])
-            for j in range(startp + 1, endp + 1):
-                tokens[j] = (TOK_WHITESPACE, "")
+            whiteout_tokens(tokens, startp + 1, endp)
         else:
             # handle non-indented statements
             pass
@@ -559,96 +1355,112 @@ def add_indent(tokens, indent):
     return newtokens
 
 
+class Macro:
+    # A macro ready to be pasted in at each call: variables are what its
+    # arguments get set in, and body has those swapped in for the arguments
+    # and its indentation stripped
+    __slots__ = ["name", "argnames", "variables", "body"]
+
+    def __init__(self, name, argnames, variables, body):
+        self.name = name
+        self.argnames = argnames
+        self.variables = variables
+        self.body = body
+
+    def __repr__(self):
+        return "Macro(%r)" % self.name
+
+
+def make_macro(name, argnames, body):
+    for a in argnames:
+        if a[0] == "$":
+            raise Exception("Macro argument name mustn't start with '$', got %r" % a)
+
+    # TODO: better way to make sure these don't conflict with user variables
+    variables = ["$__macro_{}_{}".format(name, a) for a in argnames]
+    argnames_to_variables = {"$" + a: n for (a, n) in zip(argnames, variables)}
+
+    # add EOI for strip_indent and then remove it, ugh
+    newbody = strip_indent(body + [(TOK_EOI, "")])[:-1]
+
+    for j in range(len(newbody)):
+        if newbody[j][0] == TOK_WORD and newbody[j][1] in argnames_to_variables:
+            newbody[j] = (TOK_WORD, argnames_to_variables[newbody[j][1]])
+    return Macro(name.lower(), argnames, variables, newbody)
+
+
+def macro_end_index(parsetree, p):
+    # the index of the endmacro for the macro starting at p
+    while True:
+        if p >= len(parsetree):
+            raise Exception("Didn't see 'endmacro'")
+        if isinstance(parsetree[p], MacroDefinitionEnd):
+            return p
+        p += 1
+
+
 def expand_macros(tokens, parsetree):
-    # collect macros
-    macros = []
+    # collect macros, including the ones from libraries
+    macros_by_name = {}
     p = 0
     while p < len(parsetree):
-        if parsetree[p]["type"] != "MacroDefinitionStart":
+        if isinstance(parsetree[p], Include):
+            macros_by_name.update(parsetree[p].library.macros)
             p += 1
             continue
-
-        start_node = parsetree[p]
-        for a in parsetree[p]["argnames"]:
-            if a[0] == "$":
-                raise Exception(
-                    "Macro argument name mustn't start with '$', got %r" % a
-                )
-        p += 1
-
-        while True:
-            if p >= len(tokens):
-                raise Exception("Didn't see 'endmacro'")
-            if parsetree[p]["type"] == "MacroDefinitionEnd":
-                break
+        if not isinstance(parsetree[p], MacroDefinitionStart):
             p += 1
+            continue
 
-        macros.append(
-            (
-                start_node["name"],
-                start_node["argnames"],
-                tokens[
-                    start_node["body_start_token"] : parsetree[p - 1]["end_token"] + 1
-                ],
-            )
+        start_node = parsetree[p]
+        p = macro_end_index(parsetree, p + 1)
+        macro = make_macro(
+            start_node.name,
+            start_node.argnames,
+            tokens[start_node.body_start_token : parsetree[p - 1].end_token + 1],
         )
+        macros_by_name[macro.name] = macro
         p += 1
 
-    # fixup macros
-    for i in range(len(macros)):
-        (name, argnames, body) = macros[i]
-        newbody = body[:]
-        # TODO: better way to make sure these don't conflict with user variables
-        newargnames = ["$__macro_{}_{}".format(name, a) for a in argnames]
-        argnames_to_newargnames = {"$" + a: n for (a, n) in zip(argnames, newargnames)}
-
-        # add EOI for strip_indent and then remove it, ugh
-        newbody = strip_indent(newbody + [(TOK_EOI, "")])[:-1]
-
-        for j in range(len(newbody)):
-            if newbody[j][0] == TOK_WORD and newbody[j][1] in argnames_to_newargnames:
-                newbody[j] = (TOK_WORD, argnames_to_newargnames[newbody[j][1]])
-        macros[i] = (name, newargnames, newbody)
-
-    macros_by_name = {
-        name.lower(): (argnames, body) for (name, argnames, body) in macros
-    }
-
     # parse and do expansions
     last_macro_start_index = None
     node_index = 0
     while node_index < len(parsetree):
         toplevel = parsetree[node_index]
-        if toplevel["type"] == "MacroDefinitionEnd":
-            startp = parsetree[last_macro_start_index]["start_token"]
+        if isinstance(toplevel, MacroDefinitionEnd):
+            startp = parsetree[last_macro_start_index].start_token
             while startp > 0 and tokens[startp - 1][0] == TOK_WHITESPACE:
                 startp -= 1
-            endp = toplevel["end_token"]
+            endp = toplevel.end_token
             while tokens[endp + 1][0] == TOK_WHITESPACE:
                 endp += 1
             if tokens[endp + 1][0] == TOK_NEWLINE:
                 endp += 1
-            for j in range(startp, endp + 1):
-                tokens[j] = (TOK_WHITESPACE, "")
+            whiteout_tokens(tokens, startp, endp)
             del parsetree[last_macro_start_index : node_index + 1]
             node_index = last_macro_start_index
+            last_macro_start_index = None
             continue
-        if toplevel["type"] == "MacroDefinitionStart":
+        if isinstance(toplevel, MacroDefinitionStart):
             last_macro_start_index = node_index
             node_index += 1
             continue
-        if toplevel["type"] != "Command":
+        if last_macro_start_index is not None:
+            # the whole definition gets whited out, don't bother expanding in it
             node_index += 1
             continue
-        if toplevel["name"].lower() not in macros_by_name:
+        if not isinstance(toplevel, Command):
+            node_index += 1
+            continue
+        if toplevel.name.lower() not in macros_by_name:
             node_index += 1
             continue
 
-        indent = get_indentation_at(tokens, toplevel["start_token"])
+        indent = get_indentation_at(tokens, toplevel.start_token)
 
-        argnames = macros_by_name[toplevel["name"].lower()][0]
-        for i, a in enumerate(toplevel["args"]):
-            argvar = argnames[i]
+        macro = macros_by_name[toplevel.name.lower()]
+        for i, a in enumerate(toplevel.args):
+            argvar = macro.variables[i]
 
             node_index = insert_before_node(
                 tokens,
@@ -661,81 +1473,603 @@ def expand_macros(tokens, parsetree):
             tokens,
             parsetree,
             node_index,
-            add_indent(macros_by_name[toplevel["name"].lower()][1], indent)
-            + [(TOK_NEWLINE, "\n")],
+            add_indent(macro.body, indent) + [(TOK_NEWLINE, "\n")],
         )
 
         whiteout_node_and_line(tokens, parsetree, node_index)
 
 
+# Libraries are files of definitions (constants, agent variables and macros)
+# that scripts pull in with 'include "path"'. Each one is only parsed once per
+# process, and what it defines (macro bodies ready to paste in, constant
+# values) is kept in a marshal file in a __pycache__ directory next to it, like
+# Python does for modules, so other runs don't parse it again either. A cached
+# library is used as long as its mtime and size match; if they don't, it's
+# hashed, and only parsed again if the contents really changed.
+#
+# The cache only holds a library's own definitions, and its includes by name,
+# so changing a library doesn't leave stale copies of it in everything that
+# includes it.
+LIBRARY_CACHE_VERSION = 1
+
+# finds includes in a source without parsing it, see included_libraries()
+INCLUDE_RE = re.compile(r'(?<!\S)include[ \t]+"([^"\n]*)"')
+
+
+class Library:
+    # files are (path, mtime, size) for the library and everything it
+    # includes, as they were when it was loaded. digest covers all of them
+    __slots__ = ["path", "digest", "files", "constants", "agent_variables", "macros"]
+
+    def __init__(self, path, digest, files, constants, agent_variables, macros):
+        self.path = path
+        self.digest = digest
+        self.files = files
+        self.constants = constants
+        self.agent_variables = agent_variables
+        self.macros = macros
+
+    def __repr__(self):
+        return "Library(%r)" % self.path
+
+    def changed(self):
+        for (path, mtime, size) in self.files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+                return True
+        return False
+
+
+def _pack_tokens(tokens):
+    return [(t[0].code, t[1]) for t in tokens]
+
+
+def _unpack_tokens(packed):
+    return [(TOKEN_TYPES[code], text) for (code, text) in packed]
+
+
+def library_definitions(text, variant=DEFAULT_VARIANT, include=None):
+    # Parses a library into a list of what it defines, in order, in a form
+    # marshal can store
+    tokens = TokenBuffer(lexcaos(text))
+    move_comments_to_own_line(tokens)
+    parsetree = parse(tokens, variant, include)
+
+    definitions = []
+    p = 0
+    while p < len(parsetree):
+        node = parsetree[p]
+        if isinstance(node, Include):
+            definitions.append(("include", node.path))
+        elif isinstance(node, ConstantDefinition):
+            definitions.append(("constant", node.name, _pack_tokens(node.values)))
+        elif isinstance(node, AgentVariableDefinition):
+            definitions.append(("agent_variable", node.name, node.value))
+        elif isinstance(node, MacroDefinitionStart):
+            p = macro_end_index(parsetree, p + 1)
+            macro = make_macro(
+                node.name,
+                node.argnames,
+                tokens[node.body_start_token : parsetree[p - 1].end_token + 1],
+            )
+            definitions.append(
+                (
+                    "macro",
+                    macro.name,
+                    macro.argnames,
+                    macro.variables,
+                    _pack_tokens(macro.body),
+                )
+            )
+        else:
+            raise Exception(
+                "Libraries can only contain definitions, got %r"
+                % tokens_to_string(tokens[node.start_token : node.end_token + 1])
+            )
+        p += 1
+    return definitions
+
+
+def find_library(name, include_dirs=(".",)):
+    if os.path.isabs(name):
+        if os.path.isfile(name):
+            return name
+        raise Exception("Can't find library %r" % name)
+    for directory in include_dirs:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    raise Exception(
+        "Can't find library %r, looked in %s" % (name, ", ".join(include_dirs))
+    )
+
+
+def _library_cache_path(path, variant):
+    return os.path.join(
+        os.path.dirname(path),
+        "__pycache__",
+        "{}.{}.{}.marshal".format(
+            os.path.basename(path), variant, sys.implementation.cache_tag
+        ),
+    )
+
+
+def _read_library_cache(path, variant):
+    try:
+        with open(path, "rb") as f:
+            cache = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not (
+        isinstance(cache, dict)
+        and cache.get("version") == LIBRARY_CACHE_VERSION
+        and cache.get("variant_hash") == get_variant(variant).hash
+        and cache.get("token_types") == [t.name for t in TOKEN_TYPES]
+    ):
+        return None
+    return cache
+
+
+def _write_library_cache(path, cache):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            marshal.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        # e.g. a read-only directory, just go without the cache
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+# (path, variant, include_dirs) -> Library
+_libraries = {}
+
+
+def _includer(variant, include_dirs, including=()):
+    # the include function for parse(), which loads libraries by name
+    def include(name):
+        return load_library(
+            find_library(name, include_dirs), variant, include_dirs, including
+        )
+
+    return include
+
+
+def load_library(path, variant=DEFAULT_VARIANT, include_dirs=(".",), including=()):
+    # Libraries a library includes are looked for next to it first, then in
+    # include_dirs. including is the libraries being loaded that led to this
+    # one, to catch libraries that include themselves
+    path = os.path.realpath(path)
+    include_dirs = tuple(include_dirs)
+    library = _libraries.get((path, variant, include_dirs))
+    if library is not None and not library.changed():
+        return library
+    if path in including:
+        raise Exception("Library %s includes itself" % path)
+    include = _includer(
+        variant, (os.path.dirname(path),) + include_dirs, including + (path,)
+    )
+
+    stat = os.stat(path)
+    cache_path = _library_cache_path(path, variant)
+    cache = _read_library_cache(cache_path, variant)
+    if not (
+        cache and (cache["mtime"], cache["size"]) == (stat.st_mtime_ns, stat.st_size)
+    ):
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if cache and cache["hash"] == digest:
+            definitions = cache["definitions"]
+        else:
+            definitions = library_definitions(data.decode("utf-8"), variant, include)
+            count(LIBRARIES_COMPILED)
+        cache = {
+            "version": LIBRARY_CACHE_VERSION,
+            "variant_hash": get_variant(variant).hash,
+            "token_types": [t.name for t in TOKEN_TYPES],
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": digest,
+            "definitions": definitions,
+        }
+        _write_library_cache(cache_path, cache)
+
+    # what included libraries define comes in where they're included, and
+    # later definitions replace earlier ones, same as in a script
+    h = hashlib.sha256(cache["hash"].encode("ascii"))
+    files = [(path, stat.st_mtime_ns, stat.st_size)]
+    constants = {}
+    agent_variables = {}
+    macros = {}
+    for definition in cache["definitions"]:
+        kind = definition[0]
+        if kind == "include":
+            included = include(definition[1])
+            h.update(included.digest.encode("ascii"))
+            files += included.files
+            constants.update(included.constants)
+            agent_variables.update(included.agent_variables)
+            macros.update(included.macros)
+        elif kind == "constant":
+            constants[definition[1]] = _unpack_tokens(definition[2])
+        elif kind == "agent_variable":
+            agent_variables[definition[1]] = definition[2]
+        elif kind == "macro":
+            (name, argnames, variables, body) = definition[1:]
+            macros[name] = Macro(name, argnames, variables, _unpack_tokens(body))
+
+    library = Library(
+        path, h.hexdigest(), tuple(files), constants, agent_variables, macros
+    )
+    _libraries[(path, variant, include_dirs)] = library
+    return library
+
+
+def included_libraries(source, variant=DEFAULT_VARIANT, include_dirs=(".",)):
+    # The libraries source includes, found without parsing it, for caches of
+    # compiled output that need to notice when a library changes. Anything
+    # that looks like an include but doesn't load gets skipped; compiling
+    # the source will say what's wrong with it
+    libraries = []
+    for name in INCLUDE_RE.findall(source):
+        try:
+            libraries.append(
+                load_library(find_library(name, include_dirs), variant, include_dirs)
+            )
+        except Exception:
+            continue
+    return libraries
+
+
+def remove_includes(tokens, parsetree):
+    # Everything that uses what libraries define has run by now
+    node_index = 0
+    while node_index < len(parsetree):
+        if isinstance(parsetree[node_index], Include):
+            whiteout_node_and_line(tokens, parsetree, node_index)
+        else:
+            node_index += 1
+
+
+def expand_agentvariables(tokens, parsetree):
+    replace_constants_and_agentvariables(tokens, parsetree, constants=False)
+
+
 def replace_constants(tokens, parsetree):
+    replace_constants_and_agentvariables(tokens, parsetree, agentvariables=False)
+
+
+def find_dotvariables(node):
+    if isinstance(node, DotVariable):
+        return [node]
+    elif isinstance(node, (CommandBase, Condition)):
+        dotvariables = []
+        for a in node.args:
+            dotvariables += find_dotvariables(a)
+        return dotvariables
+    else:
+        return []
+
+
+def replace_constants_and_agentvariables(
+    tokens, parsetree, constants=True, agentvariables=True
+):
+    # Both of these only ever swap out leaves of a toplevel command, so they're
+    # done together: one walk over the parsetree, one splice per command
+
+    # build object variable mapping, these can be used before they're defined
+    var_mapping = {}
+    if agentvariables:
+        for toplevel in parsetree:
+            if isinstance(toplevel, AgentVariableDefinition):
+                var_mapping[toplevel.name] = toplevel.value
+            elif isinstance(toplevel, Include):
+                var_mapping.update(toplevel.library.agent_variables)
+
+    # Definitions only get whited out at the end. Working out whether one is on
+    # its own line looks back over the whitespace before it, which would mean
+    # walking over every definition already whited out right before it
+    definition_extents = []
 
     constant_definitions = {}  # TODO: expose from parse(tokens)
     node_index = 0
     while node_index < len(parsetree):
         toplevel = parsetree[node_index]
-        if toplevel["type"] == "ConstantDefinition":
-            whiteout_node_and_line(tokens, parsetree, node_index)
-            constant_definitions[toplevel["name"]] = toplevel["values"]
+        if constants and isinstance(toplevel, ConstantDefinition):
+            definition_extents.append(node_and_line_extent(toplevel, tokens))
+            del parsetree[node_index]
+            constant_definitions[toplevel.name] = toplevel.values
             continue
+        if constants and isinstance(toplevel, Include):
+            constant_definitions.update(toplevel.library.constants)
 
-        insertions = []
-        for i, t in enumerate(
-            tokens[toplevel["start_token"] : toplevel["end_token"] + 1]
-        ):
-            if not (t[0] == TOK_WORD and t[1][0] == ":"):
-                continue
-            values = []
-            for v in constant_definitions[t[1]]:
-                if values:
-                    values.append((TOK_WHITESPACE, " "))
-                values.append(v)
-            insertions.append((i, values))
-            tokens[toplevel["start_token"] + i] = (TOK_WHITESPACE, "")
-
-        if insertions:
-            for insertion_point, toks in reversed(insertions):
-                for t in reversed(toks):
-                    tokens.insert(insertion_point + toplevel["start_token"], t)
-
-            num_tokens_inserted = sum(len(_[1]) for _ in insertions)
-            add_token_offset_to_nodes(parsetree[node_index + 1 :], num_tokens_inserted)
-
-            reparsednodes = parse(
-                tokens[
-                    toplevel["start_token"] : toplevel["end_token"]
-                    + num_tokens_inserted
-                    + 1
-                ]
-                + [(TOK_EOI, "")]
+        if not isinstance(toplevel, CommandBase):
+            node_index += 1
+            continue
+
+        constant_edits = []
+        if constants:
+            for i, t in enumerate(
+                tokens[toplevel.start_token : toplevel.end_token + 1]
+            ):
+                if not (t[0] == TOK_WORD and t[1][0] == ":"):
+                    continue
+                values = []
+                for v in constant_definitions[t[1]]:
+                    if values:
+                        values.append((TOK_WHITESPACE, " "))
+                    values.append(v)
+                constant_edits.append((i, 1, values))
+                whiteout_tokens(
+                    tokens, toplevel.start_token + i, toplevel.start_token + i
+                )
+
+        dotvariable_edits = []
+        if agentvariables:
+            for node in find_dotvariables(toplevel):
+                variable_index = var_mapping[node.name][2:4]
+                whiteout_child_node_from_tokens(toplevel, node, tokens)
+
+                if node.targ == "targ":
+                    snippet = generate_snippet("ov" + variable_index)
+                elif node.targ == "ownr":
+                    snippet = generate_snippet("mv" + variable_index)
+                else:
+                    snippet = generate_snippet(
+                        "avar {} {}".format(node.targ, variable_index)
+                    )
+                dotvariable_edits.append(
+                    (
+                        node.start_token_in_parent,
+                        node.end_token_in_parent - node.start_token_in_parent + 1,
+                        snippet,
+                    )
+                )
+
+        if not (constant_edits or dotvariable_edits):
+            node_index += 1
+            continue
+
+        edits = sorted(constant_edits + dotvariable_edits, key=lambda _: _[0])
+        starts = splice_into_toplevel(tokens, parsetree, node_index, edits)
+        if constant_edits:
+            # the parser left a Constant node for each of these, in the same order
+            replace_child_nodes(
+                toplevel,
+                Constant,
+                iter(
+                    [literal_node(v) for v in values if v[0] != TOK_WHITESPACE]
+                    for (i, replaced, values) in constant_edits
+                ),
             )
-            add_token_offset_to_nodes(reparsednodes, toplevel["start_token"])
-            assert len(reparsednodes) == 1
-            parsetree[node_index] = reparsednodes[0]
+        if dotvariable_edits:
+            starts_by_position = {e[0]: start for (e, start) in zip(edits, starts)}
+            replacements = []
+            for (position, replaced, snippet) in dotvariable_edits:
+                newnode = parse_expression(
+                    snippet + [(TOK_EOI, "")], variant_of(parsetree)
+                )
+                add_token_offset_to_child_nodes(
+                    [newnode], starts_by_position[position]
+                )
+                replacements.append([newnode])
+            count(NODES_REPARSED, len(replacements))
+            replace_child_nodes(toplevel, DotVariable, iter(replacements))
 
         node_index += 1
 
+    if agentvariables:
+        for toplevel in parsetree:
+            if isinstance(toplevel, AgentVariableDefinition):
+                definition_extents.append(node_and_line_extent(toplevel, tokens))
+    for (startp, endp) in definition_extents:
+        whiteout_tokens(tokens, startp, endp)
+
 
 def add_token_offset_to_nodes(nodes, offset):
     for n in nodes:
-        n["start_token"] += offset
-        n["end_token"] += offset
+        n.start_token += offset
+        n.end_token += offset
+        if isinstance(n, MacroDefinitionStart):
+            n.body_start_token += offset
+
+
+def add_token_offset_to_child_nodes(nodes, offset):
+    for n in nodes:
+        if isinstance(n, (CommandBase, DotVariable)):
+            n.start_token_in_parent += offset
+            n.end_token_in_parent += offset
+        if isinstance(n, (CommandBase, Condition)):
+            add_token_offset_to_child_nodes(n.args, offset)
+
+
+def replace_child_nodes(node, node_type, replacements):
+    # swaps each node of node_type under node for the next list of nodes from
+    # replacements, in the order they appear in the source
+    args = []
+    for a in node.args:
+        if isinstance(a, node_type):
+            args += next(replacements)
+        else:
+            if isinstance(a, (CommandBase, Condition)):
+                replace_child_nodes(a, node_type, replacements)
+            args.append(a)
+    node.args = args
+
+
+def splice_into_toplevel(tokens, parsetree, node_index, edits):
+    # Inserts tokens into the toplevel node at node_index, and works out where
+    # its child nodes are afterwards instead of reparsing it. Each edit is
+    # (position, replaced, snippet): the snippet goes in before the `replaced`
+    # tokens at `position` (relative to the start of the node), which should
+    # already be whited out. Edits must be in order. Returns where each snippet
+    # starts now, relative to the start of the node.
+    toplevel = parsetree[node_index]
+    for (position, replaced, snippet) in reversed(edits):
+        p = toplevel.start_token + position
+        tokens[p:p] = snippet
+    inserted = sum(len(_[2]) for _ in edits)
+    add_token_offset_from(parsetree, node_index + 1, inserted)
+    count(TOKENS_INSERTED, inserted)
+
+    def new_position(p, is_end):
+        shift = 0
+        for (position, replaced, snippet) in edits:
+            if position > p:
+                break
+            if is_end and p < position + replaced:
+                # ended on tokens that got whited out, so ends with the snippet now
+                return position + shift + len(snippet) - 1
+            shift += len(snippet)
+        return p + shift
+
+    def visit(node):
+        if isinstance(node, (CommandBase, DotVariable)):
+            node.start_token_in_parent = new_position(
+                node.start_token_in_parent, False
+            )
+            node.end_token_in_parent = new_position(node.end_token_in_parent, True)
+        if isinstance(node, (CommandBase, Condition)):
+            for a in node.args:
+                visit(a)
+
+    for a in toplevel.args:
+        visit(a)
+    toplevel.end_token = toplevel.start_token + new_position(
+        toplevel.end_token - toplevel.start_token, True
+    )
+
+    starts = []
+    shift = 0
+    for (position, replaced, snippet) in edits:
+        starts.append(position + shift)
+        shift += len(snippet)
+    return starts
+
+
+def variant_of(nodes):
+    if isinstance(nodes, NodeList):
+        return nodes.variant
+    return DEFAULT_VARIANT
+
+
+def add_token_offset_from(nodes, node_index, offset):
+    if isinstance(nodes, NodeList):
+        nodes.add_token_offset(node_index, offset)
+    else:
+        add_token_offset_to_nodes(nodes[node_index:], offset)
+
+
+class NodeList:
+    # The toplevel nodes of a parse tree, for passes that insert tokens as they
+    # go. Inserting tokens before a node shifts the token positions of that node
+    # and every node after it. Instead of renumbering them all straight away,
+    # the shift is kept pending for every node from pending_start onwards, and
+    # is applied to a node the first time it's read. Passes walk the tree front
+    # to back, so each node gets renumbered about once per pass rather than
+    # once per insertion.
+    #
+    # Nodes handed out earlier aren't updated by later shifts, so read a node
+    # back from the list after inserting before it.
+    __slots__ = ["nodes", "pending_start", "pending_offset", "variant"]
+
+    def __init__(self, nodes=(), variant=DEFAULT_VARIANT):
+        self.nodes = list(nodes)
+        self.pending_start = len(self.nodes)
+        self.pending_offset = 0
+        # the variant the nodes were parsed with, for parsing new snippets
+        self.variant = variant
+
+    def _apply_pending(self, stop):
+        if stop > self.pending_start:
+            if self.pending_offset:
+                add_token_offset_to_nodes(
+                    self.nodes[self.pending_start : stop], self.pending_offset
+                )
+            self.pending_start = stop
+        if self.pending_start >= len(self.nodes):
+            self.pending_offset = 0
+
+    def flush(self):
+        self._apply_pending(len(self.nodes))
+        return self.nodes
+
+    def add_token_offset(self, node_index, offset):
+        if not self.pending_offset:
+            self.pending_start = node_index
+        elif node_index >= self.pending_start:
+            self._apply_pending(node_index)
+        elif len(self.nodes) - self.pending_start < self.pending_start - node_index:
+            # a short pending tail is cheaper to apply than to work around
+            self.flush()
+            self.pending_start = node_index
+        else:
+            add_token_offset_to_nodes(
+                self.nodes[node_index : self.pending_start], offset
+            )
+        self.pending_offset += offset
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.flush())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self.nodes))
+            self._apply_pending(max(start, stop))
+            return self.nodes[i]
+        if i < 0:
+            i += len(self.nodes)
+        self._apply_pending(i + 1)
+        return self.nodes[i]
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self.nodes))
+            assert step == 1
+            stop = max(start, stop)
+            value = list(value)
+            self._apply_pending(stop)
+            self.nodes[start:stop] = value
+            self.pending_start += len(value) - (stop - start)
+        else:
+            self[i : (i % len(self.nodes)) + 1] = [value]
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            self[i] = []
+        else:
+            i %= len(self.nodes)
+            self[i : i + 1] = []
+
+    def insert(self, i, node):
+        self[i:i] = [node]
 
 
 def insert_before_node(tokens, nodes, node_index, snippet):
     if (
         any(_[0] not in (TOK_WHITESPACE, TOK_NEWLINE) for _ in snippet)
-        and nodes[node_index]["type"] == "Command"
-        and nodes[node_index]["name"] == "elif"
+        and isinstance(nodes[node_index], Command)
+        and nodes[node_index].name == "elif"
     ):
         # we need to turn the whole rest of this doif block into an else/doif,
         # so that we can actually add instructions before this elif
         elif_node = nodes[node_index]
         # change elif to a doif
-        tokens[elif_node["start_token"]] = (TOK_WORD, "doif")
-        elif_node["name"] = "doif"
+        tokens[elif_node.start_token] = (TOK_WORD, "doif")
+        elif_node.name = "doif"
         # add a new else before it
-        indent = get_indentation_at(tokens, elif_node["start_token"])
+        indent = get_indentation_at(tokens, elif_node.start_token)
         node_index = insert_before_node(
             tokens, nodes, node_index, generate_snippet(indent + "else\n" + "    "),
         )
@@ -749,19 +2083,20 @@ def insert_before_node(tokens, nodes, node_index, snippet):
         endi_snippet = generate_snippet(indent + "    endi\n")
         insert_before_node(tokens, nodes, endi_index, endi_snippet)
 
-    insertion_point = nodes[node_index]["start_token"]
+    insertion_point = nodes[node_index].start_token
     while tokens[insertion_point - 1][0] == TOK_WHITESPACE:
         insertion_point -= 1
 
-    for i, x in enumerate(snippet):
-        tokens.insert(insertion_point + i, x)
+    parsedsnippet = parse(snippet + [(TOK_EOI, "")], variant_of(nodes))
+    count(NODES_REPARSED, len(parsedsnippet))
+    count(TOKENS_INSERTED, len(snippet))
+
+    tokens[insertion_point:insertion_point] = snippet
     offset = len(snippet)
-    add_token_offset_to_nodes(nodes[node_index:], offset)
+    add_token_offset_from(nodes, node_index, offset)
 
-    parsedsnippet = parse(snippet + [(TOK_EOI, "")])
     add_token_offset_to_nodes(parsedsnippet, insertion_point)
-    for i, x in enumerate(parsedsnippet):
-        nodes.insert(node_index + i, x)
+    nodes[node_index:node_index] = parsedsnippet
 
     return node_index + len(parsedsnippet)
 
@@ -771,21 +2106,21 @@ def handle_condition_short_circuiting(tokens, parsetree):
     while node_index < len(parsetree):
         node = parsetree[node_index]
         if not (
-            node["type"] == "Command"
-            and len(node["args"]) == 1
-            and node["args"][0]["type"] == "Condition"
+            isinstance(node, Command)
+            and len(node.args) == 1
+            and isinstance(node.args[0], Condition)
         ):
             node_index += 1
             continue
 
-        condition_args = node["args"][0]["args"]
+        condition_args = node.args[0].args
         needs_short_circuit = len(condition_args) > 3
         if not needs_short_circuit:
             node_index += 1
             continue
 
         # this is the tricky part
-        conditionvar = "$__condition_" + str(node["start_token"])
+        conditionvar = "$__condition_" + str(node.start_token)
         snippet_parts = [
             "setv {} 0\n".format(conditionvar),
         ]
@@ -827,7 +2162,7 @@ def handle_condition_short_circuiting(tokens, parsetree):
                 assert False
             i += 3
             if i < len(condition_args):
-                combiner = condition_args[i]["value"].lower()
+                combiner = condition_args[i].value.lower()
                 i += 1
 
         # remove last newline, or the wrong indentation will be added to it
@@ -835,14 +2170,14 @@ def handle_condition_short_circuiting(tokens, parsetree):
             snippet_parts[-1] = snippet_parts[-1][:-1]
 
         # figure out indentation - if we're coming down a level, we want these insertions to be at the previous indentation
-        previous_indent = get_indentation_at_previous_line(tokens, node["start_token"])
-        current_indent = get_indentation_at(tokens, node["start_token"])
+        previous_indent = get_indentation_at_previous_line(tokens, node.start_token)
+        current_indent = get_indentation_at(tokens, node.start_token)
 
         if len(previous_indent) < len(current_indent):
             # if the previous indent is smaller, we just went up a level, so stay there
             previous_indent = current_indent
 
-        indent = get_indentation_at(tokens, node["start_token"])
+        indent = get_indentation_at(tokens, node.start_token)
 
         node_index = insert_before_node(
             tokens,
@@ -858,7 +2193,7 @@ def handle_condition_short_circuiting(tokens, parsetree):
             (
                 [(TOK_NEWLINE, "\n")]
                 + add_indent(
-                    generate_snippet("{} {} = 1".format(node["name"], conditionvar)),
+                    generate_snippet("{} {} = 1".format(node.name, conditionvar)),
                     indent,
                 )
                 + [(TOK_NEWLINE, "\n")]
@@ -867,38 +2202,138 @@ def handle_condition_short_circuiting(tokens, parsetree):
         whiteout_node_and_line(tokens, parsetree, node_index)
 
 
-def extendedcaos_to_caos(s):
-    tokens = lexcaos(s)
+class Pass:
+    # A transformation over (tokens, parsetree). requires names the passes that
+    # have to run before it
+    __slots__ = ["name", "function", "requires"]
 
-    # Move comments to own line first, so they stay before any additional lines
-    # that get added
-    move_comments_to_own_line(tokens)
+    def __init__(self, name, function, requires=()):
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
 
-    # Get the initial parsetree. Transformations will modify tokens and the parsetree
-    # at the same time
-    parsetree = parse(tokens)
+    def __repr__(self):
+        return "Pass({!r})".format(self.name)
 
+
+PASSES = [
     # Handle condition short-circuiting by extracting boolean logic and doing
     # it manually. This needs to come before macro expansion, explicit targs,
     # or any other transformation that modify the condition; otherwise, the
     # short-circuiting won't actually work
-    handle_condition_short_circuiting(tokens, parsetree)
+    Pass("short_circuit", handle_condition_short_circuiting),
+    Pass("macros", expand_macros, ["short_circuit"]),
+    Pass("explicit_targs", explicit_targs, ["short_circuit"]),
+    Pass("constants", replace_constants, ["short_circuit", "macros"]),
+    Pass("agent_variables", expand_agentvariables, ["short_circuit", "macros"]),
+    # Libraries' definitions get used by the passes above, so their includes
+    # can only go after those
+    Pass("includes", remove_includes, ["macros", "constants", "agent_variables"]),
+    # Explicit targ adds in a lot of cruft around saving targ and resetting
+    # targ. Remove whatever of it doesn't do anything, to make the end result
+    # smaller and easier to read and debug
+    Pass("redundant_targs", remove_redundant_targs, ["explicit_targs", "includes"]),
+    # Turn namedvariables to vaxx variables. This must come after all
+    # transformations that add new variables (targ saving, macro arguments,
+    # condition short circuiting, etc.
+    Pass(
+        "named_variables",
+        namedvariables_to_vaxx,
+        ["short_circuit", "macros", "explicit_targs", "redundant_targs"],
+    ),
+]
+
+# Passes that can share one walk over the parsetree, keyed by the names of the
+# passes they stand in for. They're only used when those passes would have run
+# back to back anyway
+FUSED_PASSES = {
+    ("constants", "agent_variables"): replace_constants_and_agentvariables,
+}
+
+
+def schedule_passes(passes=PASSES, fused=FUSED_PASSES):
+    # Orders passes so each one comes after everything it requires, keeping
+    # the given order otherwise, then swaps runs of passes for fused ones
+    by_name = {p.name: p for p in passes}
+    order = []
+    visiting = set()
+
+    def visit(p):
+        if p in order:
+            return
+        if p.name in visiting:
+            raise Exception("Pass dependency cycle through {!r}".format(p.name))
+        visiting.add(p.name)
+        for name in p.requires:
+            if name not in by_name:
+                raise Exception(
+                    "Pass {!r} requires unknown pass {!r}".format(p.name, name)
+                )
+            visit(by_name[name])
+        visiting.discard(p.name)
+        order.append(p)
 
-    # Transformations in no particular order
-    expand_macros(tokens, parsetree)
-    explicit_targs(tokens, parsetree)
-    replace_constants(tokens, parsetree)
-    expand_agentvariables(tokens, parsetree)
+    for p in passes:
+        visit(p)
 
-    # Explicit targ adds in a lot of cruft around saving targ and resetting
-    # targ. Try to remove the cruft when possible to make the end result
-    # easier to read and debug
-    remove_extraneous_targ_saving(tokens, parsetree)
-    remove_double_targ(tokens, parsetree)
+    schedule = []
+    i = 0
+    while i < len(order):
+        for names, function in fused.items():
+            if tuple(p.name for p in order[i : i + len(names)]) == names:
+                schedule.append(
+                    Pass(
+                        "+".join(names),
+                        function,
+                        [r for p in order[i : i + len(names)] for r in p.requires],
+                    )
+                )
+                i += len(names)
+                break
+        else:
+            schedule.append(order[i])
+            i += 1
+    return schedule
+
+
+SCHEDULE = schedule_passes()
+
+
+def run_passes(tokens, parsetree, schedule=SCHEDULE):
+    for p in schedule:
+        with timer(p.name):
+            p.function(tokens, parsetree)
+
+
+def extendedcaos_to_caos(
+    s, variant=DEFAULT_VARIANT, timings=None, profile=None, include_dirs=(".",)
+):
+    # If timings is a dict, it gets the time spent in each pass, in seconds. A
+    # caosprofile.Profile gets those, the pass callbacks and the counters too.
+    # Included libraries are looked for in include_dirs
+    if profile is None and timings is not None:
+        profile = Profile()
+
+    with profiling(profile):
+        with timer("parse"):
+            tokens = TokenBuffer(lexcaos(s))
+
+            # Move comments to own line first, so they stay before any additional
+            # lines that get added
+            move_comments_to_own_line(tokens)
+
+            # Get the initial parsetree. Transformations will modify tokens and the
+            # parsetree at the same time
+            parsetree = NodeList(
+                parse(tokens, variant, _includer(variant, tuple(include_dirs))),
+                variant,
+            )
+
+        run_passes(tokens, parsetree)
 
-    # Turn namedvariables to vaxx variables. This must come after all transformations
-    # that add new variables (targ saving, macro arguments, condition short
-    # circuiting, etc.
-    namedvariables_to_vaxx(tokens, parsetree)
+        with timer("render"):
+            result = tokens_to_string(tokens)
 
-    return tokens_to_string(tokens)
+    if timings is not None:
+        timings.update(profile.timings)
+    return result
@@ -1,19 +1,160 @@
+import argparse
+import os
 import sys
+from caosbatch import compile_files, include_dirs_for
+from caoscache import DEFAULT_CACHE_DIR, compile_cached
+from caoscommandinfo import DEFAULT_VARIANT, VARIANTS
+from caosprofile import Profile
+from caosserver import CompileService, parse_address, serve
+from caoswatch import watch
 from extendedcaos import extendedcaos_to_caos
 
 
 def main():
-    if len(sys.argv) == 2:
-        with open(sys.argv[1]) as f:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "files",
+        nargs="*",
+        metavar="FILE",
+        help="files or directories to compile, reads from stdin if there are none",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="write compiled files here instead of next to the originals",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of files to compile at once, defaults to the number of CPUs",
+    )
+    parser.add_argument("--variant", choices=VARIANTS, default=DEFAULT_VARIANT)
+    parser.add_argument(
+        "-I",
+        "--include-dir",
+        action="append",
+        default=[],
+        dest="include_dirs",
+        metavar="DIR",
+        help="look for included libraries here too, after the source's directory",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        nargs="?",
+        const=DEFAULT_CACHE_DIR,
+        help="reuse compiled output for unchanged sources, kept in this directory "
+        "(default %s)" % DEFAULT_CACHE_DIR,
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print how long each pass took, and what it did, to stderr",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running, and recompile files whenever they change",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="how often --watch checks for changes, in seconds (default 0.5)",
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="ADDRESS",
+        help="keep running, and compile sources sent to this Unix socket path or "
+        "host:port",
+    )
+    args = parser.parse_args()
+
+    if args.serve:
+        if args.files or args.watch or args.profile:
+            parser.error("--serve doesn't take files, --watch or --profile")
+        address = parse_address(args.serve)
+        sys.stderr.write("Serving on %s\n" % (args.serve,))
+        try:
+            serve(
+                address,
+                CompileService((args.variant,), args.cache_dir, args.include_dirs),
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.watch:
+        if not args.files:
+            parser.error("--watch needs files or directories to watch")
+        if args.profile:
+            parser.error("--profile doesn't work with --watch")
+
+        def report(result):
+            if result.error:
+                sys.stderr.write(result.error + "\n")
+            else:
+                sys.stderr.write("Compiled %s\n" % result.destination)
+
+        try:
+            watch(
+                args.files,
+                args.output_dir,
+                args.variant,
+                args.interval,
+                report,
+                args.include_dirs,
+            )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # A single file gets printed, anything more gets compiled to files
+    batch = (
+        len(args.files) > 1
+        or args.output_dir is not None
+        or any(os.path.isdir(_) for _ in args.files)
+    )
+    if batch:
+        if args.profile:
+            parser.error("--profile only works when compiling a single file")
+        failed = False
+        for result in compile_files(
+            args.files,
+            args.output_dir,
+            args.jobs,
+            args.variant,
+            args.cache_dir,
+            args.include_dirs,
+        ):
+            if result.error:
+                sys.stderr.write(result.error + "\n")
+                failed = True
+        if failed:
+            exit(1)
+        return
+
+    if args.files:
+        with open(args.files[0]) as f:
             text = f.read()
-    elif len(sys.argv) == 1:
+        include_dirs = include_dirs_for(args.files[0], args.include_dirs)
+    else:
         sys.stderr.write("Reading from stdin...\n")
         text = sys.stdin.read()
-    else:
-        sys.stderr.write("USAGE: %s [FILE]" % sys.argv[0])
-        exit(1)
+        include_dirs = (".",) + tuple(args.include_dirs)
 
-    print(extendedcaos_to_caos(text))
+    if args.profile:
+        profile = Profile()
+        print(
+            extendedcaos_to_caos(
+                text, args.variant, profile=profile, include_dirs=include_dirs
+            )
+        )
+        sys.stderr.write(profile.format_table())
+    elif args.cache_dir:
+        print(compile_cached(text, args.variant, args.cache_dir, include_dirs))
+    else:
+        print(extendedcaos_to_caos(text, args.variant, include_dirs=include_dirs))
 
 
 if __name__ == "__main__":
@@ -1,5 +1,19 @@
 from extendedcaos import *
 from caoslexer import *
+import benchmark
+import caosbatch
+import caoscache
+import caoscommandinfo
+import caosincremental
+import caosprofile
+import caosserver
+import caoswatch
+import io
+import json
+import os
+import re
+import tempfile
+import threading
 import unittest
 
 
@@ -76,7 +90,7 @@ class TestExtendedCAOS(unittest.TestCase):
             sets va00 5
             setv va00 "world"
             setv va01 8
-            setv va02 "world"
+            setv va00 "world"
     
             scrp 1 2 3 1000
                 setv va00 0
@@ -89,8 +103,8 @@ class TestExtendedCAOS(unittest.TestCase):
                 setv va00 0
                 setv va01 1
                 setv va02 2
-                setv va03 3
-                setv va04 4
+                setv va01 3
+                setv va01 4
             endm
     
             scrp 1 2 3 1002
@@ -115,15 +129,12 @@ class TestExtendedCAOS(unittest.TestCase):
             dbg: outv from.angl 0 0
         """
         desired_output = """
-            seta va00 targ
             targ from
             mvsf 5 6
             targ ownr
             mvsf 6 5
             targ from
-            setv va01 angl 0 0
-            targ va00
-            dbg: outv va01
+            dbg: outv angl 0 0
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -144,14 +155,12 @@ class TestExtendedCAOS(unittest.TestCase):
             dbg: outv from.angl va00.posx va00.posy
         """
         desired_output = """
-            seta va01 targ
             targ va00
-            setv va02 posx
-            setv va03 posy
+            setv va01 posx
+            setv va02 posy
             targ from
-            setv va04 angl va02 va03
-            targ va01
-            dbg: outv va04
+            setv va03 angl va01 va02
+            dbg: outv va03
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -173,21 +182,10 @@ class TestExtendedCAOS(unittest.TestCase):
             seta va99 $targetring.carr
         """
         desired_output = """
-            seta va00 targ
-            targ va01
-            setv va02 movs
-            targ va00
-            dbg: outv va02
-            seta va00 targ
-            targ va01
-            sets va03 gall
-            targ va00
-            dbg: outs va03
-            seta va00 targ
-            targ va01
-            seta va04 carr
             targ va00
-            seta va99 va04
+            dbg: outv movs
+            dbg: outs gall
+            seta va99 carr
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -222,6 +220,181 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
+    def test_explicit_targ_reuses_values(self):
+        # ownr.posy is still good in the doif, but mvsf could have changed it,
+        # and $agent.posx isn't the same after $agent is set
+        input = """
+            doif ownr.posy > 5
+                dbg: outv ownr.posy
+            else
+                mvsf 1 2
+            endi
+            dbg: outv ownr.posy
+            dbg: outv ownr.posy
+            seta $agent ownr
+            dbg: outv $agent.posx
+            seta $agent from
+            dbg: outv $agent.posx
+        """
+        desired_output = """
+            seta va00 targ
+            targ ownr
+            setv va01 posy
+            targ va00
+            doif va01 > 5
+                dbg: outv va01
+            else
+                mvsf 1 2
+            endi
+            targ ownr
+            dbg: outv posy
+            dbg: outv posy
+            seta va00 ownr
+            dbg: outv posx
+            seta va00 from
+            targ va00
+            dbg: outv posx
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+    def test_explicit_targ_agent_variable_assignment(self):
+        # setting ov00 could change ownr.ov00, so it gets worked out again
+        input = """
+            doif ownr.ov00 = 1
+                setv ov00 5
+                dbg: outv ownr.ov00
+            endi
+        """
+        desired_output = """
+            seta va00 targ
+            targ ownr
+            doif type ov00 = 0 or type ov00 = 1
+                setv va01 ov00
+            elif type ov00 = 2
+                sets va01 ov00
+            else
+                seta va01 ov00
+            endi
+            targ va00
+            doif va01 = 1
+                setv ov00 5
+                targ ownr
+                dbg: outv ov00
+                targ va00
+            endi
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+        # and so could setting any of TARG's own, like attr and velx
+        input = """
+        scrp 1 2 3 4
+            doif ownr.attr > 1
+                setv attr 5
+            endi
+            doif ownr.attr > 1
+                addv velx 1
+            endi
+            doif ownr.velx > 1
+                addv velx 1
+            endi
+            doif ownr.velx > 1
+                stop
+            endi
+        endm
+        """
+        desired_output = """
+        scrp 1 2 3 4
+            seta va00 targ
+            targ ownr
+            doif type attr = 0 or type attr = 1
+                setv va01 attr
+            elif type attr = 2
+                sets va01 attr
+            else
+                seta va01 attr
+            endi
+            targ va00
+            doif va01 > 1
+                setv attr 5
+            endi
+            targ ownr
+            doif type attr = 0 or type attr = 1
+                setv va01 attr
+            elif type attr = 2
+                sets va01 attr
+            else
+                seta va01 attr
+            endi
+            targ va00
+            doif va01 > 1
+                addv velx 1
+            endi
+            targ ownr
+            doif type velx = 0 or type velx = 1
+                setv va01 velx
+            elif type velx = 2
+                sets va01 velx
+            else
+                seta va01 velx
+            endi
+            targ va00
+            doif va01 > 1
+                addv velx 1
+            endi
+            targ ownr
+            doif type velx = 0 or type velx = 1
+                setv va01 velx
+            elif type velx = 2
+                sets va01 velx
+            else
+                seta va01 velx
+            endi
+            targ va00
+            doif va01 > 1
+                stop
+            endi
+        endm
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+    def test_explicit_targ_groups_dot_commands(self):
+        # $a has to be targ'd again after it's set, and posx on its own needs
+        # the TARG from before
+        input = """
+            $a.mvsf 1 2
+            setv $x $a.posx
+            setv $y rand $a.posy $x
+            dbg: outv $b.posx
+            seta $a $a.carr
+            dbg: outv $a.posx
+            setv $z posx
+            dbg: outv $a.posy
+            dbg: outv ownr.posx
+            kill $a
+        """
+        desired_output = """
+            seta va00 targ
+            targ va01
+            mvsf 1 2
+            setv va02 posx
+            setv va03 rand posy va02
+            targ va04
+            dbg: outv posx
+            targ va01
+            seta va01 carr
+            targ va01
+            dbg: outv posx
+            targ va00
+            setv va02 posx
+            targ va01
+            dbg: outv posy
+            targ ownr
+            dbg: outv posx
+            targ va00
+            kill va01
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
     def test_explicit_targ_other_commands(self):
         input = """
             $targetring.tick tick
@@ -233,13 +406,11 @@ class TestExtendedCAOS(unittest.TestCase):
             targ va02
             tick va00
             targ va01
-            setv va03 posx
-            setv va04 posy
-            seta va01 targ
+            setv va00 posx
+            setv va01 posy
             targ va02
-            setv va05 tmvt va03 va04
-            targ va01
-            dbg: outv va05
+            setv va02 tmvt va00 va01
+            dbg: outv va02
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -285,6 +456,73 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
+    def test_remove_redundant_targs(self):
+        input = """
+            targ va00
+            * a comment
+            targ va00
+            doif va01 = 1
+                targ va00
+                setv va02 posx
+            else
+                inst
+                targ va00
+            endi
+            targ va00
+            seta va03 targ
+            enum 2 0 0
+                seta va04 targ
+            next
+            targ va03
+            new: simp 2 5 7 "blnk" 1 0 0
+            targ va03
+            kill targ
+        """
+        desired_output = """
+            targ va00
+            * a comment
+            doif va01 = 1
+                setv va02 posx
+            else
+                inst
+            endi
+            seta va03 targ
+            enum 2 0 0
+                seta va04 targ
+            next
+            targ va03
+            new: simp 2 5 7 "blnk" 1 0 0
+            targ va03
+            kill targ
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+    def test_remove_redundant_targs_around_scrp(self):
+        # the toplevel code carries on after the endm, and the script doesn't
+        # run in between, so nothing reads TARG being norn, and it's still $saved
+        input = """
+            seta $saved targ
+            targ norn
+            scrp 1 2 3 4
+                stop
+            endm
+            targ $saved
+            kill targ
+        """
+        desired_output = """
+            seta va00 targ
+            scrp 1 2 3 4
+                stop
+            endm
+            kill targ
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+        # a targ the user wrote stays, even if nothing reads it
+        self.assertMultiLineEqual(
+            "targ norn\n", extendedcaos_to_caos("targ ownr\ntarg norn\n")
+        )
+
     def test_object_variables(self):
         input = """
             agent_variable $bioenergy ov63
@@ -410,11 +648,8 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         desired_output = """
         seta va00 null
-        seta va01 targ
         targ va00
-        setv va02 clac
-        targ va01
-        dbg: outv va02
+        dbg: outv clac
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -430,18 +665,11 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         desired_output = """
         seta va00 null
-        seta va01 targ
         targ va00
-        setv va02 clac
-        targ va01
-        dbg: outv va02
+        dbg: outv clac
         
         seta va00 null
-        seta va01 targ
-        targ va00
-        setv va03 clac
-        targ va01
-        dbg: outv va03
+        dbg: outv clac
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -488,6 +716,35 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
+    def test_replacements_match_reparse(self):
+        input = """
+        constant :foo 3
+        constant :pos 10 20
+        agent_variable $chem ov12
+        doif targ.$chem > :foo
+            setv targ.$chem ownr.$chem
+            mvsf :pos
+        endi
+        """
+        tokens = TokenBuffer(lexcaos(input))
+        parsetree = NodeList(parse(tokens))
+        replace_constants(tokens, parsetree)
+        expand_agentvariables(tokens, parsetree)
+        for node in parsetree:
+            if not isinstance(node, CommandBase):
+                continue
+            reparsed = parse(
+                tokens[node.start_token : node.end_token + 1] + [(TOK_EOI, "")]
+            )
+            add_token_offset_to_nodes(reparsed, node.start_token)
+            self.assertEqual([node], reparsed)
+
+        expression = parse_expression(lexcaos("avar targ 12"))
+        self.assertEqual("avar", expression.name)
+        self.assertEqual(LiteralInteger("12"), expression.args[1])
+        with self.assertRaises(Exception):
+            parse_expression(lexcaos("1 2"))
+
     def test_transform_elifs_into_elses(self):
         input = """
         doif 1 = 1
@@ -531,9 +788,9 @@ class TestExtendedCAOS(unittest.TestCase):
         doif va00 = 0
             seta va02 targ
             targ va01
-            setv va03 posy
+            setv va01 posy
             targ va02
-            doif posy > va03
+            doif posy > va01
                 setv va00 1
             endi
         endi
@@ -568,9 +825,9 @@ class TestExtendedCAOS(unittest.TestCase):
         doif va00 = 0
             seta va02 targ
             targ va01
-            setv va03 posy
+            setv va01 posy
             targ va02
-            doif posy > va03
+            doif posy > va01
                 setv va00 1
             endi
         endi
@@ -589,20 +846,20 @@ class TestExtendedCAOS(unittest.TestCase):
         desired_output = """
         loop
             dbg: outs "hello world"
-            setv va00 0
-            doif va01 = null
-                setv va00 1
+            setv va01 0
+            doif va00 = null
+                setv va01 1
             endi
-            doif va00 = 0
+            doif va01 = 0
                 seta va02 targ
-                targ va01
+                targ va00
                 setv va03 posy
                 targ va02
                 doif posy > va03
-                    setv va00 1
+                    setv va01 1
                 endi
             endi
-        untl va00 = 1
+        untl va01 = 1
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
@@ -617,9 +874,9 @@ class TestExtendedCAOS(unittest.TestCase):
         doif va00 = 0
             seta va02 targ
             targ va01
-            setv va03 posy
+            setv va01 posy
             targ va02
-            doif posy > va03
+            doif posy > va01
                 setv va00 1
             endi
         endi
@@ -627,6 +884,121 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
+    def test_named_variables_share_vaxx(self):
+        input = """
+        setv $count 0
+        reps 3
+            setv $temp 2
+            addv $count $temp
+        repe
+        setv $after 1
+        dbg: outv $count
+        addv $unset $after
+        """
+        # $temp is set before it's used on every time around the loop, so its
+        # VAxx is free again after, but $count's isn't. $unset relies on
+        # starting out as 0, so it can't have a VAxx anything else had
+        desired_output = """
+        setv va00 0
+        reps 3
+            setv va01 2
+            addv va00 va01
+        repe
+        setv va01 1
+        dbg: outv va00
+        addv va02 va01
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+        # temporaries used to run out after 100 explicit targs in one script
+        input = "seta $agent null\n" + "dbg: outv $agent.posx\nwait 1\n" * 150
+        output = extendedcaos_to_caos(input)
+        self.assertEqual({"va00"}, set(re.findall(r"va\d\d", output)))
+
+    def test_named_variables_spill(self):
+        # more live at once than there are VAxx
+        body = "".join("setv $v%d %d\n" % (i, i) for i in range(110))
+        body += "dbg: outv $v0\n"
+        body += "".join("dbg: outv $v%d\n" % i for i in reversed(range(110)))
+        mv_variables = "".join("spill_variable mv%d\n" % i for i in range(89, 100))
+        game_variables = "".join('spill_variable game "s%d"\n' % i for i in range(10))
+
+        # nothing gets spilled anywhere the file doesn't set aside for it
+        with self.assertRaisesRegex(Exception, "Couldn't allocate variable"):
+            extendedcaos_to_caos("scrp 2 14 1000 9\n" + body + "endm\n")
+
+        # $v0 is used the most, so it keeps its VAxx. Event scripts spill to
+        # the MVxx, other than ones they use themselves
+        output = extendedcaos_to_caos(
+            mv_variables + "scrp 2 14 1000 9\nsetv ov99 1\n" + body + "endm\n"
+        )
+        self.assertIn("setv va00 0\n", output)
+        self.assertEqual(
+            {"mv%d" % i for i in range(89, 99)}, set(re.findall(r"mv\d\d", output))
+        )
+        self.assertNotIn("spill_variable", output)
+
+        # injected scripts don't have an owner, so they get GAME variables, which
+        # get deleted at the end. Code after endm is still the install script
+        output = extendedcaos_to_caos(
+            mv_variables + game_variables + "scrp 2 14 1000 9\nstop\nendm\n" + body
+        )
+        self.assertEqual(
+            {'game "s%d"' % i for i in range(10)},
+            set(re.findall(r'game "\w+"', output)),
+        )
+        self.assertNotIn("mv", output)
+        self.assertNotIn("$", output)
+        self.assertTrue(
+            output.endswith("".join('delg "s%d"\n' % i for i in range(10)))
+        )
+
+        # the owner's variables could change under it in a CALLed script
+        with self.assertRaisesRegex(Exception, "Couldn't allocate variable"):
+            extendedcaos_to_caos(
+                mv_variables + "scrp 2 14 1000 9\ncall 1 0 0\n" + body + "endm\n"
+            )
+
+    def test_named_variables_spill_deleted_at_exits(self):
+        body = "".join("setv $v%d %d\n" % (i, i) for i in range(100))
+        body += "doif $x = 1\n    stop\nendi\n"
+        body += "".join("dbg: outv $v%d\n" % i for i in range(100))
+        output = extendedcaos_to_caos(
+            'spill_variable game "spill"\nsetv $x 1\n' + body + "rscr\nsetv $y 1\n"
+        )
+        self.assertIn('    delg "spill"\n    stop\n', output)
+        self.assertTrue(output.endswith('delg "spill"\nrscr\nsetv va00 1\n'))
+
+        # C2 has no DELG, and C1 no GAME or MVxx
+        with self.assertRaisesRegex(Exception, "DELG"):
+            extendedcaos_to_caos('spill_variable game "spill"\n', "c2")
+        with self.assertRaisesRegex(Exception, "MVxx"):
+            extendedcaos_to_caos("spill_variable mv99\n", "c1")
+
+    def test_named_variables_across_scrp(self):
+        # the install script carries on after endm, with the same variables
+        input = """
+        setv $z 1
+        scrp 2 2 2 1
+            setv $a 2
+            dbg: outv $a
+        endm
+        setv $w 3
+        dbg: outv $z
+        dbg: outv $w
+        """
+        desired_output = """
+        setv va00 1
+        scrp 2 2 2 1
+            setv va00 2
+            dbg: outv va00
+        endm
+        setv va01 3
+        dbg: outv va00
+        dbg: outv va01
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
     def test_get_indentation_at_previous_line_when_previous_line_is_blank(self):
         input = """
         endi
@@ -655,6 +1027,725 @@ class TestExtendedCAOS(unittest.TestCase):
         """
         self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
 
+    def test_lexer_matches_charwise_lexer(self):
+        inputs = [
+            'dbg: outs "a \\"quoted\\" string" * comment\r\n',
+            "setv va00 -5.25 setv va01 .5 setv va02 %0101 [bytes here] 'a' '\\''",
+            "doif $targ.posx <> 3 and ownr.$var >= -1 or :const <= 2\n",
+        ]
+        path = os.path.join(
+            os.path.dirname(__file__), "Elevines script - named variables.cos"
+        )
+        with open(path) as f:
+            inputs.append(f.read())
+        for s in inputs:
+            self.assertEqual(list(lexcaos_charwise(s)), lexcaos(s))
+
+    def test_lexer_errors(self):
+        inputs = ["stop\r", "setv va00 -", "setv va00 %", '"unterminated', "[abc"]
+        inputs += ["$", ":", "&", "ownr."]
+        for s in inputs:
+            with self.assertRaises(Exception) as expected:
+                list(lexcaos_charwise(s))
+            with self.assertRaises(Exception) as actual:
+                lexcaos(s)
+            self.assertEqual(str(expected.exception), str(actual.exception))
+
+    def test_lexer_stream(self):
+        s = 'dbg: outs "split [string]" * comment\r\n  [bytes] setv va00 -1.5\r\n'
+        for chunk_size in (1, 2, 3, 5, 64):
+            chunks = [s[i : i + chunk_size] for i in range(0, len(s), chunk_size)]
+            self.assertEqual(lexcaos(s), list(lexcaos_stream(chunks)))
+            self.assertEqual(
+                lexcaos(s), list(lexcaos_stream(io.StringIO(s), chunk_size))
+            )
+
+        with self.assertRaises(Exception):
+            list(lexcaos_stream(["stop\r", "stop"]))
+
+        # errors come as soon as they're read, not after reading everything else
+        read = []
+
+        def chunks():
+            for chunk in ["setv va00 -", "1\n", "$", "a\nstop & ", "stop\n"] * 100:
+                read.append(chunk)
+                yield chunk
+
+        with self.assertRaisesRegex(Exception, "Unexpected character '&'"):
+            list(lexcaos_stream(chunks()))
+        self.assertEqual(4, len(read))
+        for s in ["setv va00 - 1", "$&", '"a\nb\\', "ownr.$x"]:
+            with self.assertRaises(Exception) as expected:
+                lexcaos(s + "@")
+            with self.assertRaises(Exception) as actual:
+                list(lexcaos_stream([s, "@", "stop"]))
+            self.assertEqual(str(expected.exception), str(actual.exception))
+
+    def test_token_buffer(self):
+        tokens = lexcaos("setv va00 1\nstop")
+        buf = TokenBuffer(tokens)
+        self.assertEqual(len(tokens), len(buf))
+        self.assertEqual(tokens, list(buf))
+        self.assertEqual(tokens[2], buf[2])
+        self.assertEqual(tokens[1:4], list(buf[1:4]))
+        self.assertEqual(tokens + [(TOK_EOI, "")], list(buf + [(TOK_EOI, "")]))
+
+        buf.insert(0, (TOK_COMMENT, "* hi"))
+        del buf[1]
+        buf[0] = (TOK_WORD, "sets")
+        buf.whiteout(1, 3)
+        self.assertEqual(buf[1], (TOK_WHITESPACE, ""))
+        self.assertEqual(tokens_to_string(buf), "sets 1\nstop")
+
+    def test_token_buffer_splice(self):
+        tokens = lexcaos("stop\nstop\nstop")
+        buf = TokenBuffer(tokens)
+        for i in (4, 2, 0, 5):
+            snippet = lexcaos("setv va00 %d\n" % i)[:-1]
+            tokens[i:i] = snippet
+            buf[i:i] = snippet
+            self.assertEqual(tokens, list(buf))
+        buf.splice(1, [(TOK_WORD, "endm")], 3)
+        del tokens[1:4]
+        tokens.insert(1, (TOK_WORD, "endm"))
+        self.assertEqual(tokens, list(buf))
+        self.assertEqual(tokens_to_string(tokens), tokens_to_string(buf))
+
+    def test_node_list_offsets(self):
+        def make_nodes():
+            return [MacroDefinitionEnd(i * 10, i * 10 + 5) for i in range(6)]
+
+        expected = make_nodes()
+        nodes = NodeList(make_nodes())
+        for (node_index, offset) in ((2, 3), (2, 4), (4, 1), (1, 2)):
+            add_token_offset_to_nodes(expected[node_index:], offset)
+            nodes.add_token_offset(node_index, offset)
+        expected.insert(3, MacroDefinitionEnd(0, 0))
+        nodes.insert(3, MacroDefinitionEnd(0, 0))
+        self.assertEqual(expected[4], nodes[4])
+        del expected[5]
+        del nodes[5]
+        self.assertEqual(expected, list(nodes))
+
+    def test_parse_nodes(self):
+        nodes = parse(lexcaos("setv va00 targ.posx\n"))
+        self.assertEqual(
+            nodes,
+            [
+                Command(
+                    name="setv",
+                    args=[
+                        Command(
+                            name="va00",
+                            args=[],
+                            commandtype="expression",
+                            commandret="variable",
+                            start_token_in_parent=2,
+                            end_token_in_parent=2,
+                        ),
+                        DotCommand(
+                            targ="targ",
+                            name="posx",
+                            args=[],
+                            commandtype="expression",
+                            commandret="float",
+                            start_token_in_parent=4,
+                            end_token_in_parent=6,
+                        ),
+                    ],
+                    commandtype="statement",
+                    commandret="command",
+                    start_token=0,
+                    end_token=6,
+                )
+            ],
+        )
+        self.assertEqual(
+            node_to_dict(nodes[0].args[1]),
+            {
+                "type": "DotCommand",
+                "targ": "targ",
+                "name": "posx",
+                "args": [],
+                "commandtype": "expression",
+                "commandret": "float",
+                "start_token_in_parent": 4,
+                "end_token_in_parent": 6,
+            },
+        )
+
+    def test_parse_numbered_variables(self):
+        nodes = parse(lexcaos("SETV VA12 mv03\nsetv ov99 1\n"))
+        self.assertEqual(nodes[0].name, "setv")
+        self.assertEqual([_.name for _ in nodes[0].args], ["va12", "mv03"])
+        self.assertEqual(
+            [_.commandret for _ in nodes[0].args], ["variable", "variable"]
+        )
+        self.assertEqual(nodes[1].args[0].name, "ov99")
+        with self.assertRaisesRegex(Exception, "Unknown command 'va1'"):
+            parse(lexcaos("setv va1 1\n"))
+
+    def test_command_info_cache(self):
+        command = {
+            "name": "OUTS",
+            "match": "OUTS",
+            "type": "command",
+            "arguments": [{"name": "text", "type": "string"}],
+            "description": "not needed by the parser",
+        }
+        with tempfile.TemporaryDirectory() as tmpdir:
+            json_path = os.path.join(tmpdir, "commandinfo.json")
+            cache_dir = os.path.join(tmpdir, "cache")
+
+            def write_json(commands):
+                with open(json_path, "w") as f:
+                    json.dump({"variants": {"c3": commands}}, f)
+
+            def load():
+                return caoscommandinfo.load_command_info("c3", json_path, cache_dir)
+
+            write_json({"c_OUTS": command})
+            expected = [{k: v for k, v in command.items() if k != "description"}]
+            self.assertEqual(load(), expected)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+            # served from the cache even if the JSON is unreadable
+            os.rename(json_path, json_path + ".bak")
+            with open(json_path, "w") as f:
+                f.write(" " * os.path.getsize(json_path + ".bak"))
+            stat = os.stat(json_path + ".bak")
+            os.utime(json_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(load(), expected)
+
+            # rebuilt once the contents change
+            write_json({"c_OUTS": dict(command, type="integer")})
+            self.assertEqual(load()[0]["type"], "integer")
+
+    def test_command_info_variants(self):
+        c3 = caoscommandinfo.get_variant("c3")
+        self.assertIs(caoscommandinfo.get_variant("c3"), c3)
+        self.assertIs(caoscommandinfo.COMMAND_INFO_C3_DICT, c3.commands_dict)
+        self.assertEqual(c3.commands_dict[("", "face", False)]["type"], "anything")
+        self.assertFalse(any(_["name"] == "FACE INT" for _ in c3.commands))
+        c1 = caoscommandinfo.get_variant("c1")
+        self.assertNotIn(("", "face", False), c1.commands_dict)
+
+        self.assertEqual(
+            extendedcaos_to_caos('outs "hi"\n', variant="c1"), 'outs "hi"\n'
+        )
+        with self.assertRaisesRegex(Exception, "Unknown variant"):
+            extendedcaos_to_caos('outs "hi"\n', variant="c4")
+
+        # setv is a namespace too in C1 and C2, for setv clas and setv cls2
+        source = "setv var0 posl\nsetv obv1 var0\nsetv clas 100\n"
+        self.assertEqual(extendedcaos_to_caos(source, variant="c1"), source)
+        source = "setv va00 posx\nsetv cls2 2 5 100\n"
+        self.assertEqual(extendedcaos_to_caos(source, variant="c2"), source)
+        with self.assertRaisesRegex(Exception, "Unknown command 'clas'"):
+            extendedcaos_to_caos("setv clas 100\n", variant="c2")
+
+    def test_pass_schedule(self):
+        self.assertEqual(
+            [
+                "short_circuit",
+                "macros",
+                "explicit_targs",
+                "constants+agent_variables",
+                "includes",
+                "redundant_targs",
+                "named_variables",
+            ],
+            [p.name for p in SCHEDULE],
+        )
+
+        def noop(tokens, parsetree):
+            pass
+
+        passes = [Pass("b", noop, ["a"]), Pass("a", noop), Pass("c", noop, ["a"])]
+        self.assertEqual(["a", "b", "c"], [p.name for p in schedule_passes(passes)])
+        self.assertEqual(
+            ["a", "b+c"],
+            [p.name for p in schedule_passes(passes, {("b", "c"): noop})],
+        )
+        # not fused when something else has to run in between
+        self.assertEqual(
+            ["a", "b", "c"],
+            [p.name for p in schedule_passes(passes, {("a", "c"): noop})],
+        )
+        with self.assertRaises(Exception):
+            schedule_passes([Pass("a", noop, ["b"]), Pass("b", noop, ["a"])])
+        with self.assertRaises(Exception):
+            schedule_passes([Pass("a", noop, ["missing"])])
+
+        timings = {}
+        extendedcaos_to_caos("setv $foo 1\n", timings=timings)
+        self.assertEqual(
+            ["parse"] + [p.name for p in SCHEDULE] + ["render"], list(timings)
+        )
+
+    def test_profile(self):
+        events = []
+        profile = caosprofile.Profile(
+            on_pass_start=lambda name: events.append(("start", name)),
+            on_pass_end=lambda name, seconds: events.append(("end", name)),
+        )
+        extendedcaos_to_caos(
+            """
+            setv $foo 1
+            doif $foo = 1 and $foo < 2
+                from.mvsf 5 6
+            endi
+            """,
+            profile=profile,
+        )
+        names = ["parse"] + [p.name for p in SCHEDULE] + ["render"]
+        self.assertEqual(names, list(profile.timings))
+        self.assertEqual(
+            [(e, name) for name in names for e in ("start", "end")], events
+        )
+        self.assertEqual(3, profile.counters["named_variables"]["variables allocated"])
+        self.assertGreater(profile.counters["short_circuit"]["nodes reparsed"], 0)
+        self.assertGreater(profile.totals()["tokens inserted"], 0)
+        self.assertGreater(profile.totals()["snippets generated"], 0)
+        self.assertIn("named_variables", profile.format_table())
+
+        # nothing is collected when it's not asked for
+        extendedcaos_to_caos("setv $foo 1\n")
+        self.assertEqual(3, profile.totals()["variables allocated"])
+
+        # or from other threads
+        with caosprofile.profiling(profile):
+            thread = threading.Thread(
+                target=caosprofile.count, args=(caosprofile.VARIABLES_ALLOCATED,)
+            )
+            thread.start()
+            thread.join()
+        self.assertEqual(3, profile.totals()["variables allocated"])
+
+    def test_benchmark_cases_compile(self):
+        for name in benchmark.CASES:
+            source = benchmark.generate_case(name, scale=0.05)
+            result = benchmark.benchmark_case(source, repeat=1)
+            self.assertEqual(
+                ["parse"] + [p.name for p in SCHEDULE] + ["render"],
+                list(result["passes"]),
+            )
+            self.assertNotIn("$", extendedcaos_to_caos(source))
+
+    def test_compile_files(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, "in", "sub"))
+            files = {
+                "b.cos": "setv $foo 1\n",
+                "a.cos": "unknowncommand\n",
+                "sub/c.cos": "constant :five 5\nsetv va00 :five\n",
+                "sub/d.cos": "anotherunknowncommand\n",
+                "notes.txt": "not caos",
+            }
+            for name, text in files.items():
+                with open(os.path.join(d, "in", name), "w") as f:
+                    f.write(text)
+
+            for jobs in (1, 2):
+                out = os.path.join(d, "out%d" % jobs)
+                results = caosbatch.compile_files([os.path.join(d, "in")], out, jobs)
+                self.assertEqual(
+                    ["a.cos", "b.cos", "sub/c.cos", "sub/d.cos"],
+                    [os.path.relpath(_.source, os.path.join(d, "in")) for _ in results],
+                )
+                self.assertEqual(
+                    [True, False, False, True], [bool(_.error) for _ in results]
+                )
+                with open(os.path.join(out, "b.cos")) as f:
+                    self.assertEqual("setv va00 1\n", f.read())
+                with open(os.path.join(out, "sub", "c.cos")) as f:
+                    self.assertEqual("setv va00 5\n", f.read())
+
+            # without an output directory, outputs go next to the sources and
+            # don't get picked up as sources next time
+            source = os.path.join(d, "in", "b.cos")
+            caosbatch.compile_files([source])
+            self.assertTrue(os.path.exists(os.path.join(d, "in", "b.compiled.cos")))
+            self.assertEqual(
+                4, len(caosbatch.find_sources([os.path.join(d, "in")]))
+            )
+
+    def test_compile_cache(self):
+        source = "constant :five 5\nsetv $foo :five\n"
+        expected = extendedcaos_to_caos(source)
+        with tempfile.TemporaryDirectory() as d:
+            cache = caoscache.CompileCache(d)
+            self.assertEqual(expected, cache.compile(source))
+            self.assertEqual(expected, cache.compile(source))
+            self.assertEqual(
+                (1, 0, 1), (cache.memo_hits, cache.disk_hits, cache.misses)
+            )
+
+            # a new process would find it on disk
+            cache = caoscache.CompileCache(d)
+            self.assertEqual(expected, cache.compile(source))
+            self.assertEqual(
+                (0, 1, 0), (cache.memo_hits, cache.disk_hits, cache.misses)
+            )
+
+            self.assertNotEqual(cache.key(source), cache.key(source + "\n"))
+            self.assertNotEqual(cache.key(source), cache.key(source, "c2"))
+
+            # errors aren't cached
+            with self.assertRaises(Exception):
+                cache.compile("unknowncommand\n")
+            with self.assertRaises(Exception):
+                cache.compile("unknowncommand\n")
+
+            # the least recently used entries go first once it's too big
+            cache = caoscache.CompileCache(d, max_bytes=30, memo_size=0)
+            cache.clear()
+            for i, text in enumerate(("setv va00 1\n", "setv va01 2\n")):
+                cache.compile(text)
+                os.utime(os.path.join(d, cache.key(text) + ".cos"), (i, i))
+            cache.compile("setv va00 1\n")
+            cache.compile("setv va02 3\n")
+            self.assertEqual(
+                sorted(
+                    cache.key(_) + ".cos" for _ in ("setv va00 1\n", "setv va02 3\n")
+                ),
+                sorted(os.listdir(d)),
+            )
+            self.assertEqual(
+                (0, 1, 3), (cache.memo_hits, cache.disk_hits, cache.misses)
+            )
+
+    def test_incremental_compile(self):
+        source = """
+        agent_variable $chem ov12
+        constant :five 5
+        constant :six 6
+        macro SetChem value
+            setv targ.$chem $value
+        endmacro
+        scrp 1 2 3 4
+            SetChem 5
+        endm
+        scrp 1 2 3 5
+            setv $x :six * uses :six
+            doif $x = 1 and $x < 2
+                stop
+            endi
+        endm
+        rscr
+        dbg: outv :five
+        """
+        compiler = caosincremental.IncrementalCompiler()
+        self.assertEqual(extendedcaos_to_caos(source), compiler.compile(source))
+        self.assertEqual((4, 0), (compiler.compiled, compiler.reused))
+
+        # only the script that changed
+        edited = source.replace("stop", "dbg: outs \"stop\"")
+        self.assertEqual(extendedcaos_to_caos(edited), compiler.compile(edited))
+        self.assertEqual((1, 3), (compiler.compiled, compiler.reused))
+
+        # the definitions, and everything using them
+        edited = edited.replace(":five 5", ":five 55")
+        self.assertEqual(extendedcaos_to_caos(edited), compiler.compile(edited))
+        self.assertEqual((2, 2), (compiler.compiled, compiler.reused))
+
+        edited = edited.replace("$value", "$value\n    dbg: outv 6")
+        self.assertEqual(extendedcaos_to_caos(edited), compiler.compile(edited))
+        self.assertEqual((2, 2), (compiler.compiled, compiler.reused))
+
+        # macros defined twice apply to the whole file, so it all gets compiled
+        edited += "macro SetChem value\nendmacro\n"
+        self.assertEqual(extendedcaos_to_caos(edited), compiler.compile(edited))
+        self.assertEqual((1, 0), (compiler.compiled, compiler.reused))
+
+    def test_incremental_compile_matches_full_compile(self):
+        body = "".join("setv $v%d %d\n" % (i, i) for i in range(101))
+        body += "".join("dbg: outv $v%d\n" % i for i in range(101))
+        for (source, compiled) in (
+            # the install script goes on after endm
+            ("targ norn\nscrp 1 2 3 4\nendm\nkill targ\n", 1),
+            (
+                "setv $z 1\nscrp 1 2 3 4\n    setv $a 2\nendm\n"
+                "setv $w 3\ndbg: outv $z\ndbg: outv $w\n",
+                1,
+            ),
+            # TARG only needs restoring before a scrp if code after it reads it
+            ("seta $a ownr\nfrom.mvsf 0 49\nscrp 2 3 4 0\ninst\nendm\n", 2),
+            # spill variables apply to every script
+            ("spill_variable mv98\nscrp 1 2 3 4\n" + body + "endm\n", 2),
+            ('spill_variable game "spill"\n' + body + "scrp 1 2 3 4\nendm\n", 1),
+        ):
+            compiler = caosincremental.IncrementalCompiler()
+            self.assertEqual(extendedcaos_to_caos(source), compiler.compile(source))
+            self.assertEqual(compiled, compiler.compiled)
+
+    def test_include(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, "base.ecos"), "w") as f:
+                f.write("constant :two 2\n")
+            with open(os.path.join(d, "lib.ecos"), "w") as f:
+                f.write(
+                    'include "base.ecos"\n'
+                    "agent_variable $counter ov10\n"
+                    "macro Reset\n"
+                    "    setv ov11 0\n"
+                    "endmacro\n"
+                )
+            source = (
+                'include "lib.ecos"\n'
+                "scrp 1 2 3 4\n"
+                "    setv targ.$counter :two\n"
+                "    Reset\n"
+                "endm\n"
+            )
+            desired_output = (
+                "scrp 1 2 3 4\n"
+                "    setv ov10 2\n"
+                "    setv ov11 0\n"
+                "endm\n"
+            )
+
+            # parsed once, however many sources include it
+            profile = caosprofile.Profile()
+            for _ in range(2):
+                self.assertMultiLineEqual(
+                    desired_output,
+                    extendedcaos_to_caos(source, profile=profile, include_dirs=[d]),
+                )
+            self.assertEqual(2, profile.totals()[caosprofile.LIBRARIES_COMPILED])
+            self.assertEqual(
+                ["base.ecos", "lib.ecos"],
+                sorted(_.split(".c3.")[0] for _ in os.listdir(d + "/__pycache__")),
+            )
+
+            # touching a library doesn't mean parsing it again, and editing one
+            # doesn't mean parsing the libraries that include it again
+            os.utime(os.path.join(d, "lib.ecos"))
+            with open(os.path.join(d, "base.ecos"), "w") as f:
+                f.write("constant :two 22\n")
+            profile = caosprofile.Profile()
+            cache = caoscache.CompileCache()
+            # the cache loads libraries itself, to see if they've changed
+            with caosprofile.profiling(profile):
+                self.assertMultiLineEqual(
+                    desired_output.replace(" 2\n", " 22\n"),
+                    cache.compile(source, include_dirs=[d]),
+                )
+            self.assertEqual(1, profile.totals()[caosprofile.LIBRARIES_COMPILED])
+
+            # the compile cache notices libraries changing too
+            with open(os.path.join(d, "base.ecos"), "w") as f:
+                f.write("constant :two 3\n")
+            self.assertMultiLineEqual(
+                desired_output.replace(" 2\n", " 3\n"),
+                cache.compile(source, include_dirs=[d]),
+            )
+
+            compiler = caosincremental.IncrementalCompiler(include_dirs=[d])
+            edited = source + "scrp 1 2 3 5\n    Reset\nendm\n"
+            for text in (source, edited):
+                self.assertEqual(
+                    extendedcaos_to_caos(text, include_dirs=[d]),
+                    compiler.compile(text),
+                )
+            self.assertEqual((1, 2), (compiler.compiled, compiler.reused))
+
+            with open(os.path.join(d, "bad.ecos"), "w") as f:
+                f.write("constant :two 2\nsetv va00 :two\n")
+            with self.assertRaisesRegex(Exception, "only contain definitions"):
+                extendedcaos_to_caos('include "bad.ecos"\n', include_dirs=[d])
+            with self.assertRaisesRegex(Exception, "Can't find library"):
+                extendedcaos_to_caos('include "missing.ecos"\n', include_dirs=[d])
+
+    def test_watcher(self):
+        with tempfile.TemporaryDirectory() as d:
+            source = os.path.join(d, "in")
+            out = os.path.join(d, "out")
+            os.makedirs(source)
+            for name, text in (("a.cos", "setv $x 1\n"), ("b.cos", "setv $y 2\n")):
+                with open(os.path.join(source, name), "w") as f:
+                    f.write(text)
+
+            watcher = caoswatch.Watcher([source], out)
+            self.assertEqual(
+                ["a.cos", "b.cos"],
+                [os.path.basename(_.destination) for _ in watcher.poll()],
+            )
+            self.assertEqual([], watcher.poll())
+
+            with open(os.path.join(source, "b.cos"), "w") as f:
+                f.write("setv $y 2\nunknowncommand\n")
+            with open(os.path.join(source, "c.cos"), "w") as f:
+                f.write("setv $z 3\n")
+            results = watcher.poll()
+            self.assertEqual(
+                ["b.cos", "c.cos"], [os.path.basename(_.source) for _ in results]
+            )
+            self.assertEqual([True, False], [bool(_.error) for _ in results])
+            with open(os.path.join(out, "c.cos")) as f:
+                self.assertEqual("setv va00 3\n", f.read())
+            # b.cos keeps its last good output, and no temporary files are left
+            self.assertEqual(["a.cos", "b.cos", "c.cos"], sorted(os.listdir(out)))
+
+            os.remove(os.path.join(source, "a.cos"))
+            self.assertEqual([], watcher.poll())
+            self.assertNotIn(os.path.join(source, "a.cos"), watcher.compilers)
+
+    def test_compile_server(self):
+        with tempfile.TemporaryDirectory() as d:
+            address = os.path.join(d, "server.sock")
+            service = caosserver.CompileService()
+            server = caosserver.make_server(address, service)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                # several requests over one connection
+                with caosserver.connect(address) as sock:
+                    with sock.makefile("rwb") as f:
+                        caosserver.write_message(f, {"id": 1, "source": "setv $x 1"})
+                        caosserver.write_message(f, {"id": 2, "source": "blah"})
+                        caosserver.write_message(f, {"id": 3})
+                        responses = [caosserver.read_message(f) for _ in range(3)]
+                self.assertEqual([1, 2, 3], [_["id"] for _ in responses])
+                self.assertEqual("setv va00 1", responses[0]["output"])
+                self.assertEqual([], responses[0]["diagnostics"])
+                for response in responses[1:]:
+                    self.assertIsNone(response["output"])
+                    self.assertEqual(
+                        ["error"], [_["severity"] for _ in response["diagnostics"]]
+                    )
+
+                # and several connections at once
+                sources = ["setv $x %d\nsetv $y $x" % i for i in range(8)]
+                results = [None] * len(sources)
+
+                def send(i):
+                    results[i] = caosserver.compile_remote(
+                        address, sources[i], path="file%d.cos" % (i % 2)
+                    )
+
+                threads = [
+                    threading.Thread(target=send, args=(i,))
+                    for i in range(len(sources))
+                ]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                self.assertEqual(
+                    [extendedcaos_to_caos(_) for _ in sources],
+                    [_["output"] for _ in results],
+                )
+                self.assertEqual(
+                    [("file0.cos", "c3"), ("file1.cos", "c3")],
+                    sorted(service.documents),
+                )
+
+                # a server that's running doesn't get its socket taken over
+                with self.assertRaisesRegex(Exception, "already running"):
+                    caosserver.make_server(address)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+            # but one that's gone does
+            self.assertTrue(os.path.exists(address))
+            caosserver.make_server(address).server_close()
+
+        # only the documents used most recently are kept
+        service = caosserver.CompileService(max_documents=2)
+        for path in ("a.cos", "b.cos", "a.cos", "c.cos"):
+            service.compile("setv $x 1\n", path=path)
+        self.assertEqual([("a.cos", "c3"), ("c.cos", "c3")], list(service.documents))
+
+    def test_macro_definition_after_short_circuit(self):
+        input = """
+        doif 1 = 1 or 2 = 2
+            stop
+        endi
+        macro MyMacro
+            dbg: outs "in macro"
+        endmacro
+        MyMacro
+        """
+        desired_output = """
+        setv va00 0
+        doif 1 = 1
+            setv va00 1
+        endi
+        doif va00 = 0
+            doif 2 = 2
+                setv va00 1
+            endi
+        endi
+        doif va00 = 1
+            stop
+        endi
+        dbg: outs "in macro"
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
+    def test_nested_short_circuit_after_earlier_short_circuit(self):
+        input = """
+        scrp 3 1 21051 1
+            doif posx > 0 and posx > 1
+                dbg: outv 0
+            endi
+        endm
+        scrp 1 2 3 4
+            doif posx = 3 and posy < 2
+                doif va05 = null or posy > 4
+                    seta va05 targ
+                endi
+            endi
+        endm
+        """
+        desired_output = """
+        scrp 3 1 21051 1
+            setv va00 0
+            doif posx > 0
+                setv va00 1
+            endi
+            doif va00 = 1
+                doif posx > 1
+                else
+                    setv va00 0
+                endi
+            endi
+            doif va00 = 1
+                dbg: outv 0
+            endi
+        endm
+        scrp 1 2 3 4
+            setv va00 0
+            doif posx = 3
+                setv va00 1
+            endi
+            doif va00 = 1
+                doif posy < 2
+                else
+                    setv va00 0
+                endi
+            endi
+            doif va00 = 1
+                setv va00 0
+                doif va05 = null
+                    setv va00 1
+                endi
+                doif va00 = 0
+                    doif posy > 4
+                        setv va00 1
+                    endi
+                endi
+                doif va00 = 1
+                    seta va05 targ
+                endi
+            endi
+        endm
+        """
+        self.assertMultiLineEqual(desired_output, extendedcaos_to_caos(input))
+
     def test_parse_face(self):
         # FACE is a different command depending on the expected return type
         # openc2e handles this in a weird way, and thus commandinfo.json is weird